@@ -1,18 +1,20 @@
 import streamlit as st
-import cv2
 import numpy as np
 import pandas as pd
 import os
 import tempfile
-from PIL import Image
-import io
-import zipfile
 from datetime import datetime
-from grade_mcq import (
-    load_image, find_sheet_corners, warp_perspective, 
-    extract_question_boxes, detect_colored_bubble, 
-    load_marking_scheme, grade
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from grade_core import MarkingScheme, load_marking_scheme
+from item_analysis import ItemAnalysis, LOW_DISCRIMINATION
+from sheet_layout import load_layout, available_layouts, DEFAULT_LAYOUT_NAME
+from functools import partial
+from app_backend import (
+    process_single_sheet, ResultMemo, SessionImageDir, result_key, DEFAULT_CACHE_PATH, upload_sheet_sources,
+    detected_answers_table, results_table, item_analysis_table, make_thumbnail, write_results_zip
 )
+from instrumentation import PrometheusExporter
 
 # Page configuration
 st.set_page_config(
@@ -61,124 +63,112 @@ if 'marking_scheme_name' not in st.session_state:
     st.session_state.marking_scheme_name = None
 if 'results' not in st.session_state:
     st.session_state.results = []
-if 'annotated_images' not in st.session_state:
-    st.session_state.annotated_images = []
+if 'item_report' not in st.session_state:
+    st.session_state.item_report = None
+if 'image_dir' not in st.session_state:
+    st.session_state.image_dir = None
 
-def annotate_image(image, detected_answers, marking_scheme):
-    """Annotate image with detected answers and correctness"""
-    annotated = image.copy()
-    question_boxes_coords = []
-    
-    # Get image dimensions
-    height, width = image.shape[:2]
-    num_columns, num_rows = 5, 10
-    box_width, box_height = width // num_columns, height // num_rows
-    
-    # Calculate coordinates for each question
-    for j in range(num_columns):
-        for i in range(num_rows):
-            top_left = (j * box_width, i * box_height)
-            bottom_right = ((j + 1) * box_width, (i + 1) * box_height)
-            question_boxes_coords.append((top_left, bottom_right))
-    
-    # Annotate each question
-    for idx, (q_no, detected_answer) in enumerate(detected_answers):
-        if idx >= len(question_boxes_coords):
-            break
-            
-        top_left, bottom_right = question_boxes_coords[idx]
-        
-        # Check if answer is correct
-        correct_data = marking_scheme.get(q_no, {})
-        correct_answers = correct_data.get('correct_answers', [])
-        condition = correct_data.get('condition', '-')
-        
-        is_correct = detected_answer in correct_answers if condition in ['-', 'Any'] else set(correct_answers) == {detected_answer}
-        
-        # Draw rectangle around the question box
-        color = (0, 255, 0) if is_correct else (0, 0, 255)  # Green if correct, Red if wrong
-        cv2.rectangle(annotated, top_left, bottom_right, color, 3)
-        
-        # Add question number and detected answer
-        text = f"Q{q_no}: {detected_answer}"
-        cv2.putText(annotated, text, (top_left[0] + 5, top_left[1] + 25), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
-        
-        # Add checkmark or cross
-        symbol = "✓" if is_correct else "✗"
-        cv2.putText(annotated, symbol, (bottom_right[0] - 30, top_left[1] + 25),
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
-    
-    return annotated
+def clear_results():
+    """Forget the graded sheets, deleting their annotated images"""
+    st.session_state.results = []
+    st.session_state.item_report = None
+    if st.session_state.image_dir is not None:
+        st.session_state.image_dir.remove()
+        st.session_state.image_dir = None
 
-def process_single_sheet(image_file, marking_scheme, file_name):
-    """Process a single answer sheet"""
-    try:
-        # Load image
-        file_bytes = np.asarray(bytearray(image_file.read()), dtype=np.uint8)
-        image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-        
-        # Process the sheet
-        corners = find_sheet_corners(image)
-        warped_image = warp_perspective(image, corners)
-        question_boxes = extract_question_boxes(warped_image)
-        
-        # Detect answers
-        detected_answers = [(i + 1, detect_colored_bubble(question_box)) 
-                          for i, question_box in enumerate(question_boxes)]
-        
-        # Create DataFrame
-        detected_answers_df = pd.DataFrame(detected_answers, columns=["q_no", "option"])
-        
-        # Grade
-        results_df = grade(detected_answers_df, marking_scheme)
-        total_marks = results_df['Correct'].sum()
-        
-        # Annotate image
-        annotated_image = annotate_image(warped_image, detected_answers, marking_scheme)
-        
-        return {
-            'file_name': file_name,
-            'total_marks': total_marks,
-            'results_df': results_df,
-            'detected_answers_df': detected_answers_df,
-            'annotated_image': annotated_image,
-            'success': True,
-            'error': None
-        }
-    except Exception as e:
-        return {
-            'file_name': file_name,
-            'success': False,
-            'error': str(e)
-        }
+@st.cache_resource
+def get_executor():
+    """Process pool shared by all sessions of this server"""
+    # Spawned workers import app_backend cleanly instead of forking the Streamlit server
+    return ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context("spawn"))
 
-def create_download_zip(results):
-    """Create a ZIP file with all results"""
-    zip_buffer = io.BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        # Add individual result CSVs
-        for result in results:
+@st.cache_resource
+def get_result_memo():
+    """Graded sheets shared by all sessions, so re-uploads and reruns skip the CV work"""
+    return ResultMemo()
+
+@st.cache_resource
+def get_metrics_exporter():
+    """Stage timings of every graded sheet, served in Prometheus format when MCQ_GRADER_METRICS_PORT is set"""
+    exporter = PrometheusExporter()
+    port = os.environ.get("MCQ_GRADER_METRICS_PORT")
+    if port:
+        exporter.serve(int(port))
+    return exporter
+
+def grade_uploaded_files(sources, marking_scheme, on_result, image_dir, layout=None):
+    """Grade uploaded sheets concurrently, calling on_result(index, result) as each sheet completes; annotated
+    sheets go to image_dir (a SessionImageDir)"""
+    executor = get_executor()
+    memo = get_result_memo()
+    metrics = get_metrics_exporter()
+    futures = {}
+    # Sheets are read as they are submitted, so only this many pages are held in memory at once
+    max_in_flight = 2 * (os.cpu_count() or 1)
+    # The scheme is uploaded before a layout is picked; grade it with that layout's answer options
+    marking_scheme = MarkingScheme(marking_scheme, layout)
+    
+    def collect(done):
+        for future in done:
+            idx, key = futures.pop(future)
+            result = future.result()
+            metrics.export(result['profile'])
             if result['success']:
-                csv_buffer = io.StringIO()
-                result['results_df'].to_csv(csv_buffer, index=False)
-                zip_file.writestr(f"{result['file_name']}_graded.csv", csv_buffer.getvalue())
-                
-                # Add annotated images
-                _, img_encoded = cv2.imencode('.png', result['annotated_image'])
-                zip_file.writestr(f"{result['file_name']}_annotated.png", img_encoded.tobytes())
-        
-        # Add summary CSV
-        summary_data = [{'file_name': r['file_name'], 'total_marks': r['total_marks']} 
-                       for r in results if r['success']]
-        summary_df = pd.DataFrame(summary_data)
-        summary_buffer = io.StringIO()
-        summary_df.to_csv(summary_buffer, index=False)
-        zip_file.writestr('Summary.csv', summary_buffer.getvalue())
-    
-    zip_buffer.seek(0)
-    return zip_buffer
+                memo.put(key, result)
+            on_result(idx, result)
+    
+    for idx, source in enumerate(sources):
+        file_name = source.name.rsplit('.', 1)[0]
+        try:
+            raw_bytes = source.read()
+        except ValueError as e:
+            on_result(idx, {'file_name': file_name, 'success': False, 'error': str(e)})
+            continue
+        key = result_key(raw_bytes, marking_scheme, layout)
+        cached = memo.get(key)
+        if cached is not None:
+            cached = image_dir.adopt(cached)
+        if cached is not None:
+            on_result(idx, dict(cached, file_name=file_name))
+        else:
+            if len(futures) >= max_in_flight:
+                collect(wait(futures, return_when=FIRST_COMPLETED).done)
+            future = executor.submit(process_single_sheet, raw_bytes, marking_scheme, file_name, image_dir.path,
+                                     DEFAULT_CACHE_PATH, layout=layout)
+            futures[future] = (idx, key)
+    
+    collect(as_completed(futures))
+
+def summary_frame(results):
+    """Summary table rows for the graded sheets"""
+    summary_data = []
+    for result in results:
+        if result['success']:
+            summary_data.append({
+                'Student': result['file_name'],
+                'Total Marks': f"{result['total_marks']}/{len(result['question_ids'])}",
+                'Percentage': f"{(result['total_marks']/len(result['question_ids']))*100:.1f}%",
+                'Status': 'Successfully Graded'
+            })
+        else:
+            summary_data.append({
+                'Student': result['file_name'],
+                'Total Marks': 'Error',
+                'Percentage': '-',
+                'Status': f"Error: {result['error']}"
+            })
+    return pd.DataFrame(summary_data)
+
+def create_download_zip(results, item_report=None):
+    """Write the results ZIP to an anonymous temp file; only called when a download is requested"""
+    zip_file = tempfile.TemporaryFile()
+    write_results_zip(results, zip_file, item_report)
+    zip_file.seek(0)
+    return zip_file
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_thumbnail(annotated_path):
+    return make_thumbnail(annotated_path)
 
 # Main App
 st.markdown('<div class="main-header">Automatic MCQ Grader</div>', unsafe_allow_html=True)
@@ -245,8 +235,7 @@ with st.sidebar:
         if st.button("🔄 Change Marking Scheme"):
             st.session_state.marking_scheme = None
             st.session_state.marking_scheme_name = None
-            st.session_state.results = []
-            st.session_state.annotated_images = []
+            clear_results()
             st.rerun()
         
         st.markdown("---")
@@ -262,6 +251,15 @@ with st.sidebar:
         if len(st.session_state.marking_scheme) > 5:
             st.caption(f"...and {len(st.session_state.marking_scheme) - 5} more questions")
 
+    st.markdown("---")
+    layout_names = available_layouts()
+    sheet_layout = load_layout(st.selectbox(
+        "📐 Sheet Layout",
+        layout_names,
+        index=layout_names.index(DEFAULT_LAYOUT_NAME),
+        help="Bubble grid printed on the answer sheets (layout files in sheet_layouts/)"
+    ))
+
 # Main content area
 if st.session_state.marking_scheme is None:
     # Welcome section
@@ -376,7 +374,7 @@ if st.session_state.marking_scheme is None:
             <ul style='color: #666;'>
                 <li><code style='background: #e0e0e0; padding: 2px 6px; border-radius: 3px;'>-</code> (single) : Only one specific answer</li>
                 <li><code style='background: #e0e0e0; padding: 2px 6px; border-radius: 3px;'>Any</code> : Any of listed answers is correct</li>
-                <li><code style='background: #e0e0e0; padding: 2px 6px; border-radius: 3px;'>All</code> : All answers must be selected</li>
+                <li><code style='background: #e0e0e0; padding: 2px 6px; border-radius: 3px;'>All</code> : Partial credit for each valid answer selected, minus a penalty for invalid ones</li>
             </ul>
         </div>
         """, unsafe_allow_html=True)
@@ -410,8 +408,7 @@ else:
         if st.button("🔄 Start Over", type="secondary", use_container_width=True):
             st.session_state.marking_scheme = None
             st.session_state.marking_scheme_name = None
-            st.session_state.results = []
-            st.session_state.annotated_images = []
+            clear_results()
             st.rerun()
     
     # Success message after marking scheme is loaded
@@ -432,9 +429,10 @@ else:
     with col1:
         uploaded_files = st.file_uploader(
             "📁 Choose Answer Sheet Images",
-            type=['jpg', 'jpeg', 'png'],
+            type=['jpg', 'jpeg', 'png', 'tif', 'tiff', 'zip'],
             accept_multiple_files=True,
-            help="Select one or more answer sheet images. You can Ctrl+Click to select multiple files"
+            help="Select one or more answer sheet images, multi-page TIFFs or ZIP archives of images. "
+                 "You can Ctrl+Click to select multiple files"
         )
     
     with col2:
@@ -444,25 +442,39 @@ else:
     
     if uploaded_files:
         if st.button("Grade All Sheets", type="primary", use_container_width=True):
-            st.session_state.results = []
+            # The new results replace the old ones and their annotated images
+            clear_results()
+            st.session_state.image_dir = SessionImageDir()
             
             progress_bar = st.progress(0)
             status_text = st.empty()
+            live_table = st.empty()
             
-            for idx, uploaded_file in enumerate(uploaded_files):
-                status_text.text(f"Processing {idx + 1}/{len(uploaded_files)}: {uploaded_file.name}")
+            # TIFF pages and ZIP members are graded as sheets of their own, read from a spilled copy
+            with tempfile.TemporaryDirectory() as spill_dir:
+                sheets = upload_sheet_sources(uploaded_files, spill_dir)
+                results = [None] * len(sheets)
+                # Item statistics are updated as sheets finish, instead of re-reading every result at the end
+                item_analysis = ItemAnalysis(st.session_state.marking_scheme, sheet_layout.options)
                 
-                result = process_single_sheet(
-                    uploaded_file, 
-                    st.session_state.marking_scheme,
-                    uploaded_file.name.rsplit('.', 1)[0]
-                )
-                st.session_state.results.append(result)
+                def show_result(idx, result):
+                    # Stream each finished sheet into the table as it completes
+                    results[idx] = result
+                    if result['success']:
+                        item_analysis.add(result['options'])
+                    completed = [r for r in results if r is not None]
+                    status_text.text(f"Processed {len(completed)}/{len(sheets)}: {sheets[idx].name}")
+                    progress_bar.progress(len(completed) / len(sheets))
+                    live_table.dataframe(summary_frame(completed), use_container_width=True, hide_index=True)
                 
-                progress_bar.progress((idx + 1) / len(uploaded_files))
+                grade_uploaded_files(sheets, st.session_state.marking_scheme, show_result, st.session_state.image_dir,
+                                     sheet_layout)
+            st.session_state.results = results
+            st.session_state.item_report = item_analysis.report()
+            live_table.empty()
             
             status_text.text("✅ All sheets processed!")
-            st.success(f"Graded {len(uploaded_files)} answer sheets successfully!")
+            st.success(f"Graded {len(sheets)} answer sheets successfully!")
     
     # Display results
     if st.session_state.results:
@@ -470,61 +482,57 @@ else:
         st.subheader("Grading Results")
         
         # Summary table
-        summary_data = []
-        for result in st.session_state.results:
-            if result['success']:
-                summary_data.append({
-                    'Student': result['file_name'],
-                    'Total Marks': f"{result['total_marks']}/50",
-                    'Percentage': f"{(result['total_marks']/50)*100:.1f}%",
-                    'Status': 'Successfully Graded'
-                })
-            else:
-                summary_data.append({
-                    'Student': result['file_name'],
-                    'Total Marks': 'Error',
-                    'Percentage': '-',
-                    'Status': f"Error: {result['error']}"
-                })
-        
-        summary_df = pd.DataFrame(summary_data)
+        summary_df = summary_frame(st.session_state.results)
         st.dataframe(summary_df, use_container_width=True, hide_index=True)
         
         # Download button
         col1, col2, col3 = st.columns([1, 1, 2])
         with col1:
-            zip_buffer = create_download_zip(st.session_state.results)
+            # The ZIP is only built when the button is clicked, never on a rerun
             st.download_button(
                 label="Download All Results (ZIP)",
-                data=zip_buffer,
+                data=partial(create_download_zip, list(st.session_state.results), st.session_state.item_report),
                 file_name=f"grading_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
                 mime="application/zip"
             )
         
+        # Item analysis
+        item_report = st.session_state.item_report
+        if item_report is not None and item_report.sheets:
+            st.markdown("---")
+            st.subheader("Item Analysis")
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Sheets Analysed", item_report.sheets)
+            col2.metric("Mean Score", f"{item_report.mean_total:.2f}/{len(item_report.question_ids)}")
+            col3.metric("KR-20 Reliability",
+                        "n/a" if np.isnan(item_report.reliability) else f"{item_report.reliability:.3f}")
+            low = item_report.low_discrimination()
+            if low:
+                st.caption(f"Questions discriminating poorly (index below {LOW_DISCRIMINATION}): "
+                           f"{', '.join(map(str, low))}")
+            st.dataframe(item_analysis_table(item_report), use_container_width=True, hide_index=True)
+        
         # Detailed view
         st.markdown("---")
         st.subheader("Detailed View")
         
         for result in st.session_state.results:
             if result['success']:
-                with st.expander(f"{result['file_name']} - Score: {result['total_marks']}/50"):
+                with st.expander(f"{result['file_name']} - Score: {result['total_marks']}/{len(result['question_ids'])}"):
                     col1, col2, col3 = st.columns([1, 1, 1])
                     
                     with col1:
                         st.markdown("**Annotated Answer Sheet:**")
-                        # Convert BGR to RGB for display
-                        annotated_rgb = cv2.cvtColor(result['annotated_image'], cv2.COLOR_BGR2RGB)
-                        st.image(annotated_rgb, use_container_width=True)
+                        st.image(load_thumbnail(result['annotated_path']), use_container_width=True)
                     
                     with col2:
                         st.markdown("**Detected Answers:**")
-                        display_df = result['detected_answers_df'].copy()
-                        display_df.columns = ['Question', 'Answer']
+                        display_df = detected_answers_table(result)
                         st.dataframe(display_df, height=400, hide_index=True)
 
                     with col3:    
                         st.markdown("**Question-wise Results:**")
-                        results_display = result['results_df'].copy()
+                        results_display = results_table(result)
                         results_display['Correct'] = results_display['Correct'].map({True: '✅', False: '❌'})
                         st.dataframe(results_display, height=400, hide_index=True)
 
@@ -0,0 +1,282 @@
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+import zipfile
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from grade_core import (
+    find_sheet_corners, warp_perspective, sample_fill_ratios, select_options,
+    grade_sheet, detection_key, decode_image, answer_confidence
+)
+from sheet_layout import DEFAULT_LAYOUT, layout_geometry
+from detection_cache import DetectionCache, hash_image_bytes, CACHE_FILE_NAME
+from instrumentation import span, count, set_counter, profile_sheet
+from item_analysis import ITEM_ANALYSIS_FILE_NAME
+from sheet_sources import file_sheet_sources
+
+############################################################################
+
+###### Grading backend for the Streamlit app ######
+
+# Kept out of app.py so the app's executor workers can import it without
+# running the Streamlit script.
+
+############################################################################
+
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), f"mcq_grader_{CACHE_FILE_NAME}")
+
+# Detection caches opened by this process, keyed by path
+_detection_caches = {}
+_detection_caches_lock = threading.Lock()
+
+def get_detection_cache(cache_path=None):
+    """Detection cache shared by every thread of this process"""
+    cache_path = cache_path or DEFAULT_CACHE_PATH
+    with _detection_caches_lock:
+        if cache_path not in _detection_caches:
+            _detection_caches[cache_path] = DetectionCache(cache_path)
+        return _detection_caches[cache_path]
+
+class ResultMemo:
+    """Thread-safe LRU of graded sheets keyed by (image SHA-256, marking scheme fingerprint)"""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class SessionImageDir:
+    """Temporary folder for the annotated sheets of one app session, spilled there as PNGs named by image, marking
+    scheme and layout hash. It is removed when the session clears its results, when the session is dropped or at
+    exit, whichever comes first."""
+    __slots__ = ('path', '_finalizer', '__weakref__')
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix="mcq_grader_annotated_")
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+    def remove(self):
+        self._finalizer()
+
+    def adopt(self, result):
+        """A memoized result of another grading run with its annotated sheet copied into this folder, since the
+        folder it was written to may be removed while this session shows it"""
+        annotated_path = result.get('annotated_path')
+        if annotated_path is None or os.path.dirname(annotated_path) == self.path:
+            return result
+        if not os.path.exists(annotated_path):
+            return None
+        copy_path = os.path.join(self.path, os.path.basename(annotated_path))
+        try:
+            shutil.copyfile(annotated_path, copy_path)
+        except OSError:
+            # Removed by its session in the meantime
+            return None
+        return dict(result, annotated_path=copy_path)
+
+def upload_sheet_sources(uploaded_files, spill_dir):
+    """SheetSources of uploaded images, multi-page TIFFs and ZIP archives, each spilled to its own folder under
+    spill_dir so their sheets can be read one at a time"""
+    sources = []
+    for idx, uploaded_file in enumerate(uploaded_files):
+        upload_dir = os.path.join(spill_dir, str(idx))
+        os.makedirs(upload_dir, exist_ok=True)
+        path = os.path.join(upload_dir, os.path.basename(uploaded_file.name))
+        with open(path, 'wb') as file:
+            file.write(uploaded_file.getbuffer())
+        sources.extend(file_sheet_sources(path))
+    return sources
+
+def result_key(raw_bytes, marking_scheme, layout=None):
+    return hash_image_bytes(raw_bytes), marking_scheme.fingerprint(), (layout or DEFAULT_LAYOUT).fingerprint()
+
+def annotate_image(image, detected_answers, scores, layout=None):
+    """Annotate image with detected answers and per-question scores"""
+    annotated = image.copy()
+    
+    # Question boxes of the sheet layout, in question order
+    height, width = image.shape[:2]
+    geometry = layout_geometry(layout or DEFAULT_LAYOUT, width, height)
+    question_boxes_coords = [((x0, y0), (x1, y1)) for x0, y0, x1, y1 in geometry.box_rects.tolist()]
+    
+    # Annotate each question
+    for idx, (q_no, detected_answer) in enumerate(detected_answers):
+        if idx >= len(question_boxes_coords):
+            break
+            
+        top_left, bottom_right = question_boxes_coords[idx]
+        
+        # Check if answer is correct
+        score = scores[idx]
+        is_correct = score == 1
+        
+        # Draw rectangle around the question box
+        if is_correct:
+            color = (0, 255, 0)  # Green if correct
+        elif score > 0:
+            color = (0, 165, 255)  # Orange for partial credit
+        else:
+            color = (0, 0, 255)  # Red if wrong
+        cv2.rectangle(annotated, top_left, bottom_right, color, 3)
+        
+        # Add question number and detected answer
+        text = f"Q{q_no}: {detected_answer}"
+        cv2.putText(annotated, text, (top_left[0] + 5, top_left[1] + 25), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+        
+        # Add checkmark or cross
+        symbol = "✓" if is_correct else "✗"
+        cv2.putText(annotated, symbol, (bottom_right[0] - 30, top_left[1] + 25),
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+    
+    return annotated
+
+def save_annotated_image(annotated_image, image_dir, name):
+    """Encode the annotated sheet to PNG on disk and return its path"""
+    os.makedirs(image_dir, exist_ok=True)
+    path = os.path.join(image_dir, f"{name}.png")
+    # Write under a temporary name first, so concurrent workers never expose a partial file
+    tmp_path = os.path.join(image_dir, f"{name}.{os.getpid()}.{threading.get_ident()}.tmp.png")
+    cv2.imwrite(tmp_path, annotated_image)
+    os.replace(tmp_path, path)
+    return path
+
+def process_single_sheet(raw_bytes, marking_scheme, file_name, image_dir, cache_path=None, layout=None):
+    """Process a single answer sheet, given as encoded image bytes or a decoded TIFF page, writing its annotated
+    sheet to image_dir (the session's SessionImageDir path)"""
+    with profile_sheet(file_name) as profile:
+        result = _process_single_sheet(raw_bytes, marking_scheme, file_name, cache_path, image_dir,
+                                       layout or DEFAULT_LAYOUT)
+    # Stage timings travel back with the result, for the app's metrics exporter
+    result['profile'] = profile.as_dict()
+    return result
+
+def _process_single_sheet(raw_bytes, marking_scheme, file_name, cache_path, image_dir, layout):
+    try:
+        # Load image
+        with span('decode'):
+            image = decode_image(raw_bytes)
+        
+        # Reuse the corners and fill ratios of a sheet that was graded before
+        with span('cache_lookup'):
+            cache = get_detection_cache(cache_path)
+            image_sha256 = hash_image_bytes(raw_bytes)
+            # The same key as the CLI, so the app and batch runs share cache entries
+            fingerprint = detection_key(layout=layout)
+            cached = cache.get(image_sha256, fingerprint)
+        
+        if cached is None:
+            count('cache_misses')
+            # Process the sheet
+            with span('find_corners'):
+                corners = find_sheet_corners(image)
+            with span('sample_bubbles'):
+                fill_ratios = sample_fill_ratios(image, corners, layout=layout)
+            cache.put(image_sha256, fingerprint, corners, select_options(fill_ratios), fill_ratios)
+        else:
+            count('cache_hits')
+            corners, fill_ratios = cached.corners, cached.fill_ratios
+        
+        # The full-resolution warp is only needed for the annotated image
+        with span('warp'):
+            warped_image = warp_perspective(image, corners)
+        set_counter('warped_height', warped_image.shape[0])
+        set_counter('warped_width', warped_image.shape[1])
+        
+        # Detect answers
+        options = select_options(fill_ratios)
+        detected_answers = [(i + 1, int(option)) for i, option in enumerate(options)]
+        
+        # Grade
+        with span('grade'):
+            sheet_grade = grade_sheet(options, marking_scheme, answer_confidence(fill_ratios))
+        # Scores in sheet question order; questions missing from the marking scheme score nothing
+        sheet_scores = np.zeros(len(options))
+        on_sheet = (sheet_grade.question_ids >= 1) & (sheet_grade.question_ids <= len(options))
+        sheet_scores[sheet_grade.question_ids[on_sheet] - 1] = sheet_grade.scores[on_sheet]
+        
+        # Annotate image
+        with span('annotate'):
+            annotated_image = annotate_image(warped_image, detected_answers, sheet_scores, layout)
+            name = f"{image_sha256}_{marking_scheme.fingerprint()[:16]}_{layout.fingerprint()[:8]}"
+            annotated_path = save_annotated_image(annotated_image, image_dir, name)
+        
+        # Only compact arrays are kept; tables and images are rebuilt when displayed
+        return {
+            'file_name': file_name,
+            'total_marks': sheet_grade.total_marks,
+            'question_ids': sheet_grade.question_ids,
+            'options': options.astype(np.int8),
+            'scores': sheet_grade.scores,
+            'confidence': sheet_grade.confidence,
+            'annotated_path': annotated_path,
+            'success': True,
+            'error': None
+        }
+    except Exception as e:
+        count('failed')
+        return {
+            'file_name': file_name,
+            'success': False,
+            'error': str(e)
+        }
+
+# pandas is imported by the display and download helpers only, so grading workers start without it
+
+def detected_answers_table(result):
+    import pandas as pd
+    return pd.DataFrame({'Question': np.arange(1, len(result['options']) + 1), 'Answer': result['options']})
+
+def results_table(result):
+    import pandas as pd
+    scores = result['scores']
+    return pd.DataFrame({'Question': result['question_ids'], 'Correct': scores == 1, 'Score': scores,
+                         'Confidence': result['confidence']})
+
+def item_analysis_table(item_report):
+    import pandas as pd
+    return pd.DataFrame(item_report.rows(), columns=item_report.columns)
+
+def make_thumbnail(annotated_path, max_width=900):
+    """Display-resolution RGB copy of a spilled annotated sheet"""
+    image = cv2.imread(annotated_path)
+    height, width = image.shape[:2]
+    if width > max_width:
+        image = cv2.resize(image, (max_width, height * max_width // width), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def write_results_zip(results, file_obj, item_report=None):
+    """Stream the result CSVs, annotated PNGs, summary and item analysis (an ItemReport) into a ZIP file object"""
+    import pandas as pd
+    with zipfile.ZipFile(file_obj, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for result in results:
+            if result['success']:
+                zip_file.writestr(f"{result['file_name']}_graded.csv", results_table(result).to_csv(index=False))
+                # The PNGs are already compressed, so store them as they are
+                zip_file.write(result['annotated_path'], f"{result['file_name']}_annotated.png",
+                               compress_type=zipfile.ZIP_STORED)
+
+        summary_df = pd.DataFrame([{'file_name': r['file_name'], 'total_marks': r['total_marks']}
+                                   for r in results if r['success']])
+        zip_file.writestr('Summary.csv', summary_df.to_csv(index=False))
+        if item_report is not None and item_report.sheets:
+            zip_file.writestr(ITEM_ANALYSIS_FILE_NAME, item_analysis_table(item_report).to_csv(index=False))
@@ -0,0 +1,252 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from grade_core import (
+    load_image, find_sheet_corners, warp_perspective, extract_question_boxes, detect_colored_bubble,
+    compute_fill_ratios, sample_fill_ratios, select_options, load_marking_scheme, PYRAMID_FACTORS
+)
+from grade_mcq import detected_answers_frame, grade, save_results, list_answer_sheets
+from instrumentation import profile_sheet, peak_rss_bytes
+from sheet_buffers import SheetBuffers
+
+############################################################################
+
+###### Stage-level benchmark with an accuracy regression gate ######
+
+# Every sheet of the bundled dataset is run through the grading stages one
+# at a time, timing each stage separately. The per-question Correct column
+# is compared against the reference CSVs in Graded/, and the report is saved
+# as JSON so two commits can be compared with --baseline.
+
+############################################################################
+
+STAGES = ['load_image', 'find_sheet_corners', 'sample_bubbles', 'warp_perspective', 'detect_bubbles', 'grade',
+          'save_results']
+PAPERS = ['A', 'B', 'C']
+
+
+def paper_paths(dataset, reference, paper):
+    """Marking scheme, answer sheet folder and reference folder of one paper"""
+    return (os.path.join(dataset, "Marking Schemes", "Marking Schemes", f"{paper}.csv"),
+            os.path.join(dataset, "Answer Scripts", "Answer Scripts", paper),
+            os.path.join(reference, paper))
+
+def detect_bubbles_reference(warped_image):
+    """The original per-box detector, for comparing against compute_fill_ratios"""
+    return np.array([detect_colored_bubble(box) for box in extract_question_boxes(warped_image)])
+
+def time_sheet(image_path, marking_scheme, output_folder, reduction=1, detector='sparse', buffers=None):
+    """Run one sheet through every stage, returning the stage timings (seconds) and graded results"""
+    timings = {}
+
+    def timed(stage, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        timings[stage] = time.perf_counter() - started
+        return result
+
+    image = timed('load_image', load_image, image_path)
+    corners = timed('find_sheet_corners', find_sheet_corners, image, reduction, None, buffers)
+    if detector == 'sparse':
+        options = timed('sample_bubbles', lambda: select_options(sample_fill_ratios(image, corners,
+                                                                                    buffers=buffers)))
+    else:
+        warped_image = timed('warp_perspective', warp_perspective, image, corners, buffers)
+        if detector == 'reference':
+            options = timed('detect_bubbles', detect_bubbles_reference, warped_image)
+        else:
+            options = timed('detect_bubbles', lambda: select_options(compute_fill_ratios(warped_image)))
+    detected_answers_df = detected_answers_frame(options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        results_df = timed('grade', grade, detected_answers_df, marking_scheme)
+    output_file = os.path.join(output_folder, f"{os.path.splitext(os.path.basename(image_path))[0]}_graded.csv")
+    timed('save_results', save_results, results_df, output_file)
+    return timings, results_df
+
+def compare_with_reference(results_df, reference_file):
+    """Question numbers whose Correct value differs from the reference CSV"""
+    reference_df = pd.read_csv(reference_file)
+    merged = reference_df.merge(results_df, on='Question', how='left', suffixes=('_reference', ''))
+    differs = merged['Correct'].isna() | (merged['Correct'] != merged['Correct_reference'])
+    return merged.loc[differs, 'Question'].tolist(), len(reference_df)
+
+def summarize_timings(samples):
+    samples = np.array(samples) * 1000
+    return {'mean_ms': round(float(samples.mean()), 3),
+            'p50_ms': round(float(np.percentile(samples, 50)), 3),
+            'p90_ms': round(float(np.percentile(samples, 90)), 3),
+            'p99_ms': round(float(np.percentile(samples, 99)), 3),
+            'total_s': round(float(samples.sum() / 1000), 4)}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(dataset="Data Set", reference="Graded", papers=PAPERS, repeat=3, warmup=1,
+                  reduction=1, detector='sparse'):
+    stage_samples = {stage: [] for stage in STAGES}
+    sheet_times = []
+    mismatches, errors = [], []
+    compared = 0
+    # Questions detected and escalated to the second detection tier, counted in the last round of each sheet
+    escalation = {'detected_questions': 0, 'escalated_questions': 0, 'adaptive_decisions': 0}
+    # Scratch arrays reused across sheets, like a grading worker's
+    buffers = SheetBuffers()
+
+    with tempfile.TemporaryDirectory() as output_folder:
+        for paper in papers:
+            marking_scheme_path, answer_sheet_folder, reference_folder = paper_paths(dataset, reference, paper)
+            marking_scheme = load_marking_scheme(marking_scheme_path)
+            for image_file in list_answer_sheets(answer_sheet_folder):
+                image_path = os.path.join(answer_sheet_folder, image_file)
+                reference_file = os.path.join(reference_folder, f"{os.path.splitext(image_file)[0]}_graded.csv")
+                results_df = None
+                for round_index in range(warmup + repeat):
+                    try:
+                        with profile_sheet(image_file) as profile:
+                            timings, results_df = time_sheet(image_path, marking_scheme, output_folder,
+                                                             reduction, detector, buffers)
+                    except (ValueError, cv2.error) as e:
+                        errors.append({'paper': paper, 'image': image_file, 'error': str(e)})
+                        break
+                    if round_index < warmup:
+                        continue
+                    for stage, elapsed in timings.items():
+                        stage_samples[stage].append(elapsed)
+                    sheet_times.append(sum(timings.values()))
+
+                # Detection is deterministic, so checking the last round is enough
+                if results_df is not None:
+                    for counter in escalation:
+                        escalation[counter] += profile.counters.get(counter, 0)
+                if os.path.exists(reference_file):
+                    if results_df is None:
+                        # A sheet that failed to grade disagrees on every question
+                        differing = pd.read_csv(reference_file)['Question'].tolist()
+                        num_questions = len(differing)
+                    else:
+                        differing, num_questions = compare_with_reference(results_df, reference_file)
+                    compared += num_questions
+                    mismatches.extend({'paper': paper, 'image': image_file, 'question': int(q)} for q in differing)
+
+    timed_sheets = len(sheet_times)
+    peak_rss = peak_rss_bytes()
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'config': {'papers': list(papers), 'repeat': repeat, 'warmup': warmup, 'reduction': reduction,
+                   'detector': detector},
+        'sheets': timed_sheets,
+        'throughput_sheets_per_s': round(timed_sheets / sum(sheet_times), 3) if sheet_times else 0.0,
+        'sheet': summarize_timings(sheet_times) if sheet_times else None,
+        'stages': {stage: summarize_timings(samples) for stage, samples in stage_samples.items() if samples},
+        'memory': {'peak_rss_mb': round(peak_rss / 2 ** 20, 1) if peak_rss is not None else None,
+                   'buffers_mb': round(buffers.nbytes / 2 ** 20, 1)},
+        'accuracy': {'compared_questions': compared,
+                     'mismatches': len(mismatches),
+                     'accuracy': round(1 - len(mismatches) / compared, 6) if compared else None},
+        'escalation': dict(escalation, share=round(escalation['escalated_questions']
+                                                   / escalation['detected_questions'], 6)
+                           if escalation['detected_questions'] else None),
+        'mismatched_questions': mismatches,
+        'errors': errors,
+    }
+
+def compare_reports(report, baseline, fail_if_slower=None):
+    """Print the change against a baseline report, returning the regressions found"""
+    regressions = []
+    old, new = baseline['throughput_sheets_per_s'], report['throughput_sheets_per_s']
+    change = (new - old) / old if old else 0.0
+    print(f"Throughput: {old} -> {new} sheets/s ({change:+.1%}) vs {baseline.get('commit') or 'baseline'}")
+    for stage, stats in report['stages'].items():
+        if stage in baseline['stages']:
+            old_p50 = baseline['stages'][stage]['p50_ms']
+            print(f"  {stage:<20} p50 {old_p50:>9.3f} -> {stats['p50_ms']:>9.3f} ms")
+    old_rss, new_rss = baseline.get('memory', {}).get('peak_rss_mb'), report['memory']['peak_rss_mb']
+    if old_rss and new_rss:
+        print(f"Peak RSS: {old_rss} -> {new_rss} MB")
+    if fail_if_slower is not None and new < old * (1 - fail_if_slower):
+        regressions.append(f"throughput dropped {-change:.1%}, more than the allowed {fail_if_slower:.1%}")
+    if report['accuracy']['mismatches'] > baseline['accuracy']['mismatches']:
+        regressions.append(f"{report['accuracy']['mismatches']} mismatched questions, "
+                           f"baseline had {baseline['accuracy']['mismatches']}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the grading stages on the bundled dataset")
+    parser.add_argument("--dataset", default="Data Set", help="Dataset folder (default: 'Data Set')")
+    parser.add_argument("--reference", default="Graded", help="Reference results folder (default: Graded)")
+    parser.add_argument("--papers", nargs="+", default=PAPERS, help="Papers to run (default: A B C)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed rounds per sheet (default: 3)")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed rounds per sheet (default: 1)")
+    parser.add_argument("--pyramid", type=int, choices=PYRAMID_FACTORS, default=1,
+                        help="Locate sheets on an image downscaled by this factor")
+    parser.add_argument("--detector", choices=['sparse', 'dense', 'reference'], default='sparse',
+                        help="sparse: sample_fill_ratios (what grading uses); dense: warp_perspective + "
+                             "compute_fill_ratios; reference: warp_perspective + extract_question_boxes/"
+                             "detect_colored_bubble (default: sparse)")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--fail-if-slower", type=float, metavar="FRACTION",
+                        help="Exit with an error if throughput is this fraction below the baseline (e.g. 0.1)")
+    parser.add_argument("--min-accuracy", type=float, default=1.0,
+                        help="Exit with an error if agreement with the reference is below this (default: 1.0)")
+    args = parser.parse_args()
+    if args.fail_if_slower is not None and not args.baseline:
+        parser.error("--fail-if-slower needs --baseline")
+
+    report = run_benchmark(args.dataset, args.reference, args.papers, args.repeat, args.warmup,
+                           args.pyramid, args.detector)
+    print(f"{report['sheets']} timed sheet runs, {report['throughput_sheets_per_s']} sheets/s")
+    for stage, stats in report['stages'].items():
+        print(f"  {stage:<20} p50 {stats['p50_ms']:>9.3f} ms  p90 {stats['p90_ms']:>9.3f} ms  "
+              f"p99 {stats['p99_ms']:>9.3f} ms")
+    memory = report['memory']
+    if memory['peak_rss_mb'] is not None:
+        print(f"Peak RSS: {memory['peak_rss_mb']} MB ({memory['buffers_mb']} MB of reused scratch buffers)")
+    accuracy = report['accuracy']
+    print(f"Accuracy: {accuracy['accuracy']} ({accuracy['mismatches']} of "
+          f"{accuracy['compared_questions']} questions differ from {args.reference})")
+    escalation = report['escalation']
+    if escalation['share'] is not None:
+        print(f"Escalated: {escalation['share']:.1%} of questions ({escalation['escalated_questions']} of "
+              f"{escalation['detected_questions']}, {escalation['adaptive_decisions']} decided by the adaptive "
+              "threshold)")
+    for mismatch in report['mismatched_questions']:
+        print(f"  {mismatch['paper']}/{mismatch['image']} question {mismatch['question']}")
+    for error in report['errors']:
+        print(f"  {error['paper']}/{error['image']} failed: {error['error']}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Report saved to {args.output}")
+
+    failures = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            failures.extend(compare_reports(report, json.load(file), args.fail_if_slower))
+    if accuracy['accuracy'] is not None and accuracy['accuracy'] < args.min_accuracy:
+        failures.append(f"accuracy {accuracy['accuracy']} is below {args.min_accuracy}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
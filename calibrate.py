@@ -0,0 +1,351 @@
+import argparse
+import csv
+import os
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import product
+
+import cv2
+import numpy as np
+
+from grade_core import (
+    decode_image, find_sheet_corners, grade_sheet, load_image, load_marking_scheme, sample_sheet,
+    sampled_fill_ratios, select_options, top_two_fill_ratios
+)
+from scanner_profile import DEFAULT_PROFILE, PARAMETERS, save_profile
+from sheet_layout import DEFAULT_LAYOUT, load_layout
+from sheet_sources import IMAGE_EXTENSIONS
+from synthetic_sheets import Distortion, render_sheet, sheet_name
+
+############################################################################
+
+###### Calibrating scanner profiles against ground truth ######
+
+# Detection is a small DAG of stages: the decoded scan, the sheet corners
+# (blur, Canny and approxPolyDP parameters), the sampled upright sheet and
+# the fill ratios (ink threshold). Each stage result is memoized under a key
+# built from the parameters of that stage and of every stage upstream of it,
+# so a search that only changes the ink threshold never finds the corners
+# again, and one that changes the Canny thresholds re-uses the decoded scan.
+# Profiles are evaluated in parameter order, one sheet per task across the
+# worker processes, which keeps each worker's memo small. A profile scores
+# the share of questions detected right: against the Correct column of the
+# reference CSVs in Graded/ for the bundled scans, or against the true
+# answers of synthetic sheets rendered in memory. Ties go to the profile
+# with the safest closest call: the largest smallest lead of a detected
+# bubble over the next fullest, across every question of every sheet.
+
+############################################################################
+
+# Values tried by a grid search, around the defaults
+GRID = {
+    'blur_kernel': (3, 5, 7),
+    'canny_low': (30, 50, 80),
+    'canny_high': (120, 150, 200),
+    'poly_epsilon': (0.01, 0.02, 0.03),
+    'dark_threshold': (120, 135, 150, 165, 180),
+}
+# (lowest, highest) of each parameter for a random search; float bounds give float values
+RANGES = {
+    'blur_kernel': (1, 11),
+    'canny_low': (10, 120),
+    'canny_high': (60, 250),
+    'poly_epsilon': (0.005, 0.05),
+    'dark_threshold': (90, 210),
+}
+# Stage results kept by each worker; a decoded ~3000x2000 scan takes ~18 MB
+MEMO_MAX_BYTES = 512 * 2 ** 20
+PAPERS = ['A', 'B', 'C']
+
+
+class Stage:
+    """One detection step, function(sheet, scanner, *inputs), depending on the scanner parameters in params"""
+    __slots__ = ('name', 'function', 'params', 'inputs')
+
+    def __init__(self, name, function, params=(), inputs=()):
+        self.name = name
+        self.function = function
+        self.params = params
+        self.inputs = inputs
+
+def _decode_stage(sheet, scanner):
+    return sheet.load()
+
+def _corners_stage(sheet, scanner, image):
+    return find_sheet_corners(image, scanner=scanner)
+
+def _sample_stage(sheet, scanner, image, corners):
+    return sample_sheet(image, corners)
+
+def _fill_ratios_stage(sheet, scanner, image, sample):
+    return sampled_fill_ratios(image, sample, sheet.layout, scanner=scanner)
+
+STAGES = (
+    Stage('image', _decode_stage),
+    Stage('corners', _corners_stage, ('blur_kernel', 'canny_low', 'canny_high', 'poly_epsilon'), ('image',)),
+    Stage('sample', _sample_stage, (), ('image', 'corners')),
+    Stage('fill_ratios', _fill_ratios_stage, ('dark_threshold',), ('image', 'sample')),
+)
+
+class StageGraph:
+    """Memoized evaluation of the stages, keyed by the sheet and the upstream scanner parameters"""
+    __slots__ = ('stages', 'max_bytes', 'computed', '_memo', '_bytes')
+
+    def __init__(self, stages=STAGES, max_bytes=MEMO_MAX_BYTES):
+        self.stages = {stage.name: stage for stage in stages}
+        self.max_bytes = max_bytes
+        self.computed = Counter()
+        self._memo = OrderedDict()
+        self._bytes = 0
+
+    def key(self, name, sheet, scanner):
+        stage = self.stages[name]
+        return ((name, sheet.name, tuple(getattr(scanner, param) for param in stage.params))
+                + tuple(self.key(upstream, sheet, scanner) for upstream in stage.inputs))
+
+    def evaluate(self, name, sheet, scanner):
+        """The stage's result for a sheet and ScannerProfile, raising the stage's (memoized) error if it failed"""
+        key = self.key(name, sheet, scanner)
+        if key in self._memo:
+            self._memo.move_to_end(key)
+            value = self._memo[key]
+        else:
+            stage = self.stages[name]
+            try:
+                value = stage.function(sheet, scanner, *(self.evaluate(upstream, sheet, scanner)
+                                                         for upstream in stage.inputs))
+            except (ValueError, cv2.error) as e:
+                # Failures are remembered too, so a profile that loses the sheet is not retried downstream
+                value = e
+            self.computed[name] += 1
+            self._remember(key, value)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def _remember(self, key, value):
+        self._memo[key] = value
+        self._bytes += getattr(value, 'nbytes', 0)
+        # The newest result always stays, however large
+        while self._bytes > self.max_bytes and len(self._memo) > 1:
+            _, evicted = self._memo.popitem(last=False)
+            self._bytes -= getattr(evicted, 'nbytes', 0)
+
+class ReferenceSheet:
+    """A scan with the reference Correct column of its questions (Graded/<paper>/<image>_graded.csv)"""
+    __slots__ = ('name', 'image_path', 'marking_scheme', 'question_ids', 'correct', 'layout')
+
+    def __init__(self, name, image_path, marking_scheme, question_ids, correct, layout=DEFAULT_LAYOUT):
+        self.name = name
+        self.image_path = image_path
+        self.marking_scheme = marking_scheme
+        self.question_ids = question_ids
+        self.correct = correct
+        self.layout = layout
+
+    def load(self):
+        image = load_image(self.image_path)
+        if image is None:
+            raise ValueError(f"Could not read {self.image_path}")
+        return image
+
+    def score(self, options):
+        """Questions whose Correct value matches the reference, and the questions compared"""
+        if options is None:
+            return 0, len(self.correct)
+        sheet_grade = grade_sheet(options, self.marking_scheme)
+        graded = dict(zip(sheet_grade.question_ids.tolist(), (sheet_grade.scores == 1).tolist()))
+        matching = sum(graded.get(question) == correct for question, correct in zip(self.question_ids, self.correct))
+        return matching, len(self.correct)
+
+class SyntheticSheet:
+    """Sheet index of a seeded synthetic_sheets run, whose true answers are known once it is rendered"""
+    __slots__ = ('name', 'index', 'seed', 'scale', 'distortion', 'layout', 'answers')
+
+    def __init__(self, index, seed=0, scale=1.0, distortion=None, layout=DEFAULT_LAYOUT):
+        self.name = sheet_name(index)
+        self.index = index
+        self.seed = seed
+        self.scale = scale
+        self.distortion = distortion
+        self.layout = layout
+        self.answers = None
+
+    def load(self):
+        image_bytes, self.answers = render_sheet(self.index, self.seed, self.scale, self.distortion, self.layout)
+        return decode_image(image_bytes)
+
+    def score(self, options):
+        if options is None:
+            return 0, self.layout.questions
+        return int(np.sum(options == self.answers)), len(self.answers)
+
+def reference_sheets(dataset="Data Set", reference="Graded", papers=PAPERS, layout=DEFAULT_LAYOUT):
+    """ReferenceSheets of every scan with a reference CSV, in the folder layout benchmark.py reads"""
+    sheets = []
+    for paper in papers:
+        marking_scheme = load_marking_scheme(os.path.join(dataset, "Marking Schemes", "Marking Schemes",
+                                                          f"{paper}.csv"))
+        answer_sheet_folder = os.path.join(dataset, "Answer Scripts", "Answer Scripts", paper)
+        for image_file in sorted(f for f in os.listdir(answer_sheet_folder) if f.endswith(IMAGE_EXTENSIONS)):
+            reference_file = os.path.join(reference, paper, f"{os.path.splitext(image_file)[0]}_graded.csv")
+            if not os.path.exists(reference_file):
+                continue
+            with open(reference_file, newline='') as file:
+                rows = list(csv.DictReader(file))
+            sheets.append(ReferenceSheet(f"{paper}/{image_file}", os.path.join(answer_sheet_folder, image_file),
+                                         marking_scheme, [int(row['Question']) for row in rows],
+                                         [row['Correct'] == 'True' for row in rows], layout))
+    return sheets
+
+def grid_profiles(grid=GRID, base=DEFAULT_PROFILE):
+    """Every valid combination of the grid's values (e.g. canny_low below canny_high)"""
+    names = list(grid)
+    profiles = []
+    for values in product(*(grid[name] for name in names)):
+        try:
+            profiles.append(base.replace(**dict(zip(names, values))))
+        except ValueError:
+            continue
+    return profiles
+
+def random_profiles(trials, ranges=RANGES, seed=0, base=DEFAULT_PROFILE):
+    """trials valid profiles drawn uniformly from the ranges"""
+    rng = np.random.default_rng(seed)
+    profiles = []
+    for _ in range(100 * trials):
+        if len(profiles) == trials:
+            break
+        params = {}
+        for name, (low, high) in ranges.items():
+            if isinstance(low, float) or isinstance(high, float):
+                params[name] = round(float(rng.uniform(low, high)), 4)
+            else:
+                params[name] = int(rng.integers(low, high + 1))
+        if 'blur_kernel' in params:
+            params['blur_kernel'] |= 1
+        try:
+            profiles.append(base.replace(**params))
+        except ValueError:
+            continue
+    return profiles
+
+def score_sheet(sheet, scanners, max_bytes=MEMO_MAX_BYTES):
+    """Per scanner profile, the questions right, the questions and whether the sheet failed, and the smallest
+    lead of a fullest bubble (inf when failed); and the number of times each stage ran"""
+    graph = StageGraph(max_bytes=max_bytes)
+    scores = np.zeros((len(scanners), 3))
+    closest = np.full(len(scanners), np.inf)
+    for index, scanner in enumerate(scanners):
+        try:
+            fill_ratios = graph.evaluate('fill_ratios', sheet, scanner)
+        except (ValueError, cv2.error):
+            scores[index] = sheet.score(None) + (1,)
+            continue
+        top, second = top_two_fill_ratios(fill_ratios)
+        scores[index] = sheet.score(select_options(fill_ratios)) + (0,)
+        closest[index] = np.min(top - second)
+    return scores, closest, graph.computed
+
+def calibrate(sheets, profiles, workers=1):
+    """Results of every profile, best first, and how often each stage ran.
+
+    A result is a dict of the profile, its question accuracy, the sheets it failed to locate and its closest
+    call: the smallest lead of a fullest bubble over the next.
+    """
+    # Neighbouring profiles share their upstream parameters, so their stage results are still in the memo
+    profiles = sorted(dict.fromkeys(profiles), key=lambda profile: tuple(profile.params()[p] for p in PARAMETERS))
+    totals = np.zeros((len(profiles), 3))
+    closest = np.full(len(profiles), np.inf)
+    stage_runs = Counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for scores, sheet_closest, computed in executor.map(partial(score_sheet, scanners=profiles), sheets):
+            totals += scores
+            np.minimum(closest, sheet_closest, out=closest)
+            stage_runs.update(computed)
+    right, questions, failed = totals.T
+    accuracy = right / np.maximum(questions, 1)
+    # Profiles that located no sheet at all have no closest call
+    closest[np.isinf(closest)] = 0
+    order = np.lexsort((-closest, failed, -accuracy))
+    return [{'profile': profiles[i], 'accuracy': float(accuracy[i]), 'failed': int(failed[i]),
+             'closest': float(closest[i])} for i in order], stage_runs
+
+def parse_values(specs):
+    """Grid values given as NAME=V1,V2,... on the command line"""
+    grid = dict(GRID)
+    for spec in specs or []:
+        name, _, values = spec.partition('=')
+        if name not in GRID or not values:
+            raise ValueError(f"--values takes NAME=V1,V2,... with NAME one of {', '.join(PARAMETERS)}, not {spec!r}")
+        cast = float if isinstance(GRID[name][0], float) else int
+        try:
+            grid[name] = tuple(cast(value) for value in values.split(','))
+        except ValueError:
+            raise ValueError(f"--values {name} must be {cast.__name__}s, not {values!r}")
+    return grid
+
+def format_result(result):
+    params = ' '.join(f"{name}={value}" for name, value in result['profile'].params().items())
+    return (f"accuracy {result['accuracy']:.4f}  failed {result['failed']}  closest call {result['closest']:.4f}  "
+            f"{params}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="grade_mcq calibrate",
+                                     description="Search for the scanner profile that detects a scanner's sheets "
+                                                 "best, and save it for --scanner-profile")
+    parser.add_argument("--scanner", required=True,
+                        help="Name of the scanner; the best profile is saved as scanner_profiles/<name>.json")
+    parser.add_argument("--output", metavar="PATH", help="Save the best profile here instead")
+    parser.add_argument("--dataset", default="Data Set", help="Folder with the scans and marking schemes")
+    parser.add_argument("--reference", default="Graded", help="Folder with the reference CSVs of the scans")
+    parser.add_argument("--papers", nargs="+", default=PAPERS, help="Papers to calibrate on (default: A B C)")
+    parser.add_argument("--synthetic", type=int, metavar="N",
+                        help="Calibrate on N synthetic sheets rendered in memory instead of the scans")
+    parser.add_argument("--scale", type=float, default=1.0, help="Size of the synthetic sheets (default: 1.0)")
+    parser.add_argument("--search", choices=["grid", "random"], default="grid",
+                        help="Try every combination of the grid values, or --trials random profiles")
+    parser.add_argument("--values", action="append", metavar="NAME=V1,V2",
+                        help="Grid values of one parameter, e.g. dark_threshold=140,150,160 (repeatable)")
+    parser.add_argument("--trials", type=int, default=200, help="Profiles tried by a random search (default: 200)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic sheets and the random search")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes (default: number of CPU cores)")
+    parser.add_argument("--layout", metavar="NAME_OR_PATH",
+                        help=f"Sheet layout, a file or a name in sheet_layouts/ (default: {DEFAULT_LAYOUT.name})")
+    parser.add_argument("--top", type=int, default=10, help="Profiles to list (default: 10)")
+    args = parser.parse_args(argv)
+    try:
+        layout = load_layout(args.layout)
+        grid = parse_values(args.values)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.synthetic:
+        sheets = [SyntheticSheet(index, args.seed, args.scale, Distortion(), layout) for index in range(args.synthetic)]
+    else:
+        sheets = reference_sheets(args.dataset, args.reference, args.papers, layout)
+    if not sheets:
+        parser.error("No sheets to calibrate on")
+    profiles = grid_profiles(grid) if args.search == "grid" else random_profiles(args.trials, seed=args.seed)
+    # The current default is always a candidate, so calibrating never makes detection worse
+    profiles.append(DEFAULT_PROFILE)
+
+    started = time.perf_counter()
+    results, stage_runs = calibrate(sheets, profiles, args.workers)
+    elapsed = time.perf_counter() - started
+    print(f"Tried {len(results)} profiles on {len(sheets)} sheets in {elapsed:.1f}s; stage runs "
+          + ", ".join(f"{stage.name} {stage_runs[stage.name]}" for stage in STAGES)
+          + f" (each would run {len(results) * len(sheets)} times without the memo)")
+    for rank, result in enumerate(results[:args.top], start=1):
+        print(f"{rank:3d}. {format_result(result)}")
+    default = next(result for result in results if result['profile'] == DEFAULT_PROFILE)
+    print(f"default: {format_result(default)}")
+
+    best = results[0]['profile'].replace(name=args.scanner)
+    print(f"Best profile saved to {save_profile(best, args.output)}")
+
+if __name__ == "__main__":
+    main()
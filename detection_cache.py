@@ -0,0 +1,166 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+############################################################################
+
+###### On-disk cache of sheet detections ######
+
+# Entries are keyed by the SHA-256 of the image bytes plus a fingerprint of
+# the detection pipeline version and parameters, and hold the sheet corners,
+# the detected options, the (questions, options) fill ratios and, when
+# duplicate detection asked for it, the sheet's perceptual hash. Re-grading
+# against a corrected marking scheme then only needs grade().
+
+############################################################################
+
+CACHE_FILE_NAME = "detection_cache.sqlite"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Eviction scans the whole table, so only run it every few writes
+EVICT_EVERY = 32
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS detections (
+    image_sha256 TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    corners BLOB NOT NULL,
+    options BLOB NOT NULL,
+    fill_ratios BLOB NOT NULL,
+    num_questions INTEGER NOT NULL,
+    num_options INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    sheet_hash BLOB,
+    PRIMARY KEY (image_sha256, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS detections_last_used ON detections (last_used);
+"""
+
+
+def hash_image_bytes(file_bytes):
+    return hashlib.sha256(file_bytes).hexdigest()
+
+class CachedDetection:
+    __slots__ = ('corners', 'options', 'fill_ratios', 'sheet_hash')
+
+    def __init__(self, corners, options, fill_ratios, sheet_hash=None):
+        self.corners = corners
+        self.options = options
+        self.fill_ratios = fill_ratios
+        self.sheet_hash = sheet_hash
+
+class DetectionCache:
+    """SQLite store of detection results with size-based LRU eviction, safe to share between threads.
+    With max_bytes=None nothing is evicted, which is how the inspection commands open it."""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_SCHEMA)
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(detections)")]
+        if 'sheet_hash' not in columns:
+            # Caches written before duplicate detection existed
+            with self._connection:
+                self._connection.execute("ALTER TABLE detections ADD COLUMN sheet_hash BLOB")
+
+    def get(self, image_sha256, fingerprint):
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT corners, options, fill_ratios, num_questions, num_options, sheet_hash FROM detections "
+                "WHERE image_sha256 = ? AND fingerprint = ?", (image_sha256, fingerprint)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE detections SET last_used = ? WHERE image_sha256 = ? AND fingerprint = ?",
+                (time.time(), image_sha256, fingerprint))
+        corners, options, fill_ratios, num_questions, num_options, sheet_hash = row
+        return CachedDetection(np.frombuffer(corners, dtype=np.float32).reshape(4, 2),
+                               np.frombuffer(options, dtype=np.int8).astype(np.int64),
+                               np.frombuffer(fill_ratios, dtype=np.float64).reshape(num_questions, num_options),
+                               sheet_hash)
+
+    def put(self, image_sha256, fingerprint, corners, options, fill_ratios, sheet_hash=None):
+        corners = np.asarray(corners, dtype=np.float32).tobytes()
+        options = np.asarray(options, dtype=np.int8).tobytes()
+        fill_ratios = np.asarray(fill_ratios, dtype=np.float64)
+        num_questions, num_options = fill_ratios.shape
+        fill_ratios = fill_ratios.tobytes()
+        size = len(corners) + len(options) + len(fill_ratios) + len(sheet_hash or b"")
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO detections (image_sha256, fingerprint, corners, options, fill_ratios, "
+                "num_questions, num_options, size, last_used, sheet_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (image_sha256, fingerprint, corners, options, fill_ratios,
+                 num_questions, num_options, size, time.time(), sheet_hash))
+            self._writes_since_evict += 1
+            if self._writes_since_evict >= EVICT_EVERY:
+                self._evict()
+
+    def _evict(self):
+        # Keep the most recently used entries that fit within max_bytes
+        self._writes_since_evict = 0
+        if self.max_bytes is None:
+            return
+        self._connection.execute(
+            "DELETE FROM detections WHERE rowid IN ("
+            " SELECT rowid FROM (SELECT rowid, SUM(size) OVER (ORDER BY last_used DESC) AS running"
+            " FROM detections) WHERE running > ?)", (self.max_bytes,))
+
+    def invalidate(self, image_sha256=None, keep_fingerprint=None):
+        """Drop entries for one image (or all images), optionally keeping those for the current pipeline"""
+        query, params = "DELETE FROM detections WHERE 1", []
+        if image_sha256 is not None:
+            query += " AND image_sha256 = ?"
+            params.append(image_sha256)
+        if keep_fingerprint is not None:
+            query += " AND fingerprint != ?"
+            params.append(keep_fingerprint)
+        with self._lock, self._connection:
+            return self._connection.execute(query, params).rowcount
+
+    def stats(self):
+        with self._lock:
+            entries, total_bytes = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM detections").fetchone()
+        return {'entries': entries, 'bytes': total_bytes, 'max_bytes': self.max_bytes}
+
+    def close(self):
+        with self._lock, self._connection:
+            self._evict()
+        self._connection.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the MCQ grader detection cache")
+    parser.add_argument("cache_path", help=f"Cache file, or an output folder containing {CACHE_FILE_NAME}")
+    parser.add_argument("command", choices=["stats", "invalidate"])
+    parser.add_argument("images", nargs="*", help="Only invalidate the entries for these image files")
+    args = parser.parse_args()
+
+    cache_path = args.cache_path
+    if os.path.isdir(cache_path):
+        cache_path = os.path.join(cache_path, CACHE_FILE_NAME)
+    # Inspecting the cache must not shrink it to the default size limit
+    cache = DetectionCache(cache_path, max_bytes=None)
+    if args.command == "stats":
+        print(cache.stats())
+    elif args.images:
+        for image_path in args.images:
+            with open(image_path, 'rb') as file:
+                removed = cache.invalidate(hash_image_bytes(file.read()))
+            print(f"Removed {removed} cached detection(s) for {image_path}")
+    else:
+        print(f"Removed {cache.invalidate()} cached detection(s)")
+    cache.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from multiprocessing.managers import BaseManager
+
+import cv2
+import numpy as np
+
+############################################################################
+
+###### Perceptual-hash index of answer sheets, for near-duplicate scans ######
+
+# A sheet's perceptual hash comes from a small grayscale thumbnail of the
+# upright sheet: the thumbnail is high-pass filtered, so paper tone and
+# lighting drop out and the printed grid and pen marks remain, and projected
+# onto HASH_BITS fixed random directions (SimHash). The signs of the
+# projections, taken against per-direction thresholds, are the hash bits; a
+# rescan or a copy of the same sheet lands a few bits away, while sheets of
+# different students differ in many bubbles and land far apart.
+#
+# Every sheet shares the same printed template, so against a zero threshold
+# most bits would come out alike for all sheets. The index therefore learns
+# its thresholds, the median projections of the first CALIBRATION_SHEETS
+# sheets it sees, which leaves each bit close to a coin flip across sheets.
+# Sheets are handed to it as their projections for that reason; until it has
+# seen enough of them, it compares them against the median of those so far.
+#
+# The index finds the closest hash within max_distance bits by multi-index
+# hashing: the hash is cut into BANDS 16-bit bands and, since two hashes
+# within max_distance bits must agree to within max_distance // BANDS bits in
+# at least one band, only entries whose band value is that close to the
+# query's are compared in full. Entries are kept sorted by (band, value),
+# with a table of where each of the BANDS * 2**16 keys starts, so finding
+# them is a few array lookups; recent additions sit in a small unsorted tail
+# that is compared directly until it is merged into the sorted entries.
+#
+# Grading checks each sheet as soon as its corners are found, so a skipped
+# rescan is never sampled. A DuplicateGate makes those checks happen in the
+# sheets' folder order whichever worker gets there first; pool workers share
+# one gate living in a manager process (serve_duplicate_gate).
+
+############################################################################
+
+INDEX_FILE_NAME = "duplicate_index.sqlite"
+# Bump when the thumbnail or projections change, so old hashes are never compared against new ones
+HASH_VERSION = 1
+HASH_BITS = 128
+THUMBNAIL_SIZE = (64, 32)
+BLUR_SIGMA = 5
+HASH_SEED = 20240501
+# Rescans of a sheet stay within about 20 bits of each other, different sheets are over 30 bits apart.
+# Below 24 bits each band is searched within 2 bits.
+DEFAULT_MAX_DISTANCE = 23
+# Even a few sheets give usable thresholds; with fewer than PROVISIONAL_SHEETS they are taken as zero
+CALIBRATION_SHEETS = 8
+PROVISIONAL_SHEETS = 4
+
+BANDS = 8
+# The unsorted tail is merged into the sorted entries once it holds this many entries plus 1/64 of the index
+MERGE_THRESHOLD = 1024
+BATCH_SIZE = 256
+
+_PROJECTIONS = np.random.default_rng(HASH_SEED).standard_normal(
+    (THUMBNAIL_SIZE[0] * THUMBNAIL_SIZE[1], HASH_BITS)).astype(np.float32)
+_POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheets (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    image_name TEXT NOT NULL,
+    hash BLOB NOT NULL,
+    added_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS calibration (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    image_name TEXT NOT NULL,
+    sheet_hash BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def sheet_hash(thumbnail):
+    """Perceptual hash of a THUMBNAIL_SIZE grayscale sheet thumbnail, as its HASH_BITS projections (float16 bytes)"""
+    thumbnail = thumbnail.astype(np.float32)
+    detail = thumbnail - cv2.GaussianBlur(thumbnail, (0, 0), BLUR_SIGMA)
+    return (detail.ravel() @ _PROJECTIONS).astype(np.float16).tobytes()
+
+def _projections(sheet_hashes):
+    return np.frombuffer(b"".join(sheet_hashes), dtype=np.float16).reshape(-1, HASH_BITS).astype(np.float32)
+
+def _popcount(words):
+    """Set bits of every element of a uint64 array"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return _POPCOUNT[words[..., None].view(np.uint8)].sum(axis=-1, dtype=np.uint8)
+
+@lru_cache(maxsize=None)
+def _band_neighbours(radius):
+    """Every 16-bit mask with at most radius bits set"""
+    masks = np.arange(2 ** 16, dtype=np.uint32)
+    bits = _POPCOUNT[masks & 0xFF] + _POPCOUNT[masks >> 8]
+    return masks[bits <= radius].astype(np.uint16)
+
+class DuplicateIndex:
+    """Sheet hashes searchable by Hamming distance, in memory or persisted to an SQLite file"""
+
+    def __init__(self, path=None, max_distance=DEFAULT_MAX_DISTANCE):
+        if not 0 <= max_distance < HASH_BITS:
+            raise ValueError(f"The duplicate distance must be between 0 and {HASH_BITS - 1} bits")
+        self.path = path
+        self.max_distance = max_distance
+        self.thresholds = None
+        self._calibration = []          # (image_name, sheet_hash) seen before the thresholds are known
+        self._names = []
+        self._entry_of = {}             # image name -> entry, -1 while calibrating
+        # Hash words stored column-major, one row per 64 bits, so each can be gathered contiguously
+        self._words = np.empty((HASH_BITS // 64, 0), dtype=np.uint64)
+        self._size = 0
+        self._sorted_size = 0
+        self._key_starts = self._sorted_entries = None
+        self._pending = []
+        self._connection = None
+        if path is not None:
+            self._open(path)
+
+    def _open(self, path):
+        # A DuplicateGate serves the index from whichever of its threads holds the lock
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+        meta = dict(self._connection.execute("SELECT key, value FROM meta"))
+        if 'hash_version' not in meta:
+            with self._connection:
+                self._connection.execute("INSERT INTO meta VALUES ('hash_version', ?)", (str(HASH_VERSION),))
+        elif int(meta['hash_version']) != HASH_VERSION:
+            self._connection.close()
+            raise ValueError(f"{path} holds hashes of another version; delete it to start a new index")
+        if 'thresholds' in meta:
+            self.thresholds = np.array(json.loads(meta['thresholds']), dtype=np.float32)
+        self._calibration = self._connection.execute(
+            "SELECT image_name, sheet_hash FROM calibration ORDER BY seq").fetchall()
+        self._entry_of.update((name, -1) for name, _ in self._calibration)
+        rows = self._connection.execute("SELECT image_name, hash FROM sheets ORDER BY seq").fetchall()
+        if rows:
+            codes = np.frombuffer(b"".join(code for _, code in rows), dtype=np.uint64).reshape(-1, HASH_BITS // 64)
+            self._append([name for name, _ in rows], codes)
+            self._merge()
+
+    def __len__(self):
+        return self._size + len(self._calibration)
+
+    def _binarize(self, projections, thresholds):
+        return np.packbits(projections > thresholds, axis=-1).view(np.uint64)
+
+    def _append(self, names, codes):
+        if self._size + len(codes) > self._words.shape[1]:
+            # Grow geometrically, so adding one sheet at a time stays amortized O(1)
+            grown = np.empty((HASH_BITS // 64, max(2 * self._words.shape[1], self._size + len(codes), 1024)),
+                             dtype=np.uint64)
+            grown[:, :self._size] = self._words[:, :self._size]
+            self._words = grown
+        self._words[:, self._size:self._size + len(codes)] = codes.T
+        self._size += len(codes)
+        self._entry_of.update(zip(names, range(self._size - len(codes), self._size)))
+        self._names.extend(names)
+
+    def _merge(self):
+        """Sort every entry into the (band, value) table"""
+        # Band b of a hash is 16-bit lane b of its words, as in code.view(np.uint16)
+        bands = np.concatenate([words[:self._size].view(np.uint16).reshape(self._size, 4)
+                                for words in self._words], axis=1)
+        order = np.argsort(bands, axis=0, kind='stable')
+        values = np.take_along_axis(bands, order, axis=0).T.astype(np.int64)
+        keys = values + (np.arange(BANDS)[:, None] << 16)
+        self._sorted_entries = np.ascontiguousarray(order.T, dtype=np.int32).ravel()
+        self._key_starts = np.concatenate([[0], np.cumsum(np.bincount(keys.ravel(), minlength=BANDS << 16))])
+        self._sorted_size = self._size
+
+    def _candidates(self, code):
+        """Entries that may lie within max_distance of the code (a superset of them)"""
+        candidates = [np.arange(self._sorted_size, self._size)]
+        if self._sorted_size:
+            values = code.view(np.uint16)[:, None] ^ _band_neighbours(self.max_distance // BANDS)
+            keys = (values.astype(np.int64) + (np.arange(BANDS)[:, None] << 16)).ravel()
+            starts = self._key_starts[keys]
+            counts = self._key_starts[keys + 1] - starts
+            total = counts.sum()
+            if total:
+                # Concatenated ranges [start, start + count) of every matching key
+                offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+                candidates.append(self._sorted_entries[offsets])
+        return np.concatenate(candidates)
+
+    def _distances(self, candidates, code):
+        distances = np.zeros(len(candidates), dtype=np.int32)
+        for words, word in zip(self._words, code):
+            distances += _popcount(np.take(words, candidates) ^ word)
+        return distances
+
+    def _nearest_calibrating(self, sheet_hash, exclude_name):
+        # Too few sheets for fixed thresholds yet, so compare them all against provisional ones
+        others = [(name, other) for name, other in self._calibration if name != exclude_name]
+        if not others:
+            return None
+        projections = _projections([other for _, other in others] + [sheet_hash])
+        thresholds = np.median(projections, axis=0) if len(projections) >= PROVISIONAL_SHEETS else 0
+        codes = self._binarize(projections, thresholds)
+        distances = _popcount(codes[:-1] ^ codes[-1]).sum(axis=1)
+        best = int(np.argmin(distances))
+        return others[best][0], int(distances[best])
+
+    def nearest(self, sheet_hash, exclude_name=None):
+        """(image_name, distance) of the closest indexed sheet within max_distance, or None"""
+        if self.thresholds is None:
+            match = self._nearest_calibrating(sheet_hash, exclude_name)
+            return match if match is not None and match[1] <= self.max_distance else None
+        code = self._binarize(_projections([sheet_hash])[0], self.thresholds)
+        candidates = self._candidates(code)
+        if exclude_name in self._entry_of:
+            candidates = candidates[candidates != self._entry_of[exclude_name]]
+        if len(candidates) == 0:
+            return None
+        distances = self._distances(candidates, code)
+        best = int(np.argmin(distances))
+        if distances[best] > self.max_distance:
+            return None
+        return self._names[candidates[best]], int(distances[best])
+
+    def add(self, image_name, sheet_hash):
+        if self.thresholds is None:
+            self._calibration.append((image_name, sheet_hash))
+            self._entry_of[image_name] = -1
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute("INSERT INTO calibration (image_name, sheet_hash) VALUES (?, ?)",
+                                             (image_name, sheet_hash))
+            if len(self._calibration) >= CALIBRATION_SHEETS:
+                self._calibrate()
+            return
+        code = self._binarize(_projections([sheet_hash])[0], self.thresholds)
+        self._append([image_name], code[None, :])
+        if self._size - self._sorted_size >= MERGE_THRESHOLD + self._sorted_size // 64:
+            self._merge()
+        if self._connection is not None:
+            self._pending.append((image_name, code.tobytes(), time.time()))
+            if len(self._pending) >= BATCH_SIZE:
+                self.flush()
+
+    def _calibrate(self):
+        """Fix the thresholds from the calibration sheets and index them"""
+        names = [name for name, _ in self._calibration]
+        projections = _projections([sheet_hash for _, sheet_hash in self._calibration])
+        self.thresholds = np.median(projections, axis=0).astype(np.float32)
+        codes = self._binarize(projections, self.thresholds)
+        self._calibration = []
+        self._append(names, codes)
+        self._merge()
+        if self._connection is not None:
+            with self._connection:
+                self._connection.execute("INSERT INTO meta VALUES ('thresholds', ?)",
+                                         (json.dumps(self.thresholds.tolist()),))
+                self._connection.executemany("INSERT INTO sheets (image_name, hash, added_at) VALUES (?, ?, ?)",
+                                             [(name, code.tobytes(), time.time()) for name, code in zip(names, codes)])
+                self._connection.execute("DELETE FROM calibration")
+
+    def check(self, image_name, sheet_hash):
+        """The (image_name, distance) this sheet duplicates, or None after indexing it as an original.
+
+        Entries under the sheet's own name are the same sheet graded before, not duplicates of it.
+        """
+        match = self.nearest(sheet_hash, exclude_name=image_name)
+        if match is None and image_name not in self._entry_of:
+            self.add(image_name, sheet_hash)
+        return match
+
+    def flush(self):
+        if self._pending:
+            with self._connection:
+                self._connection.executemany("INSERT INTO sheets (image_name, hash, added_at) VALUES (?, ?, ?)",
+                                             self._pending)
+            self._pending = []
+
+    def close(self):
+        if self._connection is not None:
+            self.flush()
+            self._connection.close()
+            self._connection = None
+
+def open_duplicate_index(index_path=None, max_distance=DEFAULT_MAX_DISTANCE):
+    """A persistent index when a path is given, otherwise one covering only the current run"""
+    if index_path and os.path.isdir(index_path):
+        index_path = os.path.join(index_path, INDEX_FILE_NAME)
+    return DuplicateIndex(index_path or None, max_distance)
+
+class DuplicateGate:
+    """Checks sheets against a DuplicateIndex strictly in the order of their positions, safe to share between
+    threads"""
+
+    def __init__(self, index_path=None, max_distance=DEFAULT_MAX_DISTANCE):
+        self._index = open_duplicate_index(index_path, max_distance)
+        self._condition = threading.Condition()
+        self._next = 0
+
+    def check(self, position, image_name, sheet_hash):
+        """DuplicateIndex.check once every earlier position has been checked; a sheet that could not be hashed
+        (sheet_hash None) only takes its turn"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._next == position)
+            try:
+                return None if sheet_hash is None else self._index.check(image_name, sheet_hash)
+            finally:
+                self._next += 1
+                self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._index.close()
+
+class _GateManager(BaseManager):
+    pass
+
+_GateManager.register('DuplicateGate', DuplicateGate)
+
+def serve_duplicate_gate(index_path=None, max_distance=DEFAULT_MAX_DISTANCE):
+    """A DuplicateGate in a manager process, returning the manager and a proxy that can be passed to workers"""
+    manager = _GateManager()
+    manager.start()
+    try:
+        return manager, manager.DuplicateGate(index_path, max_distance)
+    except BaseException:
+        manager.shutdown()
+        raise
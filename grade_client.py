@@ -0,0 +1,138 @@
+import argparse
+import http.client
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import numpy as np
+
+from grade_mcq import list_answer_sheets
+
+############################################################################
+
+###### Client and load generator for grade_service.py ######
+
+############################################################################
+
+
+class GradingClient:
+    """One keep-alive connection to the grading service"""
+
+    def __init__(self, host="127.0.0.1", port=8080, timeout=60):
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, body=None):
+        self.connection.request(method, path, body=body)
+        response = self.connection.getresponse()
+        return response.status, json.loads(response.read() or b'null')
+
+    def register_scheme(self, scheme_id, marking_scheme_path):
+        with open(marking_scheme_path, 'rb') as file:
+            return self.request("PUT", f"/schemes/{quote(scheme_id)}", file.read())
+
+    def grade(self, scheme_id, image_bytes, name=None):
+        path = f"/grade/{quote(scheme_id)}"
+        if name:
+            path += f"?name={quote(name)}"
+        return self.request("POST", path, image_bytes)
+
+    def metrics(self):
+        return self.request("GET", "/metrics")
+
+    def close(self):
+        self.connection.close()
+
+def load_test(host, port, scheme_id, images, requests, concurrency):
+    """Send requests sheets from concurrency connections and report latency and throughput"""
+    local = threading.local()
+    statuses = {}
+    lock = threading.Lock()
+
+    def send(index):
+        if not hasattr(local, 'client'):
+            local.client = GradingClient(host, port)
+        started = time.perf_counter()
+        try:
+            status, _ = local.client.grade(scheme_id, images[index % len(images)])
+        except (OSError, http.client.HTTPException):
+            local.client.close()
+            del local.client
+            status = 'error'
+        elapsed = time.perf_counter() - started
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+        return elapsed if status == 200 else None
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = [elapsed for elapsed in pool.map(send, range(requests)) if elapsed is not None]
+    duration = time.perf_counter() - started
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'duration_s': round(duration, 3),
+        'throughput_per_s': round(len(latencies) / duration, 2),
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'rejected_429': statuses.get(429, 0),
+        'latency_ms': {'p50': round(float(np.percentile(latencies, 50)), 2) if len(latencies) else None,
+                       'p99': round(float(np.percentile(latencies, 99)), 2) if len(latencies) else None},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Client for the MCQ grading service")
+    parser.add_argument("--host", default="127.0.0.1", help="Service address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080, help="Service port (default: 8080)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    register = subparsers.add_parser("register", help="Upload a marking scheme")
+    register.add_argument("scheme_id")
+    register.add_argument("marking_scheme_path")
+
+    grade = subparsers.add_parser("grade", help="Grade answer sheet images")
+    grade.add_argument("scheme_id")
+    grade.add_argument("images", nargs="+")
+
+    load = subparsers.add_parser("load", help="Replay a folder of sheets against the service")
+    load.add_argument("scheme_id")
+    load.add_argument("answer_sheet_folder")
+    load.add_argument("--requests", type=int, default=200, help="Total sheets to send (default: 200)")
+    load.add_argument("--concurrency", type=int, default=16, help="Parallel connections (default: 16)")
+
+    subparsers.add_parser("metrics", help="Show the service metrics")
+    args = parser.parse_args()
+
+    if args.command == "load":
+        images = []
+        for image_file in list_answer_sheets(args.answer_sheet_folder):
+            with open(os.path.join(args.answer_sheet_folder, image_file), 'rb') as file:
+                images.append(file.read())
+        if not images:
+            parser.error(f"No answer sheets found in {args.answer_sheet_folder}")
+        print(json.dumps(load_test(args.host, args.port, args.scheme_id, images,
+                                   args.requests, args.concurrency), indent=2))
+        return
+
+    client = GradingClient(args.host, args.port)
+    try:
+        if args.command == "register":
+            print(client.register_scheme(args.scheme_id, args.marking_scheme_path))
+        elif args.command == "grade":
+            for image_path in args.images:
+                with open(image_path, 'rb') as file:
+                    status, result = client.grade(args.scheme_id, file.read(), os.path.basename(image_path))
+                if status == 200:
+                    print(f"{image_path}: {result['total_marks']}")
+                else:
+                    print(f"{image_path}: HTTP {status} {result.get('error')}")
+        else:
+            print(json.dumps(client.metrics()[1], indent=2))
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    main()
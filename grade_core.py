@@ -0,0 +1,572 @@
+import csv
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+
+from detection_cache import CachedDetection, hash_image_bytes
+from duplicate_index import sheet_hash, THUMBNAIL_SIZE
+from instrumentation import span, count, set_counter
+from pipeline_trace import current_trace
+from sheet_buffers import scratch, thread_buffers
+from scanner_profile import DEFAULT_PROFILE
+from sheet_layout import DEFAULT_LAYOUT, layout_geometry, sheet_sampler, box_sampler, quantized_size
+from sheet_sources import as_sheet_source
+
+############################################################################
+
+###### Sheet detection and grading on plain NumPy arrays ######
+
+# Everything between an image and its marks: locating the sheet, sampling
+# its bubbles, compiling the marking scheme and scoring the detected
+# options, plus the CSV writers for the results. Only OpenCV and NumPy are
+# imported, so the CLI, the service and the pool workers start without
+# pandas or matplotlib; grade_mcq adds DataFrame versions on top for
+# notebooks and the web app.
+
+############################################################################
+
+# Decode flags for reading a downscaled proxy straight from a JPEG/PNG
+REDUCED_READ_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# Choices of --pyramid: full resolution or one of the reduced reads
+PYRAMID_FACTORS = (1,) + tuple(sorted(REDUCED_READ_FLAGS))
+
+def load_image(image_path, reduction=1):
+    if reduction == 1:
+        return cv2.imread(image_path)
+    return cv2.imread(image_path, REDUCED_READ_FLAGS[reduction])
+
+def decode_image(file_bytes, reduction=1):
+    """Decode an encoded image; an already decoded one (a TIFF page) is only downscaled"""
+    if isinstance(file_bytes, np.ndarray):
+        if reduction == 1:
+            return file_bytes
+        height, width = file_bytes.shape[:2]
+        return cv2.resize(file_bytes, (-(-width // reduction), -(-height // reduction)),
+                          interpolation=cv2.INTER_AREA)
+    flags = cv2.IMREAD_COLOR if reduction == 1 else REDUCED_READ_FLAGS[reduction]
+    return cv2.imdecode(np.frombuffer(file_bytes, dtype=np.uint8), flags)
+
+def load_sheet(source):
+    """Full-resolution image of a SheetSource. The bubbles are always read at full resolution, so with --pyramid
+    the proxy is downscaled from this image by find_sheet_corners rather than decoded a second time."""
+    image = load_image(source.path) if source.is_file() else decode_image(source.read())
+    if image is None:
+        raise ValueError("Could not decode the image")
+    return image
+
+def find_contour_corners(image, buffers=None, scanner=None):
+    scanner = scanner or DEFAULT_PROFILE
+    shape = image.shape[:2]
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=scratch(buffers, 'gray', shape))
+    trace = current_trace()
+    if trace is not None:
+        trace.add_image('gray', gray)
+    # Blurred in place, the gray image is not needed afterwards
+    kernel = (scanner.blur_kernel, scanner.blur_kernel)
+    blurred = cv2.GaussianBlur(gray, kernel, 0, dst=gray)
+    edged = cv2.Canny(blurred, scanner.canny_low, scanner.canny_high, edges=scratch(buffers, 'edges', shape))
+    if trace is not None:
+        trace.add_image('canny', edged)
+    contours, _ = cv2.findContours(edged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    count('contours', len(contours))
+    if not contours:
+        raise ValueError("Could not find the corners of the sheet")
+    largest_contour = max(contours, key=cv2.contourArea)
+    perimeter = cv2.arcLength(largest_contour, True)
+    corners = cv2.approxPolyDP(largest_contour, scanner.poly_epsilon * perimeter, True)
+    if trace is not None:
+        trace.add_contour(largest_contour, corners)
+    if len(corners) == 4:
+        return order_corners(corners.reshape(4, 2))
+    else:
+        raise ValueError("Could not find the corners of the sheet")
+
+def order_corners(corners):
+    """Put the corners in the order warp_perspective expects: top-left, bottom-left, bottom-right, top-right"""
+    # The contour starts at its topmost point, which is the top-right corner when the sheet tilts the other way.
+    # Going round the centroid keeps the four corners distinct even for a sheet turned by 45 degrees, where
+    # picking each corner by its own extreme coordinate can pick one point twice.
+    center = corners.mean(axis=0)
+    angles = np.arctan2(corners[:, 1] - center[1], corners[:, 0] - center[0])
+    # With y pointing down, decreasing angle runs bottom-left, bottom-right, top-right, top-left
+    cyclic = corners[np.argsort(-angles, kind='stable')]
+    return np.roll(cyclic, -np.argmin(cyclic.sum(axis=1)), axis=0)
+
+def refine_corners(image, corners, window):
+    """Refine approximate corners with a sub-pixel search in small full-resolution windows"""
+    height, width = image.shape[:2]
+    margin = 2 * window
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    refined = np.empty((4, 2), dtype=np.float32)
+    for i, (x, y) in enumerate(corners):
+        x0, y0 = max(int(x) - margin, 0), max(int(y) - margin, 0)
+        x1, y1 = min(int(x) + margin + 1, width), min(int(y) + margin + 1, height)
+        gray_window = cv2.cvtColor(image[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+        point = np.array([[[x - x0, y - y0]]], dtype=np.float32)
+        cv2.cornerSubPix(gray_window, point, (window, window), (-1, -1), criteria)
+        refined[i] = point[0, 0] + (x0, y0)
+    return np.rint(refined).astype(np.int32)
+
+def find_sheet_corners(image, reduction=1, proxy=None, buffers=None, scanner=None):
+    """Corners of the sheet; buffers (a SheetBuffers) holds the temporaries when given, scanner (a
+    ScannerProfile) the edge detection parameters"""
+    if reduction == 1:
+        return find_contour_corners(image, buffers, scanner)
+
+    # Pyramid mode: find the sheet contour on a downscaled proxy, then map the corners back up
+    if proxy is None:
+        # Cropped to a multiple of reduction, INTER_AREA takes its fast integer-factor path (about half the time)
+        height, width = image.shape[0] // reduction, image.shape[1] // reduction
+        proxy = cv2.resize(image[:height * reduction, :width * reduction], (width, height),
+                           dst=scratch(buffers, 'proxy', (height, width) + image.shape[2:]),
+                           interpolation=cv2.INTER_AREA)
+        scale = np.full(2, reduction, dtype=np.float32)
+    else:
+        scale = np.array([image.shape[1] / proxy.shape[1], image.shape[0] / proxy.shape[0]], dtype=np.float32)
+    corners = find_contour_corners(proxy, buffers, scanner).astype(np.float32) * scale
+    return refine_corners(image, corners, window=2 * reduction + 3)
+
+def warp_perspective(image, corners, buffers=None):
+    """The upright sheet, in a single resample (the rotation and flip are part of sheet_homography)"""
+    homography, (width, height) = sheet_homography(corners)
+    return cv2.warpPerspective(image, homography, (width, height),
+                               dst=scratch(buffers, 'warped', (height, width) + image.shape[2:]))
+
+def create_grid(image, layout=None):
+    """Corners of every option cell of the layout, as a list of ((x0, y0), (x1, y1)) per question"""
+    height, width = image.shape[:2]
+    geometry = layout_geometry(layout or DEFAULT_LAYOUT, width, height)
+    return [[((x0, y0), (x1, y1)) for x0, y0, x1, y1 in cells] for cells in geometry.cell_rects.tolist()]
+
+def extract_question_boxes(image, layout=None):
+    height, width = image.shape[:2]
+    geometry = layout_geometry(layout or DEFAULT_LAYOUT, width, height)
+    # Questions are numbered down each column first
+    return [image[y0:y1, x0:x1] for x0, y0, x1, y1 in geometry.box_rects]
+
+
+# Reference per-box implementation (strip bubbles), kept to check compute_fill_ratios against
+def reference_fill_ratios(question_box, layout=None):
+    layout = layout or DEFAULT_LAYOUT
+    gray_box = cv2.cvtColor(question_box, cv2.COLOR_BGR2GRAY)
+    _, thresh_box = cv2.threshold(gray_box, 150, 255, cv2.THRESH_BINARY_INV)
+    bubble_width = question_box.shape[1] // (layout.options + layout.label_strips)
+    options = range(layout.label_strips, layout.label_strips + layout.options)
+    return [np.sum(thresh_box[:, i * bubble_width:(i + 1) * bubble_width] == 255) / float(thresh_box.size) for i in options]
+
+def detect_colored_bubble(question_box, layout=None):
+    return np.argmax(reference_fill_ratios(question_box, layout)) + 1
+
+def _dark_pixels(image, dst=None, threshold=DEFAULT_PROFILE.dark_threshold):
+    # Thresholded in place, into dst when given
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=dst)
+    return cv2.threshold(gray, threshold, 1, cv2.THRESH_BINARY_INV, dst=gray)[1]
+
+def compute_fill_ratios(warped_image, layout=None, scanner=None):
+    """Dark-pixel ratio of every option cell on the sheet in one pass, as a (questions, options) array"""
+    height, width = warped_image.shape[:2]
+    thresh = _dark_pixels(warped_image, threshold=(scanner or DEFAULT_PROFILE).dark_threshold)
+    return sheet_sampler(layout or DEFAULT_LAYOUT, width, height).fill_ratios(thresh)
+
+# Detection is tiered. A sparse pass samples every SAMPLE_STRIDE-th pixel of the option cells and decides
+# the clear questions. A question escalates when its two largest fill ratios are closer than
+# ESCALATE_MARGIN, or when not exactly one of them reaches FILLED_RATIO (a tie, a blank, a faint mark, a
+# double mark or paper too dark for the fixed threshold). Its box in the sparse sample is re-thresholded at
+# a level adapted to the box (Otsu), which is kept when it is decisive: a filled bubble leading by
+# ESCALATE_MARGIN. Questions still undecided are re-read at full density, so subsampling never decides a
+# near tie.
+SAMPLE_STRIDE = 2
+ESCALATE_MARGIN = 0.02
+FILLED_RATIO = 0.03
+# A lead of the fullest bubble over the next of this much counts as fully confident
+CONFIDENT_MARGIN = 0.03
+
+def top_two_fill_ratios(fill_ratios):
+    """Largest and second largest fill ratio of every question (0 for a single-option layout)"""
+    top_two = np.sort(fill_ratios, axis=1)[:, -2:]
+    return top_two[:, -1], top_two[:, 0] if top_two.shape[1] > 1 else np.zeros(len(top_two))
+
+def is_decisive(fill_ratios):
+    """Whether the fullest bubble of every question is filled and leads the next by ESCALATE_MARGIN"""
+    top, second = top_two_fill_ratios(fill_ratios)
+    return (top - second >= ESCALATE_MARGIN) & (top >= FILLED_RATIO)
+
+def answer_confidence(fill_ratios):
+    """Confidence (0-1) of every selected option, from the lead of the fullest bubble over the next"""
+    top, second = top_two_fill_ratios(np.asarray(fill_ratios))
+    return np.clip((top - second) / CONFIDENT_MARGIN, 0, 1)
+
+def sheet_homography(corners):
+    """Homography from the image to the upright sheet, and that sheet's size"""
+    top_left, top_right, bottom_right, bottom_left = corners.astype(np.float32)
+    width = max(np.linalg.norm(top_right - top_left), np.linalg.norm(bottom_right - bottom_left))
+    height = max(np.linalg.norm(top_right - bottom_right), np.linalg.norm(top_left - bottom_left))
+    destination_corners = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype="float32")
+    M = cv2.getPerspectiveTransform(corners.astype(np.float32), destination_corners)
+    # The sheet is photographed on its side: rotating clockwise and flipping horizontally swaps x and y
+    transpose = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]], dtype=np.float64)
+    return transpose @ M, (int(height), int(width))
+
+class SheetSample:
+    """The upright sheet read every stride pixels, with the geometry needed to re-read parts of it"""
+    __slots__ = ('pixels', 'homography', 'size', 'sheet_size', 'stride')
+
+    def __init__(self, pixels, homography, size, sheet_size, stride):
+        self.pixels = pixels
+        self.homography = homography
+        self.size = size                # (width, height) of the upright sheet
+        self.sheet_size = sheet_size    # the size rounded for the compiled layout index
+        self.stride = stride
+
+    @property
+    def nbytes(self):
+        return self.pixels.nbytes
+
+def sample_sheet(image, corners, stride=SAMPLE_STRIDE, buffers=None):
+    """SheetSample of every stride-th pixel of the upright sheet, in one resample"""
+    homography, (width, height) = sheet_homography(corners)
+    # Sample the sheet at a rounded size, so sheets of similar size share one compiled layout index
+    sheet_width, sheet_height = quantized_size(width, height)
+    resize = np.diag([sheet_width / width, sheet_height / height, 1.0])
+
+    # Output pixel (j, i) is sheet point (stride*j, stride*i)
+    scale = np.diag([1.0 / stride, 1.0 / stride, 1.0])
+    sampled_width, sampled_height = -(-sheet_width // stride), -(-sheet_height // stride)
+    sampled = cv2.warpPerspective(image, scale @ resize @ homography, (sampled_width, sampled_height),
+                                  dst=scratch(buffers, 'sampled', (sampled_height, sampled_width) + image.shape[2:]))
+    return SheetSample(sampled, homography, (width, height), (sheet_width, sheet_height), stride)
+
+def sample_fill_ratios(image, corners, stride=SAMPLE_STRIDE, layout=None, buffers=None, scanner=None):
+    """compute_fill_ratios without warping the sheet at full resolution"""
+    return sampled_fill_ratios(image, sample_sheet(image, corners, stride, buffers), layout, buffers, scanner)
+
+def sampled_fill_ratios(image, sample, layout=None, buffers=None, scanner=None):
+    """Fill ratios of a SheetSample of image, escalating the questions it does not decide"""
+    layout = layout or DEFAULT_LAYOUT
+    threshold = (scanner or DEFAULT_PROFILE).dark_threshold
+    sampled, stride = sample.pixels, sample.stride
+    sheet_width, sheet_height = sample.sheet_size
+    sampler = sheet_sampler(layout, sheet_width, sheet_height, stride)
+    thresh = _dark_pixels(sampled, scratch(buffers, 'sampled_thresh', sampled.shape[:2]), threshold)
+    fill_ratios = sampler.fill_ratios(thresh)
+    trace = current_trace()
+    if layout.options == 1:
+        if trace is not None:
+            trace.add_sample(sample, thresh, layout, fill_ratios)
+        return fill_ratios
+
+    ambiguous = np.flatnonzero(~is_decisive(fill_ratios) | (top_two_fill_ratios(fill_ratios)[1] >= FILLED_RATIO))
+    set_counter('detected_questions', len(fill_ratios))
+    count('escalated_questions', len(ambiguous))
+    if len(ambiguous):
+        # Second tier: Otsu within each ambiguous box of the sparse sample
+        box_rects = -(-layout_geometry(layout, sheet_width, sheet_height).box_rects // stride)
+        for x0, y0, x1, y1 in box_rects[ambiguous]:
+            gray = cv2.cvtColor(sampled[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+            level, thresh[y0:y1, x0:x1] = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+            if trace is not None:
+                trace.otsu_levels.append(level)
+        adaptive = sampler.fill_ratios(thresh)[ambiguous]
+        decided = is_decisive(adaptive)
+        count('adaptive_decisions', int(decided.sum()))
+        fill_ratios[ambiguous[decided]] = adaptive[decided]
+        undecided = ambiguous[~decided]
+        resample_dense(image, sample.homography, sample.size, fill_ratios, undecided, layout, buffers, threshold)
+        if trace is not None:
+            trace.escalated, trace.dense = ambiguous, undecided
+    if trace is not None:
+        trace.add_sample(sample, thresh, layout, fill_ratios)
+    return fill_ratios
+
+def resample_dense(image, homography, size, fill_ratios, questions, layout, buffers=None,
+                   threshold=DEFAULT_PROFILE.dark_threshold):
+    """Third tier: re-read questions at full density and the fixed threshold, on the exact geometry
+    warp_perspective + compute_fill_ratios would use"""
+    count('dense_resampled_questions', len(questions))
+    geometry = layout_geometry(layout, *size)
+    box = box_sampler(layout, *size)
+    box_shape = (geometry.box_height, geometry.box_width)
+    for question in questions:
+        # A small full-density warp of just the question box
+        x0, y0 = geometry.box_rects[question, :2]
+        shift = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]])
+        pixels = cv2.warpPerspective(image, shift @ homography, (geometry.box_width, geometry.box_height),
+                                     dst=scratch(buffers, 'box', box_shape + image.shape[2:]))
+        thresh = _dark_pixels(pixels, scratch(buffers, 'box_thresh', box_shape), threshold)
+        fill_ratios[question] = box.fill_ratios(thresh)[0]
+
+def select_options(fill_ratios):
+    return np.argmax(fill_ratios, axis=1) + 1
+
+# The thumbnail is warped at this multiple of its size and then area-averaged, so it does not alias
+THUMBNAIL_OVERSAMPLE = 8
+
+def sheet_thumbnail(image, corners, size=THUMBNAIL_SIZE):
+    """Small grayscale image of the upright sheet"""
+    homography, (width, height) = sheet_homography(corners)
+    thumb_width, thumb_height = size
+    scale = np.diag([THUMBNAIL_OVERSAMPLE * thumb_width / width, THUMBNAIL_OVERSAMPLE * thumb_height / height, 1.0])
+    sheet = cv2.warpPerspective(image, scale @ homography,
+                                (THUMBNAIL_OVERSAMPLE * thumb_width, THUMBNAIL_OVERSAMPLE * thumb_height))
+    return cv2.cvtColor(cv2.resize(sheet, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+
+def hash_sheet(image, corners):
+    """Perceptual hash of the sheet for duplicate detection, taken from the full-resolution image"""
+    with span('duplicate_hash'):
+        return sheet_hash(sheet_thumbnail(image, corners))
+
+# Bump when a change alters detection results; it is part of the detection cache key
+DETECTION_VERSION = 6
+
+def detection_fingerprint(**params):
+    params = dict(params, version=DETECTION_VERSION)
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+def detection_key(reduction=1, layout=None, scanner=None):
+    """detection_fingerprint of the parameters a detection depends on"""
+    params = {'reduction': reduction, 'layout': (layout or DEFAULT_LAYOUT).fingerprint()}
+    # The default profile adds nothing, so caches written before scanner profiles existed stay valid
+    if scanner is not None and scanner != DEFAULT_PROFILE:
+        params['scanner'] = scanner.fingerprint()
+    return detection_fingerprint(**params)
+
+def locate_sheet(image, reduction=1, proxy=None, buffers=None, scanner=None):
+    with span('find_corners'):
+        return find_sheet_corners(image, reduction, proxy, buffers, scanner)
+
+def read_bubbles(image, corners, layout=None, buffers=None, scanner=None):
+    # The sheet is never warped here; only annotated output needs warp_perspective
+    with span('sample_bubbles'):
+        return sample_fill_ratios(image, corners, layout=layout, buffers=buffers, scanner=scanner)
+
+def detect_sheet(image, reduction=1, proxy=None, layout=None, buffers=None, scanner=None):
+    """Corners and fill ratios of a sheet, with its temporaries in buffers (default: the thread's SheetBuffers)"""
+    if buffers is None:
+        buffers = thread_buffers()
+    corners = locate_sheet(image, reduction, proxy, buffers, scanner)
+    return corners, read_bubbles(image, corners, layout, buffers, scanner)
+
+def detect_decoded(image, reduction=1, proxy=None, layout=None, with_hash=False, scanner=None,
+                   duplicate_check=None):
+    """CachedDetection of a decoded sheet.
+
+    duplicate_check, when given, is called with the sheet's hash (or None without with_hash) as soon as its corners
+    are found. When it returns True the sheet is a skipped duplicate: its bubbles are never read, and options and
+    fill_ratios are None.
+    """
+    buffers = thread_buffers()
+    corners = locate_sheet(image, reduction, proxy, buffers, scanner)
+    sheet_hash = hash_sheet(image, corners) if with_hash else None
+    if duplicate_check is not None and duplicate_check(sheet_hash):
+        return CachedDetection(corners, None, None, sheet_hash)
+    fill_ratios = read_bubbles(image, corners, layout, buffers, scanner)
+    return CachedDetection(corners, select_options(fill_ratios), fill_ratios, sheet_hash)
+
+def detect_cached(file_bytes, cache, reduction=1, regrade_only=False, layout=None, with_hash=False, scanner=None,
+                  duplicate_check=None):
+    """Detection for an encoded image (or decoded TIFF page), served from the detection cache when possible"""
+    with span('cache_lookup'):
+        image_sha256 = hash_image_bytes(file_bytes)
+        fingerprint = detection_key(reduction, layout, scanner)
+        cached = cache.get(image_sha256, fingerprint)
+    # Entries cached without a hash are detected again when duplicate detection needs one
+    if cached is not None and (cached.sheet_hash is not None or not with_hash or regrade_only):
+        count('cache_hits')
+        if duplicate_check is not None and duplicate_check(cached.sheet_hash):
+            return CachedDetection(cached.corners, None, None, cached.sheet_hash)
+        return cached
+    count('cache_misses')
+    if regrade_only:
+        raise ValueError("No cached detection for this sheet")
+
+    with span('decode'):
+        image = decode_image(file_bytes)
+        if image is None:
+            raise ValueError("Could not decode the image")
+    detection = detect_decoded(image, reduction, None, layout, with_hash, scanner, duplicate_check)
+    # Skipped duplicates were never read, so there is nothing to cache
+    if detection.fill_ratios is not None:
+        cache.put(image_sha256, fingerprint, detection.corners, detection.options, detection.fill_ratios,
+                  detection.sheet_hash)
+    return detection
+
+def detect_answer_sheet(image_path, reduction=1, cache=None, regrade_only=False, layout=None, with_hash=False,
+                        scanner=None, duplicate_check=None):
+    """CachedDetection of a sheet image path or SheetSource (hashed when with_hash), from the detection cache
+    when one is given; see detect_decoded for duplicate_check"""
+    source = as_sheet_source(image_path)
+    if cache is not None:
+        return detect_cached(source.read(), cache, reduction, regrade_only, layout, with_hash, scanner,
+                             duplicate_check)
+    with span('decode'):
+        image = load_sheet(source)
+    return detect_decoded(image, reduction, None, layout, with_hash, scanner, duplicate_check)
+
+# Condition codes stored in the compiled marking scheme
+CONDITION_CODES = {'-': 0, 'Any': 1, 'All': 2}
+
+def options_to_mask(options, num_options):
+    mask = 0
+    for option in options:
+        # Answers outside the answer choices (e.g. typos in a key) can never be selected
+        if 1 <= option <= num_options:
+            mask |= 1 << (option - 1)
+    return mask
+
+def _popcount(masks, num_options):
+    counts = np.zeros(np.shape(masks), dtype=np.int64)
+    for bit in range(num_options):
+        counts += (masks >> bit) & 1
+    return counts
+
+class MarkingScheme(dict):
+    """Marking scheme keyed by question ID, compiled into per-question NumPy arrays for grade_matrix.
+
+    The layout's answer options are the choices "All" grading counts; slots past them are ignored.
+    """
+
+    def __init__(self, entries, layout=None):
+        super().__init__(entries)
+        self.num_options = (layout or DEFAULT_LAYOUT).answer_options
+        self.answer_mask = (1 << self.num_options) - 1
+        self.question_ids = np.array(sorted(self), dtype=np.int32)
+        self.valid_masks = np.array([options_to_mask(self[q]['correct_answers'], self.num_options)
+                                     for q in self.question_ids], dtype=np.int64)
+        self.conditions = np.array([CONDITION_CODES[self[q]['condition']] for q in self.question_ids], dtype=np.int8)
+
+    def fingerprint(self):
+        """Hash of the compiled key, identifying the scheme independently of its file"""
+        digest = hashlib.sha256()
+        digest.update(np.int64(self.num_options).tobytes())
+        for array in (self.question_ids, self.valid_masks, self.conditions):
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+def parse_marking_scheme(lines, layout=None):
+    reader = csv.DictReader(lines)
+    return MarkingScheme({int(row['Question ID']): {'correct_answers': [int(ans) for ans in row['Answer ID'].split(',')], 'condition': row['Condition'].strip()} for row in reader}, layout)
+
+def load_marking_scheme(marking_scheme_path, layout=None):
+    with open(marking_scheme_path, 'r') as file:
+        return parse_marking_scheme(file, layout)
+
+def score_selection_masks(selected_masks, marking_scheme):
+    """Per-question scores for an (N, questions) matrix of selected-option bitmasks"""
+    valid_masks = marking_scheme.valid_masks
+    invalid_masks = marking_scheme.answer_mask & ~valid_masks
+    selected_masks = np.asarray(selected_masks, dtype=np.int64)
+    num_options = marking_scheme.num_options
+
+    # "-" and "Any": a mark when something is selected and every selected option is valid
+    single = (selected_masks != 0) & ((selected_masks & ~valid_masks) == 0)
+
+    # "All": |Vs|/|Vr| - |Is|/|Ir| (see Data Set/ReadMe.md)
+    num_valid, num_invalid = _popcount(valid_masks, num_options), _popcount(invalid_masks, num_options)
+    valid_share = np.divide(_popcount(selected_masks & valid_masks, num_options), num_valid,
+                            out=np.zeros(selected_masks.shape), where=num_valid > 0)
+    invalid_share = np.divide(_popcount(selected_masks & invalid_masks, num_options), num_invalid,
+                              out=np.zeros(selected_masks.shape), where=num_invalid > 0)
+
+    return np.where(marking_scheme.conditions == CONDITION_CODES['All'], valid_share - invalid_share, single)
+
+def grade_matrix(selections, marking_scheme):
+    """Grade an (N, questions) matrix of selected options (0 for none) for N students in one call"""
+    if not isinstance(marking_scheme, MarkingScheme):
+        marking_scheme = MarkingScheme(marking_scheme)
+    selections = np.asarray(selections)
+    selected_masks = np.where(selections > 0, np.left_shift(np.int64(1), np.maximum(selections - 1, 0)), 0)
+    scores = score_selection_masks(selected_masks, marking_scheme)
+    return scores, scores.sum(axis=1)
+
+def scheme_selections(options, marking_scheme):
+    """Arrange detected options (one row per sheet, question 1 first) in the marking scheme's question order"""
+    options = np.atleast_2d(options)
+    question_ids = marking_scheme.question_ids
+    selections = np.zeros((len(options), len(question_ids)), dtype=np.int64)
+    # Scheme questions the sheet does not print stay unanswered; extra sheet questions are not graded
+    on_sheet = (question_ids >= 1) & (question_ids <= options.shape[1])
+    selections[:, on_sheet] = options[:, question_ids[on_sheet] - 1]
+    return selections
+
+def format_marks(marks):
+    marks = round(float(marks), 4)
+    return int(marks) if marks.is_integer() else marks
+
+class SheetGrade:
+    """Marks of one graded sheet, per marking scheme question (in question ID order) and in total"""
+    __slots__ = ('question_ids', 'scores', 'confidence', 'total_marks')
+
+    def __init__(self, question_ids, scores, confidence, total_marks):
+        self.question_ids = question_ids
+        self.scores = scores
+        self.confidence = confidence
+        self.total_marks = total_marks
+
+def grade_sheet(options, marking_scheme, confidence=None, question_numbers=None):
+    """SheetGrade of the detected options of one sheet, question 1 first unless question_numbers gives them.
+
+    confidence holds the detection confidence of every option; it is rounded and put in scheme order.
+    """
+    if not isinstance(marking_scheme, MarkingScheme):
+        marking_scheme = MarkingScheme(marking_scheme)
+    question_ids = marking_scheme.question_ids
+    options = np.asarray(options)
+    q_no = np.arange(1, len(options) + 1) if question_numbers is None else np.asarray(question_numbers)
+    graded = np.isin(q_no, question_ids)
+    positions = np.searchsorted(question_ids, q_no[graded])
+    selections = np.zeros((1, len(question_ids)), dtype=np.int64)
+    selections[0, positions] = options[graded]
+    scores, total_marks = grade_matrix(selections, marking_scheme)
+    if confidence is not None:
+        # Questions the sheet does not print have no detection to be confident in
+        scheme_confidence = np.zeros(len(question_ids))
+        scheme_confidence[positions] = np.asarray(confidence)[graded]
+        confidence = scheme_confidence.round(3)
+    return SheetGrade(question_ids, scores[0], confidence, format_marks(total_marks[0]))
+
+# CSVs are written the way pandas' to_csv wrote them before, so their bytes do not change
+
+def _csv_number(value):
+    if isinstance(value, (bool, np.bool_)):
+        return str(bool(value))
+    # The shortest repr of the value's own precision, e.g. 0.14 for a float32 confidence
+    if isinstance(value, np.floating):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    return value
+
+def write_results_csv(output_file, question_ids, scores, confidence=None):
+    """Write a sheet's <image>_graded.csv: Question, Correct, Score and, when given, Confidence"""
+    scores = np.asarray(scores, dtype=np.float64)
+    columns = [np.asarray(question_ids), scores == 1, scores]
+    header = ['Question', 'Correct', 'Score']
+    if confidence is not None:
+        columns.append(np.asarray(confidence))
+        header.append('Confidence')
+    with open(output_file, 'w', newline='') as file:
+        writer = csv.writer(file, lineterminator=os.linesep)
+        writer.writerow(header)
+        writer.writerows([_csv_number(value) for value in row] for row in zip(*columns))
+
+def write_summary_csv(summary_file, rows, columns):
+    """Write summary rows (dicts) as a CSV of the given columns; None is written as an empty field"""
+    table = [[row.get(column) for column in columns] for row in rows]
+    for index in range(len(columns)):
+        values = [row[index] for row in table]
+        # A column of numbers only, some fractional, is written as floats throughout (3.0 rather than 3)
+        numbers = all(isinstance(value, (int, float, np.number)) and not isinstance(value, bool) for value in values)
+        if values and numbers and any(isinstance(value, (float, np.floating)) for value in values):
+            for row in table:
+                row[index] = float(row[index])
+    with open(summary_file, 'w', newline='') as file:
+        writer = csv.writer(file, lineterminator=os.linesep)
+        writer.writerow(columns)
+        writer.writerows([_csv_number(value) for value in row] for row in table)
@@ -1,127 +1,498 @@
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
-import csv
 import os
-import pandas as pd
+import sys
 import argparse
-
-def load_image(image_path):
-    return cv2.imread(image_path)
-
-def find_sheet_corners(image):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-    edged = cv2.Canny(blurred, 50, 150)
-    contours, _ = cv2.findContours(edged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    largest_contour = max(contours, key=cv2.contourArea)
-    perimeter = cv2.arcLength(largest_contour, True)
-    corners = cv2.approxPolyDP(largest_contour, 0.02 * perimeter, True)
-    if len(corners) == 4:
-        return corners.reshape(4, 2)
-    else:
-        raise ValueError("Could not find the corners of the sheet")
-
-def warp_perspective(image, corners):
-    top_left, top_right, bottom_right, bottom_left = corners
-    width = max(np.linalg.norm(top_right - top_left), np.linalg.norm(bottom_right - bottom_left))
-    height = max(np.linalg.norm(top_right - bottom_right), np.linalg.norm(top_left - bottom_left))
-    destination_corners = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype="float32")
-    M = cv2.getPerspectiveTransform(corners.astype(np.float32), destination_corners)
-    warped = cv2.warpPerspective(image, M, (int(width), int(height)))
-    return cv2.flip(cv2.rotate(warped, cv2.ROTATE_90_CLOCKWISE), 1)
-
-def create_grid(image, num_questions=10, num_options=5):
-    height, width = image.shape[:2]
-    cell_height, cell_width = height // num_questions, width // num_options
-    grid = [[((j * cell_width, i * cell_height), ((j + 1) * cell_width, (i + 1) * cell_height)) for j in range(num_options)] for i in range(num_questions)]
-    return grid
-
-def extract_question_boxes(image, num_columns=5, num_rows=10):
-    height, width = image.shape[:2]
-    box_width, box_height = width // num_columns, height // num_rows
-    question_boxes = []
-    
-    # Process in column-wise order
-    for j in range(num_columns):         # Iterate over columns first
-        for i in range(num_rows):        # Then iterate over rows
-            top_left = (j * box_width, i * box_height)
-            bottom_right = ((j + 1) * box_width, (i + 1) * box_height)
-            question_box = image[top_left[1]:bottom_right[1], top_left[0]:bottom_right[0]]
-            question_boxes.append(question_box)
-    
-    return question_boxes
-
-
-def detect_colored_bubble(question_box):
-    gray_box = cv2.cvtColor(question_box, cv2.COLOR_BGR2GRAY)
-    _, thresh_box = cv2.threshold(gray_box, 150, 255, cv2.THRESH_BINARY_INV)
-    bubble_width = question_box.shape[1] // 6
-    filled_bubbles = [np.sum(thresh_box[:, i * bubble_width:(i + 1) * bubble_width] == 255) / float(thresh_box.size) for i in range(1, 6)]
-    return np.argmax(filled_bubbles) + 1
-
-def process_answer_sheet(image_path, marking_scheme):
-    image = load_image(image_path)
-    corners = find_sheet_corners(image)
-    warped_image = warp_perspective(image, corners)
-    question_boxes = extract_question_boxes(warped_image)
-    results = [(i + 1, detect_colored_bubble(question_box)) for i, question_box in enumerate(question_boxes)]
-    return pd.DataFrame(results, columns=["q_no", "option"])
-
-def load_marking_scheme(marking_scheme_path):
-    with open(marking_scheme_path, 'r') as file:
-        reader = csv.DictReader(file)
-        return {int(row['Question ID']): {'correct_answers': [int(ans) for ans in row['Answer ID'].split(',')], 'condition': row['Condition']} for row in reader}
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+# pandas is only imported by the DataFrame helpers (grade, detected_answers_frame, save_results), so the CLI
+# and the pool workers start without it
+from grade_core import (
+    PYRAMID_FACTORS, answer_confidence, detect_answer_sheet, grade_sheet, load_marking_scheme,
+    write_results_csv, write_summary_csv
+)
+from detection_cache import DetectionCache, CACHE_FILE_NAME, DEFAULT_MAX_BYTES
+from instrumentation import span, profile_sheet, JsonLinesExporter
+from pipeline_trace import TraceSampler, TraceWriter, trace_sheet, DEFAULT_TRACE_CONFIDENCE
+from item_analysis import ItemAnalysis, analyze_rows, save_item_analysis, ITEM_ANALYSIS_FILE_NAME
+from results_store import ResultsStore, RESULTS_FILE_NAME
+from duplicate_index import DuplicateGate, serve_duplicate_gate, HASH_BITS, DEFAULT_MAX_DISTANCE, INDEX_FILE_NAME
+from sheet_sources import (
+    as_sheet_source, list_sheet_sources, select_shard, parse_shard, shard_file_name, IMAGE_EXTENSIONS
+)
+from sheet_layout import DEFAULT_LAYOUT, load_layout
+from scanner_profile import DEFAULT_PROFILE_NAME, load_profile
 
 def grade(detected_answers_df, marking_scheme):
-    total_marks = 0
-    results = []
-    for index, row in detected_answers_df.iterrows():
-        q_no = row['q_no']
-        detected_answer = row['option']
-        correct_data = marking_scheme[q_no]
-        correct_answers, condition = correct_data['correct_answers'], correct_data['condition']
-        is_correct = detected_answer in correct_answers if condition in ['-', 'Any'] else set(correct_answers) == {detected_answer}
-        if is_correct:
-            total_marks += 1
-        results.append({'Question': q_no, 'Correct': is_correct})
-    print(f"Total Marks: {total_marks}/50")
-    return pd.DataFrame(results)
+    """grade_sheet for a detected_answers_frame, returning the per-question results as a DataFrame"""
+    import pandas as pd
+    confidence = detected_answers_df['confidence'].to_numpy() if 'confidence' in detected_answers_df else None
+    sheet_grade = grade_sheet(detected_answers_df['option'].to_numpy(), marking_scheme, confidence,
+                              detected_answers_df['q_no'].to_numpy())
+    print_total_marks(sheet_grade)
+    results_df = pd.DataFrame({'Question': sheet_grade.question_ids, 'Correct': sheet_grade.scores == 1,
+                               'Score': sheet_grade.scores})
+    if sheet_grade.confidence is not None:
+        results_df['Confidence'] = sheet_grade.confidence
+    return results_df
+
+def print_total_marks(sheet_grade):
+    print(f"Total Marks: {sheet_grade.total_marks}/{len(sheet_grade.question_ids)}")
 
 def save_results(df, output_path):
     df.to_csv(output_path, index=False)
 
-def main():
-    parser = argparse.ArgumentParser(description="Grading MCQ Answer Sheets")
+def graded_csv_path(output_folder, image_file):
+    return os.path.join(output_folder, f"{os.path.splitext(image_file)[0]}_graded.csv")
+
+def list_answer_sheets(folder):
+    """Loose image files of a folder; list_sheet_sources also expands TIFFs and ZIP archives"""
+    return sorted(f for f in os.listdir(folder) if f.endswith(IMAGE_EXTENSIONS))
+
+def detected_answers_frame(options, fill_ratios=None):
+    """Detected option of every question, with its confidence when the fill ratios are given"""
+    import pandas as pd
+    detected_answers_df = pd.DataFrame({"q_no": np.arange(1, len(options) + 1), "option": options})
+    if fill_ratios is not None:
+        detected_answers_df['confidence'] = answer_confidence(fill_ratios)
+    return detected_answers_df
+
+def error_row(image_file, error):
+    print(f"Failed to process {image_file}: {error}")
+    return {'image_name': image_file, 'grade': '', 'error': str(error)}
+
+def grade_detected(options, fill_ratios, marking_scheme):
+    """SheetGrade of detected options, with their confidences"""
+    with span('grade'):
+        sheet_grade = grade_sheet(options, marking_scheme, answer_confidence(fill_ratios))
+    print_total_marks(sheet_grade)
+    return sheet_grade
+
+def save_graded_sheet(image_file, options, fill_ratios, marking_scheme, output_folder):
+    """Grade a sheet's detected options, write its CSV and return its summary row"""
+    sheet_grade = grade_detected(options, fill_ratios, marking_scheme)
+    output_file = graded_csv_path(output_folder, image_file)
+    with span('save_results'):
+        write_results_csv(output_file, sheet_grade.question_ids, sheet_grade.scores, sheet_grade.confidence)
+    print(f"Processed {image_file} and saved results to {output_file}")
+    # The options travel with the row for item analysis; the summary only writes its own columns
+    return {'image_name': image_file, 'grade': sheet_grade.total_marks, 'error': None, 'options': options}
+
+def graded_record(image_file, options, fill_ratios, marking_scheme):
+    """Summary row of a graded sheet that also carries its arrays, for the results store or a later CSV"""
+    sheet_grade = grade_detected(options, fill_ratios, marking_scheme)
+    print(f"Processed {image_file}")
+    return {'image_name': image_file, 'grade': sheet_grade.total_marks, 'error': None,
+            'options': options, 'fill_ratios': fill_ratios, 'question_ids': sheet_grade.question_ids,
+            'scores': sheet_grade.scores, 'confidence': sheet_grade.confidence}
+
+class SheetDuplicateCheck:
+    """Checks one sheet against a DuplicateGate (or a proxy of one) when detection has hashed it"""
+    __slots__ = ('gate', 'position', 'image_path', 'skip', 'checked', 'match')
+
+    def __init__(self, gate, position, source, skip=False):
+        self.gate = gate
+        self.position = position
+        # Keyed by full path, so sheets of other folders with the same file name are still told apart
+        self.image_path = os.path.abspath(source.virtual_path)
+        self.skip = skip
+        self.checked = False
+        self.match = None
+
+    def __call__(self, sheet_hash):
+        """Whether the sheet is a duplicate to skip, so its bubbles need not be read"""
+        self.checked = True
+        self.match = self.gate.check(self.position, self.image_path, sheet_hash)
+        return self.skip and self.match is not None
+
+    def finish(self):
+        """Take the sheet's turn when detection failed before hashing it, so later sheets are not held up"""
+        if not self.checked:
+            self(None)
+
+    def duplicate_of(self):
+        """The original's name (relative when in the same folder) and the distance, or None"""
+        if self.match is None:
+            return None
+        original, distance = self.match
+        if os.path.dirname(original) == os.path.dirname(self.image_path):
+            original = os.path.basename(original)
+        return original, distance
+
+def duplicate_check_for(duplicate_gate, position, image_path, skip=False):
+    return None if duplicate_gate is None else SheetDuplicateCheck(duplicate_gate, position,
+                                                                   as_sheet_source(image_path), skip)
+
+def process_answer_sheet(image_path, marking_scheme, reduction=1, layout=None, scanner=None):
+    detection = detect_answer_sheet(image_path, reduction, layout=layout, scanner=scanner)
+    return detected_answers_frame(detection.options, detection.fill_ratios)
+
+def grade_answer_sheet(image_path, marking_scheme, output_folder, reduction=1, cache=None, regrade_only=False,
+                       profile_log=None, layout=None, store_results=False, duplicate_check=None, scanner=None,
+                       trace_sampler=None):
+    """Summary row of one sheet (a path or SheetSource); with store_results it carries the sheet's arrays instead
+    of writing its CSV, and when trace_sampler picks the sheet, its SheetTrace under 'trace'.
+
+    duplicate_check (a SheetDuplicateCheck) checks the sheet for a rescan of an earlier one as soon as its corners
+    are found; a duplicate is named in the row's duplicate_of, and a skipped one is never read or graded.
+    """
+    image_file = as_sheet_source(image_path).name
+    least_confidence, skipped = None, False
+    with profile_sheet(image_file, enabled=profile_log is not None) as profile:
+        sampled = trace_sampler is not None and trace_sampler.sampled(image_file)
+        with trace_sheet(image_file, enabled=sampled) as trace:
+            try:
+                detection = detect_answer_sheet(image_path, reduction, cache, regrade_only, layout,
+                                                duplicate_check is not None, scanner, duplicate_check)
+            except (ValueError, cv2.error) as e:
+                row = error_row(image_file, e)
+            else:
+                if detection.fill_ratios is None:
+                    # A skipped duplicate
+                    row, skipped = {'image_name': image_file, 'grade': '', 'error': None}, True
+                elif store_results:
+                    row = graded_record(image_file, detection.options, detection.fill_ratios, marking_scheme)
+                else:
+                    row = save_graded_sheet(image_file, detection.options, detection.fill_ratios, marking_scheme,
+                                            output_folder)
+                if trace_sampler is not None and not skipped:
+                    least_confidence = float(np.min(answer_confidence(detection.fill_ratios)))
+            finally:
+                if duplicate_check is not None:
+                    duplicate_check.finish()
+    if duplicate_check is not None and duplicate_check.match is not None:
+        original, distance = duplicate_check.duplicate_of()
+        print(f"{image_file} looks like a rescan of {original} ({distance} bits apart)"
+              + (", skipping it" if duplicate_check.skip else ""))
+        row['duplicate_of'] = original
+    if profile is not None:
+        profile_log.export(dict(profile.as_dict(), grade=row['grade'], error=row['error']))
+    if trace_sampler is not None and not skipped and (trace is not None or trace_sampler.wants(least_confidence)):
+        if trace is None or not trace.tiles:
+            # Not traced, or served from the detection cache: detect it again to see how it was read
+            trace = trace_answer_sheet(image_path, reduction, layout, scanner)
+        trace.grade, trace.error = row['grade'], row['error']
+        row['trace'] = trace
+    return row
+
+def trace_answer_sheet(image_path, reduction=1, layout=None, scanner=None):
+    """SheetTrace of detecting a sheet (a path or SheetSource) without the detection cache"""
+    source = as_sheet_source(image_path)
+    with trace_sheet(source.name) as trace:
+        try:
+            detect_answer_sheet(source, reduction, layout=layout, scanner=scanner)
+        except (ValueError, cv2.error) as e:
+            trace.error = str(e)
+    return trace
+
+def open_profile_log(profile_path):
+    return JsonLinesExporter(profile_path) if profile_path else None
+
+def open_detection_cache(cache_path, max_bytes=DEFAULT_MAX_BYTES):
+    return DetectionCache(cache_path, max_bytes) if cache_path else None
+
+def open_results_store(store_path):
+    return ResultsStore(store_path) if store_path else None
+
+def submit_traces(rows, trace_writer):
+    """Hand the trace of every traced row passing through to the trace writer"""
+    for row in rows:
+        trace = row.pop('trace', None)
+        if trace is not None:
+            trace_writer.submit(trace)
+        yield row
+
+def collect_results(rows, store=None):
+    """The summary rows as a list, or with a results store, each row written to it as it arrives (returns None)"""
+    if store is None:
+        return list(rows)
+    try:
+        for row in rows:
+            store.add(row)
+    finally:
+        # Keep everything graded so far, even when the run is interrupted
+        store.close()
+    return None
+
+# Marking scheme, detection cache, profile log, sheet layout, scanner profile, trace sampler and duplicate gate
+# proxy set up once per pool worker by _init_worker
+_worker_marking_scheme = None
+_worker_cache = None
+_worker_profile_log = None
+_worker_layout = None
+_worker_scanner = None
+_worker_trace_sampler = None
+_worker_duplicate_gate = None
+
+def _init_worker(marking_scheme_path, cache_path=None, cache_max_bytes=DEFAULT_MAX_BYTES, profile_path=None,
+                 layout=None, scanner=None, trace_sampler=None, duplicate_gate=None):
+    global _worker_marking_scheme, _worker_cache, _worker_profile_log, _worker_layout, _worker_scanner
+    global _worker_trace_sampler, _worker_duplicate_gate
+    _worker_marking_scheme = load_marking_scheme(marking_scheme_path, layout)
+    _worker_cache = open_detection_cache(cache_path, cache_max_bytes)
+    _worker_profile_log = open_profile_log(profile_path)
+    _worker_layout = layout
+    _worker_scanner = scanner
+    _worker_trace_sampler = trace_sampler
+    _worker_duplicate_gate = duplicate_gate
+
+def _grade_in_worker(image_path, position, output_folder, reduction, regrade_only, store_results=False,
+                     skip_duplicates=False):
+    # Traces travel back with the rows and are written by the parent's TraceWriter
+    duplicate_check = duplicate_check_for(_worker_duplicate_gate, position, image_path, skip_duplicates)
+    return grade_answer_sheet(image_path, _worker_marking_scheme, output_folder, reduction,
+                              _worker_cache, regrade_only, _worker_profile_log, _worker_layout, store_results,
+                              duplicate_check, _worker_scanner, _worker_trace_sampler)
+
+def grade_folder(marking_scheme_path, answer_sheet_folder, output_folder, workers=1, reduction=1,
+                 cache_path=None, cache_max_bytes=DEFAULT_MAX_BYTES, regrade_only=False, profile_path=None,
+                 layout=None, store_path=None, duplicates=None, duplicate_index_path=None,
+                 duplicate_distance=DEFAULT_MAX_DISTANCE, shard=None, item_analysis=None, scanner=None,
+                 trace_folder=None, trace_sampler=None):
+    """Grade every sheet of a folder, returning the summary rows (None when they go to the results store).
+
+    duplicates is None, 'flag' or 'skip': rescans of an earlier sheet get a duplicate_of column, and with 'skip'
+    are left unread and ungraded. Sheets are checked in folder order as soon as their corners are found, through
+    a DuplicateGate (shared by the pool workers from a manager process).
+
+    shard is None or an (index, count) pair selecting the sheets to grade. Every graded sheet is added to
+    item_analysis (an ItemAnalysis) as its row arrives. scanner is the ScannerProfile to detect with. With a
+    trace_folder, contact sheets of the sheets trace_sampler (default: TraceSampler()) picks are written to it.
+    """
+    # Only names and page or member references; each sheet is read when it is graded
+    sources = select_shard(list_sheet_sources(answer_sheet_folder), shard)
+    store = open_results_store(store_path)
+    skip_duplicates = duplicates == 'skip'
+    deferred = store is not None
+    if trace_folder is not None:
+        trace_sampler = trace_sampler or TraceSampler()
+        trace_writer = TraceWriter(trace_folder)
+    else:
+        trace_sampler, trace_writer = None, None
+
+    def summarize(rows):
+        if trace_writer is not None:
+            rows = submit_traces(rows, trace_writer)
+        if item_analysis is not None:
+            rows = analyze_rows(rows, item_analysis)
+        return collect_results(rows, store)
+
+    serial = workers <= 1 or len(sources) <= 1
+    manager, duplicate_gate = None, None
+    try:
+        if duplicates and serial:
+            duplicate_gate = DuplicateGate(duplicate_index_path, duplicate_distance)
+        elif duplicates:
+            manager, duplicate_gate = serve_duplicate_gate(duplicate_index_path, duplicate_distance)
+        if serial:
+            marking_scheme = load_marking_scheme(marking_scheme_path, layout)
+            cache = open_detection_cache(cache_path, cache_max_bytes)
+            profile_log = open_profile_log(profile_path)
+            try:
+                return summarize(grade_answer_sheet(source, marking_scheme, output_folder, reduction, cache,
+                                                    regrade_only, profile_log, layout, deferred,
+                                                    duplicate_check_for(duplicate_gate, position, source,
+                                                                        skip_duplicates),
+                                                    scanner, trace_sampler)
+                                 for position, source in enumerate(sources))
+            finally:
+                if cache is not None:
+                    cache.close()
+
+        # executor.map yields in submission order, so the summary matches a serial run
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(marking_scheme_path, cache_path, cache_max_bytes, profile_path,
+                                           layout, scanner, trace_sampler, duplicate_gate)) as executor:
+            summary_data = summarize(executor.map(partial(_grade_in_worker, output_folder=output_folder,
+                                                          reduction=reduction, regrade_only=regrade_only,
+                                                          store_results=deferred, skip_duplicates=skip_duplicates),
+                                                  sources, range(len(sources))))
+        if cache_path:
+            # Workers exit without closing their connections, so apply the size limit once here
+            open_detection_cache(cache_path, cache_max_bytes).close()
+        return summary_data
+    finally:
+        if duplicate_gate is not None:
+            duplicate_gate.close()
+        if manager is not None:
+            manager.shutdown()
+        if trace_writer is not None:
+            trace_writer.close()
+            print(f"Wrote {trace_writer.written} trace contact sheet(s) to {trace_folder}")
+
+def save_summary(summary_data, output_folder, file_name="Summary.csv"):
+    columns = ['image_name', 'grade']
+    if any(row['error'] for row in summary_data):
+        columns.append('error')
+    if any(row.get('duplicate_of') for row in summary_data):
+        columns.append('duplicate_of')
+    summary_file = os.path.join(output_folder, file_name)
+    write_summary_csv(summary_file, summary_data, columns)
+    return summary_file
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["merge"]:
+        from merge_shards import main as merge_main
+        merge_main(argv[1:])
+        return
+    if argv[:1] == ["calibrate"]:
+        from calibrate import main as calibrate_main
+        calibrate_main(argv[1:])
+        return
+    if argv[:1] == ["trace"]:
+        from pipeline_trace import main as trace_main
+        trace_main(argv[1:])
+        return
+    parser = argparse.ArgumentParser(description="Grading MCQ Answer Sheets",
+                                     epilog="Combine the outputs of --shard runs with: %(prog)s merge --help. Find the "
+                                            "best --scanner-profile with: %(prog)s calibrate --help. Trace chosen "
+                                            "sheets with: %(prog)s trace --help")
     parser.add_argument("--marking-scheme-path", required=True, help="Path to marking scheme CSV")
-    parser.add_argument("--answer-sheet-folder", required=True, help="Folder containing answer sheet images")
+    parser.add_argument("--answer-sheet-folder", required=True,
+                        help="Folder containing answer sheet images, multi-page TIFFs or ZIP archives of images")
     parser.add_argument("--output-folder", required=True, help="Folder to save output CSVs")
-    args = parser.parse_args()
-    
-    marking_scheme = load_marking_scheme(args.marking_scheme_path)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes (default: number of CPU cores)")
+    parser.add_argument("--pyramid", type=int, choices=PYRAMID_FACTORS, default=1,
+                        help="Locate the sheet on an image downscaled by this factor, then refine at full resolution")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Overlap decoding, sheet processing and CSV writing in a streaming pipeline")
+    parser.add_argument("--io-threads", type=int, default=4,
+                        help="Image decoding threads used by --pipeline (default: 4)")
+    parser.add_argument("--queue-depth", type=int, default=8,
+                        help="Maximum number of decoded sheets in flight with --pipeline (default: 8)")
+    parser.add_argument("--cache", action="store_true",
+                        help=f"Reuse detections stored in {CACHE_FILE_NAME} under the output folder")
+    parser.add_argument("--cache-path", help="Detection cache file to use instead (implies --cache)")
+    parser.add_argument("--cache-max-mb", type=float, default=DEFAULT_MAX_BYTES / 2 ** 20,
+                        help="Evict least recently used detections beyond this size (default: %(default)s)")
+    parser.add_argument("--regrade-only", action="store_true",
+                        help="Grade purely from cached detections; sheets missing from the cache are reported as errors")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep watching the folder and grade new sheets as they are written, until interrupted")
+    parser.add_argument("--poll-interval", type=float, default=1.0,
+                        help="Seconds between folder scans in --watch mode (default: 1)")
+    parser.add_argument("--settle-seconds", type=float, default=2.0,
+                        help="In --watch mode, grade a file once its size is unchanged for this long (default: 2)")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write per-sheet stage timings and counters to this file as JSON lines")
+    parser.add_argument("--results-store", action="store_true",
+                        help=f"Write answers, fill ratios and scores to {RESULTS_FILE_NAME} in the output folder "
+                             "in batches instead of one CSV per sheet; Summary.csv is exported from it")
+    parser.add_argument("--layout", metavar="NAME_OR_PATH",
+                        help=f"Sheet layout file, or the name of one in sheet_layouts/ (default: {DEFAULT_LAYOUT.name})")
+    parser.add_argument("--scanner-profile", metavar="NAME_OR_PATH",
+                        help="Edge detection and ink threshold parameters of the scanner, a profile file or the name "
+                             f"of one in scanner_profiles/ written by calibrate.py (default: {DEFAULT_PROFILE_NAME})")
+    parser.add_argument("--duplicates", choices=["flag", "skip"],
+                        help="Find sheets that look like rescans of an earlier sheet by their perceptual hash: flag "
+                             "names the original in Summary.csv's duplicate_of column, skip also leaves them ungraded")
+    parser.add_argument("--duplicate-index", metavar="PATH",
+                        help=f"Keep sheet hashes in this file (or {INDEX_FILE_NAME} in this folder) so rescans of "
+                             "sheets from earlier runs are found too (implies --duplicates flag)")
+    parser.add_argument("--duplicate-distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                        help="Hashes at most this many bits apart are duplicates (default: %(default)s)")
+    parser.add_argument("--shard", metavar="I/N",
+                        help="Grade only shard I of N (from 1) of the sheets, chosen by a stable hash of their names, "
+                             "and write Summary.shard-I-of-N.csv; run every shard, then merge")
+    parser.add_argument("--item-analysis", action="store_true",
+                        help=f"Write per-question difficulty, discrimination and option counts to "
+                             f"{ITEM_ANALYSIS_FILE_NAME} and print the KR-20 reliability of the cohort")
+    parser.add_argument("--trace-folder", metavar="PATH",
+                        help="Write contact sheets of the intermediate images (gray, edges, contour, sampled sheet, "
+                             "bubble thresholds and cells) of the traced sheets to this folder")
+    parser.add_argument("--trace-rate", type=float, default=0.0,
+                        help="Trace this fraction of the sheets, chosen by a stable hash of their names (default: 0)")
+    parser.add_argument("--trace-confidence", type=float, default=DEFAULT_TRACE_CONFIDENCE,
+                        help="Also trace sheets that fail or have an answer less confident than this; 0 traces "
+                             "only the --trace-rate sample (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.profile and args.pipeline:
+        parser.error("--profile is not supported with --pipeline")
+    if args.watch and args.pipeline:
+        parser.error("--pipeline is not supported with --watch")
+    if args.results_store and args.watch:
+        parser.error("--results-store is not supported with --watch")
+    if args.duplicate_index and not args.duplicates:
+        args.duplicates = "flag"
+    if args.duplicates and (args.watch or args.pipeline):
+        parser.error("--duplicates is not supported with --watch or --pipeline")
+    if not 0 <= args.duplicate_distance < HASH_BITS:
+        parser.error(f"--duplicate-distance must be between 0 and {HASH_BITS - 1}")
+    if args.shard and (args.watch or args.duplicates):
+        # Rescans are only found among the sheets of one shard, so sharded runs would miss most of them
+        parser.error("--shard is not supported with --watch or --duplicates")
+    if args.item_analysis and (args.watch or args.shard):
+        # Shards are analysed together from their merged results store with item_analysis.py
+        parser.error("--item-analysis is not supported with --watch or --shard")
+    if args.trace_folder and (args.watch or args.pipeline):
+        parser.error("--trace-folder is not supported with --watch or --pipeline")
+    try:
+        layout = load_layout(args.layout)
+        scanner = load_profile(args.scanner_profile)
+        shard = parse_shard(args.shard) if args.shard else None
+        trace_sampler = TraceSampler(args.trace_rate, args.trace_confidence) if args.trace_folder else None
+    except ValueError as e:
+        parser.error(str(e))
 
-    # List to store summary of grades
-    summary_data = []
-    
     os.makedirs(args.output_folder, exist_ok=True)
-    for image_file in os.listdir(args.answer_sheet_folder):
-        if image_file.endswith((".jpg", ".jpeg", ".png")):
-            image_path = os.path.join(args.answer_sheet_folder, image_file)
-            detected_answers_df = process_answer_sheet(image_path, marking_scheme)
-            results_df = grade(detected_answers_df, marking_scheme)
-            output_file = os.path.join(args.output_folder, f"{os.path.splitext(image_file)[0]}_graded.csv")
-            save_results(results_df, output_file)
-            print(f"Processed {image_file} and saved results to {output_file}")
-
-            # Calculate total marks for the current answer sheet
-            total_marks = results_df['Correct'].sum()
-            summary_data.append({'image_name': image_file, 'grade': total_marks})
-
-    # Save the overall summary as Summary.csv in the output folder
-    summary_file = os.path.join(args.output_folder, "Summary.csv")
-    summary_df = pd.DataFrame(summary_data, columns=['image_name', 'grade'])
-    summary_df.to_csv(summary_file, index=False)
+    if args.profile and not args.watch:
+        # A batch run starts a fresh profile; --watch keeps appending across restarts
+        open(args.profile, 'w').close()
+    # Shards write their own summary, store and cache, so several machines can share one output folder
+    cache_path = args.cache_path
+    if cache_path is None and (args.cache or args.regrade_only):
+        cache_path = os.path.join(args.output_folder, shard_file_name(CACHE_FILE_NAME, shard))
+    cache_max_bytes = int(args.cache_max_mb * 2 ** 20)
+    store_path = (os.path.join(args.output_folder, shard_file_name(RESULTS_FILE_NAME, shard))
+                  if args.results_store else None)
+    summary_name = shard_file_name("Summary.csv", shard)
+    item_analysis = (ItemAnalysis(load_marking_scheme(args.marking_scheme_path, layout), layout.options)
+                     if args.item_analysis else None)
+
+    if args.watch:
+        from watch_folder import watch_folder
+        watch_folder(args.marking_scheme_path, args.answer_sheet_folder, args.output_folder,
+                     workers=args.workers, reduction=args.pyramid, cache_path=cache_path,
+                     cache_max_bytes=cache_max_bytes, regrade_only=args.regrade_only,
+                     poll_interval=args.poll_interval, settle_time=args.settle_seconds, profile_path=args.profile,
+                     layout=layout, scanner=scanner)
+        return
+    if args.pipeline:
+        from sheet_pipeline import run_pipeline
+        run_pipeline(args.marking_scheme_path, args.answer_sheet_folder, args.output_folder,
+                     workers=args.workers, io_threads=args.io_threads,
+                     queue_depth=args.queue_depth, reduction=args.pyramid,
+                     cache_path=cache_path, cache_max_bytes=cache_max_bytes, regrade_only=args.regrade_only,
+                     layout=layout, store_path=store_path, shard=shard, item_analysis=item_analysis,
+                     scanner=scanner)
+        summary_file = os.path.join(args.output_folder, summary_name)
+    else:
+        summary_data = grade_folder(args.marking_scheme_path, args.answer_sheet_folder,
+                                    args.output_folder, workers=args.workers, reduction=args.pyramid,
+                                    cache_path=cache_path, cache_max_bytes=cache_max_bytes,
+                                    regrade_only=args.regrade_only, profile_path=args.profile, layout=layout,
+                                    store_path=store_path, duplicates=args.duplicates,
+                                    duplicate_index_path=args.duplicate_index,
+                                    duplicate_distance=args.duplicate_distance, shard=shard,
+                                    item_analysis=item_analysis, scanner=scanner,
+                                    trace_folder=args.trace_folder, trace_sampler=trace_sampler)
+
+        # Save the overall summary as Summary.csv in the output folder
+        if store_path:
+            store = ResultsStore(store_path)
+            try:
+                summary_file = store.export_summary(args.output_folder, summary_name=summary_name)
+            finally:
+                store.close()
+        else:
+            summary_file = save_summary(summary_data, args.output_folder, summary_name)
     print(f"Overall summary saved to {summary_file}")
+    if item_analysis is not None:
+        report = item_analysis.report()
+        print(report.summary())
+        print(f"Item analysis saved to {save_item_analysis(report, args.output_folder)}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,327 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import cv2
+import numpy as np
+
+from grade_core import (
+    decode_image, detect_sheet, select_options, grade_matrix, scheme_selections, parse_marking_scheme,
+    load_marking_scheme, format_marks, answer_confidence, PYRAMID_FACTORS
+)
+from instrumentation import span, profile_sheet, PrometheusExporter
+from scanner_profile import DEFAULT_PROFILE_NAME, load_profile
+from sheet_layout import load_layout, DEFAULT_LAYOUT_NAME
+
+############################################################################
+
+###### Asyncio HTTP grading service ######
+
+# Marking schemes are registered once and kept compiled. Uploaded sheets
+# wait in a queue until a batcher groups them into micro-batches, which run
+# detection in a process pool and are graded together with grade_matrix.
+# Once max_in_flight sheets are accepted but not yet answered, new uploads
+# get 429 Too Many Requests.
+#
+#   PUT  /schemes/<id>          marking scheme CSV as the body
+#   GET  /schemes               registered scheme IDs
+#   POST /grade/<id>?name=...   answer sheet image as the body
+#   GET  /metrics               counters, queue depth and p50/p99 latency
+#   GET  /metrics/prometheus    per-stage timings in Prometheus text format
+#   GET  /health
+
+############################################################################
+
+MAX_BODY_BYTES = 64 * 1024 * 1024
+# Errors after which the rest of the request may still be unread, so the connection is closed
+_CLOSING_STATUSES = (HTTPStatus.BAD_REQUEST, HTTPStatus.LENGTH_REQUIRED, HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+# Number of recent request latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+
+class HttpError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+def detect_batch(images, reduction=1, layout=None, scanner=None):
+    """Worker stage: fill ratios (or an error message) and a stage profile for each image of a micro-batch"""
+    detections = []
+    for file_bytes in images:
+        with profile_sheet(None) as profile:
+            try:
+                with span('decode'):
+                    image = decode_image(file_bytes)
+                if image is None:
+                    raise ValueError("Could not decode the image")
+                _, fill_ratios = detect_sheet(image, reduction, layout=layout, scanner=scanner)
+                detection = (fill_ratios, None)
+            except (ValueError, cv2.error) as e:
+                detection = (None, str(e))
+        detections.append(detection + (profile.as_dict(),))
+    return detections
+
+async def read_request(reader):
+    """Parse one HTTP/1.1 request, returning None at end of stream"""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, target, _ = request_line.decode('latin-1').split()
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    length = headers.get('content-length')
+    if length is None:
+        # Chunked uploads are not supported, so requests with a body must give its length
+        if method.upper() in ('POST', 'PUT'):
+            raise HttpError(HTTPStatus.LENGTH_REQUIRED)
+        length = 0
+    else:
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HttpError(HTTPStatus.BAD_REQUEST, f"Invalid Content-Length {headers['content-length']!r}")
+    if length > MAX_BODY_BYTES:
+        raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target, headers, body
+
+async def write_response(writer, status, payload, keep_alive=True):
+    # Strings are sent as plain text (the Prometheus exposition), everything else as JSON
+    if isinstance(payload, str):
+        body, content_type = payload.encode(), "text/plain; version=0.0.4"
+    else:
+        body, content_type = json.dumps(payload).encode(), "application/json"
+    head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+class GradingService:
+    def __init__(self, workers=1, batch_size=8, batch_window=0.01, max_in_flight=64, reduction=1,
+                 layout=None, scanner=None):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.max_in_flight = max_in_flight
+        self.reduction = reduction
+        self.layout = layout
+        self.scanner = scanner
+        self.schemes = {}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.counters = {'requests': 0, 'graded': 0, 'failed': 0, 'rejected': 0, 'batches': 0, 'batched_sheets': 0}
+        self.in_flight = 0
+        self.stage_metrics = PrometheusExporter()
+        self.pool = None
+        self.queue = None
+        self.batch_slots = None
+
+    def register_scheme(self, scheme_id, marking_scheme):
+        self.schemes[scheme_id] = marking_scheme
+        return {'scheme_id': scheme_id, 'questions': len(marking_scheme), 'fingerprint': marking_scheme.fingerprint()}
+
+    async def submit(self, scheme_id, file_bytes):
+        """Queue one sheet for the next micro-batch and wait for its grade"""
+        if scheme_id not in self.schemes:
+            raise HttpError(HTTPStatus.NOT_FOUND, f"Unknown marking scheme {scheme_id!r}")
+        if self.in_flight >= self.max_in_flight:
+            self.counters['rejected'] += 1
+            raise HttpError(HTTPStatus.TOO_MANY_REQUESTS, "Grading queue is full, retry later")
+
+        # Only accepted sheets count as requests; rejections are counted above
+        self.counters['requests'] += 1
+        self.in_flight += 1
+        try:
+            future = asyncio.get_running_loop().create_future()
+            self.queue.put_nowait((scheme_id, file_bytes, future))
+            return await future
+        finally:
+            self.in_flight -= 1
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # One batch per worker process at a time; the rest wait in the queue
+            await self.batch_slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            asyncio.create_task(self.run_batch(batch))
+
+    async def run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        self.counters['batches'] += 1
+        self.counters['batched_sheets'] += len(batch)
+        try:
+            detections = await loop.run_in_executor(self.pool, detect_batch,
+                                                    [file_bytes for _, file_bytes, _ in batch], self.reduction,
+                                                    self.layout, self.scanner)
+            self.grade_batch(batch, detections)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.batch_slots.release()
+
+    def grade_batch(self, batch, detections):
+        # Grade every scheme's sheets of the batch in one grade_matrix call
+        by_scheme = {}
+        for (scheme_id, _, future), (fill_ratios, error, profile) in zip(batch, detections):
+            self.stage_metrics.export(profile)
+            if error is not None:
+                future.set_result({'success': False, 'error': error})
+            else:
+                by_scheme.setdefault(scheme_id, []).append((future, select_options(fill_ratios),
+                                                            answer_confidence(fill_ratios)))
+
+        for scheme_id, items in by_scheme.items():
+            marking_scheme = self.schemes[scheme_id]
+            selections = scheme_selections(np.stack([options for _, options, _ in items]), marking_scheme)
+            scores, totals = grade_matrix(selections, marking_scheme)
+            for (future, options, confidence), question_scores, total in zip(items, scores, totals):
+                if not future.done():
+                    future.set_result({'success': True, 'total_marks': format_marks(total),
+                                       'options': options.tolist(), 'confidence': confidence.round(3).tolist(),
+                                       'scores': question_scores.tolist()})
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        percentiles = np.percentile(latencies, [50, 99]) if len(latencies) else [0.0, 0.0]
+        batches = self.counters['batches']
+        return dict(self.counters,
+                    in_flight=self.in_flight,
+                    queue_depth=self.queue.qsize(),
+                    mean_batch_size=self.counters['batched_sheets'] / batches if batches else 0.0,
+                    latency_ms={'p50': round(float(percentiles[0]), 2), 'p99': round(float(percentiles[1]), 2)})
+
+    async def route(self, method, target, body):
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        if method == 'GET' and parts == ['health']:
+            return HTTPStatus.OK, {'status': 'ok'}
+        if method == 'GET' and parts == ['metrics']:
+            return HTTPStatus.OK, self.metrics()
+        if method == 'GET' and parts == ['metrics', 'prometheus']:
+            return HTTPStatus.OK, self.stage_metrics.render()
+        if method == 'GET' and parts == ['schemes']:
+            return HTTPStatus.OK, {'schemes': sorted(self.schemes)}
+        if method in ('PUT', 'POST') and len(parts) == 2 and parts[0] == 'schemes':
+            try:
+                marking_scheme = parse_marking_scheme(body.decode('utf-8-sig').splitlines(), self.layout)
+            except (KeyError, ValueError, UnicodeDecodeError) as e:
+                raise HttpError(HTTPStatus.BAD_REQUEST, f"Invalid marking scheme: {e}")
+            return HTTPStatus.CREATED, self.register_scheme(parts[1], marking_scheme)
+        if method == 'POST' and len(parts) == 2 and parts[0] == 'grade':
+            started = time.perf_counter()
+            result = await self.submit(parts[1], body)
+            self.latencies.append(time.perf_counter() - started)
+            self.counters['graded' if result['success'] else 'failed'] += 1
+            name = parse_qs(url.query).get('name', [None])[0]
+            return (HTTPStatus.OK if result['success'] else HTTPStatus.UNPROCESSABLE_ENTITY), dict(result, name=name)
+        raise HttpError(HTTPStatus.NOT_FOUND)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    method, target, headers, body = request
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                    status, payload = await self.route(method, target, body)
+                except HttpError as e:
+                    status, payload, keep_alive = e.status, {'error': str(e)}, e.status not in _CLOSING_STATUSES
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    status, payload, keep_alive = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)}, False
+                await write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        self.queue = asyncio.Queue()
+        self.batch_slots = asyncio.Semaphore(self.workers)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        batcher = asyncio.create_task(self.batcher())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Grading service listening on http://{host}:{port} with {self.workers} worker(s)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.pool.shutdown(cancel_futures=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP service for grading MCQ answer sheets")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on (default: 8080)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Detection worker processes (default: number of CPU cores)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Maximum sheets per micro-batch (default: 8)")
+    parser.add_argument("--batch-window-ms", type=float, default=10.0,
+                        help="How long a micro-batch waits to fill up (default: 10)")
+    parser.add_argument("--max-in-flight", type=int, default=64,
+                        help="Sheets accepted before new uploads get 429 (default: 64)")
+    parser.add_argument("--pyramid", type=int, choices=PYRAMID_FACTORS, default=1,
+                        help="Locate sheets on an image downscaled by this factor")
+    parser.add_argument("--layout", metavar="NAME_OR_PATH",
+                        help=f"Sheet layout file, or the name of one in sheet_layouts/ (default: {DEFAULT_LAYOUT_NAME})")
+    parser.add_argument("--scanner-profile", metavar="NAME_OR_PATH",
+                        help="Edge detection and ink threshold parameters of the scanner, a profile file or the name "
+                             f"of one in scanner_profiles/ written by calibrate.py (default: {DEFAULT_PROFILE_NAME})")
+    parser.add_argument("--scheme", action="append", default=[], metavar="ID=PATH",
+                        help="Register a marking scheme CSV at startup (repeatable)")
+    args = parser.parse_args()
+    try:
+        layout = load_layout(args.layout)
+        scanner = load_profile(args.scanner_profile)
+    except ValueError as e:
+        parser.error(str(e))
+
+    service = GradingService(workers=args.workers, batch_size=args.batch_size,
+                             batch_window=args.batch_window_ms / 1000, max_in_flight=args.max_in_flight,
+                             reduction=args.pyramid, layout=layout, scanner=scanner)
+    for spec in args.scheme:
+        scheme_id, _, path = spec.partition('=')
+        print(service.register_scheme(scheme_id, load_marking_scheme(path, layout)))
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("Grading service stopped")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+############################################################################
+
+###### Per-sheet timing spans and counters ######
+
+# profile_sheet() makes a SheetProfile current for the calling thread, and
+# the span()/count()/set_counter() calls placed in the grading hot path
+# record into it. With no profile active they return immediately, so the
+# instrumentation stays in place at no measurable cost. Finished profiles
+# are plain dicts, handed to an exporter: JsonLinesExporter writes one line
+# per sheet, PrometheusExporter aggregates them into the text format.
+
+############################################################################
+
+# Counters that describe the sheet rather than accumulate across sheets
+GAUGES = {'warped_width', 'warped_height', 'peak_rss_bytes'}
+
+_local = threading.local()
+
+
+class SheetProfile:
+    __slots__ = ('image_name', 'spans', 'counters', 'started', 'total')
+
+    def __init__(self, image_name):
+        self.image_name = image_name
+        self.spans = {}
+        self.counters = {}
+        self.started = time.perf_counter()
+        self.total = None
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+        rss = peak_rss_bytes()
+        if rss is not None:
+            self.counters['peak_rss_bytes'] = rss
+
+    def as_dict(self):
+        return {'image': self.image_name,
+                'total_ms': round(self.total * 1000, 3) if self.total is not None else None,
+                'spans_ms': {name: round(seconds * 1000, 3) for name, seconds in self.spans.items()},
+                'counters': dict(self.counters)}
+
+class _Span:
+    __slots__ = ('profile', 'name', 'started')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        spans = self.profile.spans
+        spans[self.name] = spans.get(self.name, 0.0) + time.perf_counter() - self.started
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+_NULL_SPAN = _NullSpan()
+
+def span(name):
+    """Time a block into the current sheet profile, if any"""
+    profile = getattr(_local, 'profile', None)
+    return _NULL_SPAN if profile is None else _Span(profile, name)
+
+def count(name, value=1):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.counters[name] = profile.counters.get(name, 0) + value
+
+def set_counter(name, value):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.counters[name] = value
+
+@contextmanager
+def profile_sheet(image_name, enabled=True):
+    """Collect spans and counters for one sheet, yielding its SheetProfile (or None when disabled)"""
+    if not enabled:
+        yield None
+        return
+    profile = SheetProfile(image_name)
+    previous = getattr(_local, 'profile', None)
+    _local.profile = profile
+    try:
+        yield profile
+    finally:
+        _local.profile = previous
+        profile.finish()
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class JsonLinesExporter:
+    """Appends one JSON line per sheet profile; safe to share between processes"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, record):
+        # A single O_APPEND write per line, so concurrent workers never interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(record) + '\n').encode())
+        finally:
+            os.close(fd)
+
+class PrometheusExporter:
+    """Aggregates sheet profiles into Prometheus histograms, counters and gauges"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, prefix='mcq_grader'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._sheets = 0
+        self._histograms = {}   # stage -> [bucket counts, sum, count]
+        self._counters = {}
+        self._gauges = {}
+
+    def _observe(self, stage, seconds):
+        histogram = self._histograms.setdefault(stage, [[0] * len(self.BUCKETS), 0.0, 0])
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def export(self, record):
+        with self._lock:
+            self._sheets += 1
+            if record.get('total_ms') is not None:
+                self._observe('total', record['total_ms'] / 1000)
+            for stage, milliseconds in record.get('spans_ms', {}).items():
+                self._observe(stage, milliseconds / 1000)
+            for name, value in record.get('counters', {}).items():
+                if name == 'peak_rss_bytes':
+                    self._gauges[name] = max(self._gauges.get(name, 0), value)
+                elif name in GAUGES:
+                    self._gauges[name] = value
+                else:
+                    self._counters[name] = self._counters.get(name, 0) + value
+
+    def render(self):
+        prefix = self.prefix
+        with self._lock:
+            lines = [f"# HELP {prefix}_sheets_total Sheets profiled",
+                     f"# TYPE {prefix}_sheets_total counter",
+                     f"{prefix}_sheets_total {self._sheets}"]
+            if self._histograms:
+                lines += [f"# HELP {prefix}_stage_seconds Time spent in each grading stage per sheet",
+                          f"# TYPE {prefix}_stage_seconds histogram"]
+                for stage, (buckets, total, observations) in sorted(self._histograms.items()):
+                    for bound, observed in zip(self.BUCKETS, buckets):
+                        lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {observed}')
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {observations}')
+                    lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {round(total, 6)}')
+                    lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {observations}')
+            for name, value in sorted(self._counters.items()):
+                lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+            for name, value in sorted(self._gauges.items()):
+                lines += [f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {value}"]
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='0.0.0.0'):
+        """Serve render() at /metrics from a daemon thread and return the server"""
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+        return server
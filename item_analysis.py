@@ -0,0 +1,276 @@
+import argparse
+import os
+
+import numpy as np
+
+from grade_core import (
+    MarkingScheme, grade_matrix, load_marking_scheme, scheme_selections, write_summary_csv
+)
+from results_store import ResultsStore, RESULTS_FILE_NAME
+
+############################################################################
+
+###### Item analysis of a graded cohort ######
+
+# Examiners want to know which questions are too hard, which ones separate
+# strong from weak students and which distractors nobody falls for. An
+# ItemAnalysis keeps running sums per marking scheme question as sheets are
+# graded: score sums and squares, their products with the total, option
+# counts, and per distinct total score the count and score sums of its
+# sheets. Sheets are added in batches and scored in one grade_matrix call,
+# so a 50k-student cohort is never held in memory or scanned twice. From
+# the sums, report() gives per question:
+#   - difficulty: mean score (the share answering correctly, for questions
+#     without partial credit);
+#   - discrimination index: mean score of the top 27% by total minus that of
+#     the bottom 27% (sheets tied at a group boundary count in proportion);
+#   - item-rest correlation: correlation of the score with the total of the
+#     other questions;
+#   - how many sheets chose each option;
+# and for the cohort the KR-20 reliability (coefficient alpha, with "All"
+# questions giving partial credit).
+
+############################################################################
+
+ITEM_ANALYSIS_FILE_NAME = "ItemAnalysis.csv"
+DEFAULT_BATCH_SIZE = 256
+# Share of the cohort in each of the upper and lower groups of the discrimination index
+EXTREME_GROUP_SHARE = 0.27
+# Questions whose discrimination index is below this are listed for review
+LOW_DISCRIMINATION = 0.2
+
+
+class ItemReport:
+    """Item statistics of a cohort, per marking scheme question in question ID order"""
+    __slots__ = ('question_ids', 'keys', 'conditions', 'sheets', 'mean_total', 'sd_total', 'reliability',
+                 'difficulty', 'discrimination', 'item_rest', 'option_counts')
+
+    def __init__(self, question_ids, keys, conditions, sheets, mean_total, sd_total, reliability, difficulty,
+                 discrimination, item_rest, option_counts):
+        self.question_ids = question_ids
+        self.keys = keys
+        self.conditions = conditions
+        self.sheets = sheets
+        self.mean_total = mean_total
+        self.sd_total = sd_total
+        self.reliability = reliability
+        self.difficulty = difficulty
+        self.discrimination = discrimination
+        self.item_rest = item_rest
+        self.option_counts = option_counts
+
+    @property
+    def columns(self):
+        options = self.option_counts.shape[1] - 1
+        columns = ['Question', 'Key', 'Condition', 'Difficulty', 'Discrimination', 'Item-Rest Correlation']
+        columns += [f"Option {option}" for option in range(1, options + 1)]
+        # Only scheme questions the sheets do not print go unanswered
+        if self.option_counts[:, 0].any():
+            columns.append('Unanswered')
+        return columns
+
+    def rows(self):
+        """One dict per question, with statistics that are undefined (e.g. for no sheets) as None"""
+        def stat(value):
+            return None if np.isnan(value) else round(float(value), 3)
+
+        rows = []
+        for index, question_id in enumerate(self.question_ids.tolist()):
+            row = {'Question': question_id, 'Key': self.keys[index], 'Condition': self.conditions[index],
+                   'Difficulty': stat(self.difficulty[index]), 'Discrimination': stat(self.discrimination[index]),
+                   'Item-Rest Correlation': stat(self.item_rest[index]),
+                   'Unanswered': int(self.option_counts[index, 0])}
+            for option, chosen in enumerate(self.option_counts[index, 1:].tolist(), start=1):
+                row[f"Option {option}"] = chosen
+            rows.append(row)
+        return rows
+
+    def low_discrimination(self, threshold=LOW_DISCRIMINATION):
+        """Question IDs whose discrimination index is below threshold"""
+        return self.question_ids[self.discrimination < threshold].tolist()
+
+    def summary(self):
+        if not self.sheets:
+            return "Item analysis: no graded sheets"
+        reliability = "n/a" if np.isnan(self.reliability) else f"{self.reliability:.3f}"
+        text = (f"Item analysis of {self.sheets} sheet(s): mean {self.mean_total:.2f}/{len(self.question_ids)} "
+                f"(SD {self.sd_total:.2f}), KR-20 reliability {reliability}")
+        low = self.low_discrimination()
+        if low:
+            text += f"\nQuestions discriminating below {LOW_DISCRIMINATION}: {', '.join(map(str, low))}"
+        return text
+
+class ItemAnalysis:
+    """Running item statistics for the sheets of one marking scheme, fed with their detected options"""
+    __slots__ = ('marking_scheme', 'num_options', 'batch_size', 'sheets', '_pending', '_score_sums',
+                 '_score_squares', '_score_totals', '_total_sum', '_total_squares', '_option_counts',
+                 '_group_index', '_group_counts', '_group_scores')
+
+    def __init__(self, marking_scheme, num_options=0, batch_size=DEFAULT_BATCH_SIZE):
+        if not isinstance(marking_scheme, MarkingScheme):
+            marking_scheme = MarkingScheme(marking_scheme)
+        questions = len(marking_scheme.question_ids)
+        # Options beyond num_options (e.g. from another layout) widen the counts when first seen
+        self.num_options = max([int(num_options)]
+                               + [max(entry['correct_answers']) for entry in marking_scheme.values()])
+        self.marking_scheme = marking_scheme
+        self.batch_size = batch_size
+        self.sheets = 0
+        self._pending = []
+        self._score_sums = np.zeros(questions)
+        self._score_squares = np.zeros(questions)
+        self._score_totals = np.zeros(questions)
+        self._total_sum = 0.0
+        self._total_squares = 0.0
+        self._option_counts = np.zeros((questions, self.num_options + 1), dtype=np.int64)
+        # Sheets grouped by total score: {total: group}, and per group the sheet count and score sums
+        self._group_index = {}
+        self._group_counts = np.zeros(0, dtype=np.int64)
+        self._group_scores = np.zeros((0, questions))
+
+    def add(self, options):
+        """Queue the detected options of a sheet (question 1 first), updating the sums a batch at a time"""
+        self._pending.append(np.asarray(options))
+        if len(self._pending) >= self.batch_size:
+            self._update()
+
+    def add_batch(self, options):
+        """Add an (N, questions) matrix of detected options, one row per sheet"""
+        self._update()
+        self._add_matrix(np.atleast_2d(options))
+
+    def _update(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        width = max(len(options) for options in pending)
+        matrix = np.zeros((len(pending), width), dtype=np.int64)
+        for row, options in zip(matrix, pending):
+            row[:len(options)] = options
+        self._add_matrix(matrix)
+
+    def _add_matrix(self, options):
+        if not len(options):
+            return
+        selections = scheme_selections(options, self.marking_scheme)
+        scores, totals = grade_matrix(selections, self.marking_scheme)
+        # Totals are compared as the summaries print them, so float noise does not split tied sheets
+        totals = totals.round(4)
+        self.sheets += len(options)
+        self._score_sums += scores.sum(axis=0)
+        self._score_squares += (scores ** 2).sum(axis=0)
+        self._score_totals += totals @ scores
+        self._total_sum += totals.sum()
+        self._total_squares += totals @ totals
+
+        questions = len(self.marking_scheme.question_ids)
+        width = max(self.num_options, int(selections.max(initial=0)))
+        if width > self.num_options:
+            self._option_counts = np.pad(self._option_counts, ((0, 0), (0, width - self.num_options)))
+            self.num_options = width
+        cells = np.arange(questions) * (width + 1) + selections
+        self._option_counts += np.bincount(cells.ravel(), minlength=questions * (width + 1)).reshape(questions, -1)
+
+        batch_totals, inverse = np.unique(totals, return_inverse=True)
+        new_totals = [total for total in batch_totals.tolist() if total not in self._group_index]
+        if new_totals:
+            for total in new_totals:
+                self._group_index[total] = len(self._group_index)
+            self._group_counts = np.concatenate([self._group_counts, np.zeros(len(new_totals), dtype=np.int64)])
+            self._group_scores = np.vstack([self._group_scores, np.zeros((len(new_totals), questions))])
+        groups = np.array([self._group_index[total] for total in batch_totals.tolist()])[inverse.ravel()]
+        self._group_counts += np.bincount(groups, minlength=len(self._group_counts))
+        np.add.at(self._group_scores, groups, scores)
+
+    def _extreme_group_scores(self, order):
+        """Score sums of the first EXTREME_GROUP_SHARE of sheets taking the groups in order, and the group size"""
+        size = EXTREME_GROUP_SHARE * self.sheets
+        counts = self._group_counts[order]
+        before = np.cumsum(counts) - counts
+        weights = np.clip(size - before, 0, counts) / counts
+        return weights @ self._group_scores[order], size
+
+    def report(self):
+        """ItemReport of every sheet added so far"""
+        self._update()
+        scheme = self.marking_scheme
+        questions = len(scheme.question_ids)
+        entries = [scheme[question_id] for question_id in scheme.question_ids.tolist()]
+        keys = [','.join(map(str, entry['correct_answers'])) for entry in entries]
+        conditions = [entry['condition'] for entry in entries]
+        n = self.sheets
+        with np.errstate(divide='ignore', invalid='ignore'):
+            difficulty = self._score_sums / n
+            item_variance = self._score_squares / n - difficulty ** 2
+            mean_total = self._total_sum / n if n else np.nan
+            total_variance = self._total_squares / n - mean_total ** 2 if n else np.nan
+            covariance = self._score_totals / n - difficulty * mean_total
+            # The rest score is the total without the question itself
+            rest_covariance = covariance - item_variance
+            rest_variance = total_variance - 2 * covariance + item_variance
+            item_rest = rest_covariance / np.sqrt(item_variance * rest_variance)
+            reliability = (questions / (questions - 1) * (1 - item_variance.sum() / total_variance)
+                           if questions > 1 and total_variance > 0 else np.nan)
+            if n:
+                totals = np.array(list(self._group_index))
+                order = np.argsort(totals)
+                upper, size = self._extreme_group_scores(order[::-1])
+                lower, _ = self._extreme_group_scores(order)
+                discrimination = (upper - lower) / size
+            else:
+                discrimination = np.full(questions, np.nan)
+        # Rounding leaves tiny negative variances on constant scores; their correlations are undefined
+        item_rest[(item_variance <= 1e-12) | (rest_variance <= 1e-12)] = np.nan
+        return ItemReport(scheme.question_ids, keys, conditions, n, mean_total,
+                          np.sqrt(max(total_variance, 0)) if n else np.nan, reliability, difficulty,
+                          discrimination, item_rest, self._option_counts.copy())
+
+def analyze_rows(rows, analysis):
+    """Add the options of every graded summary row passing through; rescans flagged as duplicates are left out"""
+    for row in rows:
+        if row.get('options') is not None and not row.get('duplicate_of'):
+            analysis.add(row['options'])
+        yield row
+
+def save_item_analysis(report, output_folder, file_name=ITEM_ANALYSIS_FILE_NAME):
+    """Write the per-question statistics as a CSV and return its path"""
+    item_file = os.path.join(output_folder, file_name)
+    write_summary_csv(item_file, report.rows(), report.columns)
+    return item_file
+
+def analyze_store(store, marking_scheme, run=None):
+    """ItemReport of the graded sheets of a results store run (default: the latest)"""
+    results = [result for result in store.results(run) if result.options is not None and not result.duplicate_of]
+    num_options = max((result.fill_ratios.shape[1] for result in results if result.fill_ratios is not None),
+                      default=0)
+    analysis = ItemAnalysis(marking_scheme, num_options)
+    for result in results:
+        analysis.add(result.options)
+    return analysis.report()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Item analysis of the sheets in an MCQ grader results store")
+    parser.add_argument("store_path", help=f"Results file, or an output folder containing {RESULTS_FILE_NAME}")
+    parser.add_argument("--marking-scheme-path", required=True, help="Marking scheme the sheets were graded with")
+    parser.add_argument("--run", type=int, help="Run to analyse (default: the latest)")
+    parser.add_argument("--output-folder", help=f"Where to write {ITEM_ANALYSIS_FILE_NAME} (default: the store's folder)")
+    args = parser.parse_args(argv)
+
+    store_path = args.store_path
+    if os.path.isdir(store_path):
+        store_path = os.path.join(store_path, RESULTS_FILE_NAME)
+    if not os.path.exists(store_path):
+        parser.error(f"No results store at {store_path}")
+    output_folder = args.output_folder or os.path.dirname(os.path.abspath(store_path))
+    os.makedirs(output_folder, exist_ok=True)
+
+    store = ResultsStore(store_path)
+    try:
+        report = analyze_store(store, load_marking_scheme(args.marking_scheme_path), args.run)
+    finally:
+        store.close()
+    print(report.summary())
+    print(f"Item analysis saved to {save_item_analysis(report, output_folder)}")
+
+if __name__ == "__main__":
+    main()
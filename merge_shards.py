@@ -0,0 +1,169 @@
+import argparse
+import csv
+import os
+import re
+import shutil
+from collections import Counter, defaultdict
+
+from grade_core import write_summary_csv
+from results_store import ResultsStore, RESULTS_FILE_NAME
+from sheet_sources import list_sheet_sources, shard_of, shard_file_name
+
+############################################################################
+
+###### Merging the outputs of sharded grading runs ######
+
+# grade_mcq --shard i/N grades the sheets whose names hash to shard i and
+# writes Summary.shard-i-of-N.csv (and results.shard-i-of-N.sqlite with
+# --results-store) next to the per-sheet CSVs. Merging checks that all N
+# shards ran, that every sheet sits in the shard its name hashes to and,
+# given the answer sheet folder, that every sheet was graded exactly once.
+# It then writes one Summary.csv (in the folder's sheet order, like a single
+# run) and merges the shard stores into a new run of results.sqlite.
+
+############################################################################
+
+_SHARD_SUMMARY = re.compile(r"^Summary\.shard-(\d+)-of-(\d+)\.csv$")
+
+
+def find_shard_summaries(folders):
+    """{shard index: summary path} of the shard summaries in the folders, and the shard count"""
+    found = defaultdict(list)
+    for folder in folders:
+        for file_name in sorted(os.listdir(folder)):
+            match = _SHARD_SUMMARY.match(file_name)
+            if match:
+                found[int(match.group(1)), int(match.group(2))].append(os.path.join(folder, file_name))
+    if not found:
+        raise ValueError(f"No shard summaries (Summary.shard-I-of-N.csv) in {', '.join(folders)}")
+    counts = sorted({count for _, count in found})
+    if len(counts) > 1:
+        raise ValueError(f"Shard summaries of runs split {' and '.join(map(str, counts))} ways; "
+                         "remove the stale ones")
+    count = counts[0]
+    summaries = {}
+    for (index, _), paths in sorted(found.items()):
+        if len(paths) > 1:
+            raise ValueError(f"Shard {index} of {count} has {len(paths)} summaries: {', '.join(paths)}")
+        summaries[index] = paths[0]
+    missing = sorted(set(range(1, count + 1)) - set(summaries))
+    if missing:
+        raise ValueError(f"Missing shard(s) {', '.join(map(str, missing))} of {count}")
+    return summaries, count
+
+def read_shard_rows(summaries, count):
+    """Summary rows of every shard (as text, so grades are written back unchanged), checking their shards"""
+    rows = []
+    for index, summary_path in sorted(summaries.items()):
+        with open(summary_path, newline='') as file:
+            shard_rows = list(csv.DictReader(file))
+        for row in shard_rows:
+            expected = shard_of(row['image_name'], count)
+            if expected != index:
+                raise ValueError(f"{row['image_name']} is in shard {index} of {count} but belongs to shard "
+                                 f"{expected}; was it graded with another shard count?")
+            row['shard'] = index
+            rows.append(row)
+    return rows
+
+def order_like_folder(rows, answer_sheet_folder):
+    """The rows in the folder's sheet order, checking that every sheet was graded exactly once"""
+    expected = [source.name for source in list_sheet_sources(answer_sheet_folder)]
+    graded = Counter(row['image_name'] for row in rows)
+    missing = Counter(expected) - graded
+    extra = graded - Counter(expected)
+    problems = []
+    if missing:
+        problems.append(f"not graded: {', '.join(sorted(missing))}")
+    if extra:
+        problems.append(f"graded more than once or not in {answer_sheet_folder}: {', '.join(sorted(extra))}")
+    if problems:
+        raise ValueError("; ".join(problems))
+    by_name = defaultdict(list)
+    for row in rows:
+        by_name[row['image_name']].append(row)
+    return [by_name[name].pop(0) for name in expected]
+
+def copy_sheet_csvs(rows, summaries, output_folder):
+    """Copy the per-sheet CSVs of shards written elsewhere into the output folder, returning how many"""
+    copied = 0
+    for row in rows:
+        shard_folder = os.path.dirname(summaries[row['shard']])
+        if os.path.abspath(shard_folder) == os.path.abspath(output_folder):
+            continue
+        csv_name = f"{os.path.splitext(row['image_name'])[0]}_graded.csv"
+        if os.path.exists(os.path.join(shard_folder, csv_name)):
+            shutil.copyfile(os.path.join(shard_folder, csv_name), os.path.join(output_folder, csv_name))
+            copied += 1
+    return copied
+
+def merge_stores(summaries, count, output_folder, rows):
+    """Copy the shard stores into a new run of the output folder's store, in the order of the merged rows; returns
+    it, or None without stores"""
+    store_paths = [os.path.join(os.path.dirname(path), shard_file_name(RESULTS_FILE_NAME, (index, count)))
+                   for index, path in sorted(summaries.items())]
+    present = [os.path.exists(store_path) for store_path in store_paths]
+    if not any(present):
+        return None
+    if not all(present):
+        raise ValueError("Only some shards wrote a results store: "
+                         + ", ".join(path for path, exists in zip(store_paths, present) if not exists) + " missing")
+    positions = {row['image_name']: position for position, row in enumerate(rows)}
+    store = ResultsStore(os.path.join(output_folder, RESULTS_FILE_NAME))
+    try:
+        for store_path in store_paths:
+            shard_store = ResultsStore(store_path)
+            try:
+                for result in shard_store.results():
+                    store.add_result(result, positions.get(result.image_name, len(positions)))
+            finally:
+                shard_store.close()
+    except BaseException:
+        store.close()
+        raise
+    return store
+
+def merge_shards(output_folder, shard_folders=None, answer_sheet_folder=None):
+    """Combine the outputs of every shard into Summary.csv (and results.sqlite), returning the summary path"""
+    summaries, count = find_shard_summaries(shard_folders or [output_folder])
+    rows = read_shard_rows(summaries, count)
+    if answer_sheet_folder:
+        rows = order_like_folder(rows, answer_sheet_folder)
+    else:
+        rows.sort(key=lambda row: row['image_name'])
+    os.makedirs(output_folder, exist_ok=True)
+    copied = copy_sheet_csvs(rows, summaries, output_folder)
+    if copied:
+        print(f"Copied {copied} graded sheet CSV(s) to {output_folder}")
+
+    store = merge_stores(summaries, count, output_folder, rows)
+    if store is not None:
+        try:
+            # Like a single --results-store run, Summary.csv comes from the store
+            print(f"Merged {len(rows)} sheet(s) from {count} shard stores into run {store.run} of {store.path}")
+            return store.export_summary(output_folder)
+        finally:
+            store.close()
+    columns = ['image_name', 'grade']
+    columns += [column for column in ('error', 'duplicate_of') if any(row.get(column) for row in rows)]
+    summary_file = os.path.join(output_folder, "Summary.csv")
+    write_summary_csv(summary_file, rows, columns)
+    return summary_file
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="grade_mcq merge",
+                                     description="Combine the outputs of grade_mcq --shard runs into one Summary.csv")
+    parser.add_argument("shard_folders", nargs="*", metavar="SHARD_FOLDER",
+                        help="Output folders of the shards (default: the output folder)")
+    parser.add_argument("--output-folder", required=True, help="Folder to write the merged Summary.csv to")
+    parser.add_argument("--answer-sheet-folder",
+                        help="The graded folder: check every sheet in it was graded exactly once and keep its order")
+    args = parser.parse_args(argv)
+    try:
+        summary_file = merge_shards(args.output_folder, args.shard_folders, args.answer_sheet_folder)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Overall summary saved to {summary_file}")
+
+if __name__ == "__main__":
+    main()
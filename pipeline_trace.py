@@ -0,0 +1,296 @@
+import argparse
+import hashlib
+import os
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from sheet_layout import layout_geometry
+
+############################################################################
+
+###### Sampled visual traces of the detection pipeline ######
+
+# trace_sheet() makes a SheetTrace current for the calling thread, and the
+# detection functions hand it their intermediate images as they go: the
+# gray and edge images, the chosen contour, the sampled sheet, the bubble
+# thresholds (with the Otsu level of every escalated box) and the option
+# cells coloured by the tier that decided them. With no trace active the
+# capture points cost one attribute lookup and allocate nothing, so they
+# stay in the real grading path. A TraceSampler picks the sheets to trace:
+# a stable share of them by name, and those that fail or read an answer
+# with low confidence (detected again under a trace, since the scratch
+# buffers are gone by then). A TraceWriter renders each trace into one
+# contact sheet image and writes it on a background thread.
+
+############################################################################
+
+TRACE_FOLDER_NAME = "traces"
+# Sheets with an answer less confident than this (see answer_confidence) are traced
+DEFAULT_TRACE_CONFIDENCE = 0.5
+# Height of every image in a contact sheet, and images per row
+TILE_HEIGHT = 480
+TILE_COLUMNS = 3
+DEFAULT_QUEUE_DEPTH = 8
+
+# Cell outline colours (BGR) by the tier that decided the question
+TIER_COLORS = {'sparse': (0, 160, 0), 'otsu': (0, 140, 255), 'dense': (0, 0, 255)}
+
+_local = threading.local()
+
+
+class SheetTrace:
+    """Downscaled copies of the intermediate images of one sheet, and what was decided from them"""
+    __slots__ = ('image_name', 'tiles', 'contour', 'corners', 'cell_rects', 'fill_ratios', 'escalated',
+                 'otsu_levels', 'dense', 'grade', 'error')
+
+    def __init__(self, image_name):
+        self.image_name = image_name
+        self.tiles = {}             # label -> (image, scale from the original)
+        self.contour = None         # largest contour and its polygon, in the coordinates of the 'gray' image
+        self.corners = None
+        self.cell_rects = None      # option cells in the coordinates of the 'sample' image
+        self.fill_ratios = None
+        self.escalated = None       # questions the sparse pass did not decide
+        self.otsu_levels = []       # threshold chosen for each of them
+        self.dense = None           # questions re-read at full density
+        self.grade = None
+        self.error = None
+
+    def add_image(self, label, image):
+        """Keep a copy of image no taller than TILE_HEIGHT (the original is a scratch buffer reused later)"""
+        height, width = image.shape[:2]
+        scale = min(1.0, TILE_HEIGHT / height)
+        if scale < 1:
+            tile = cv2.resize(image, (max(1, round(width * scale)), TILE_HEIGHT), interpolation=cv2.INTER_AREA)
+        else:
+            tile = image.copy()
+        self.tiles[label] = (tile, scale)
+
+    def add_contour(self, contour, corners):
+        self.contour, self.corners = contour, corners.reshape(-1, 2)
+
+    def add_sample(self, sample, thresh, layout, fill_ratios):
+        """The sampled sheet, its thresholded bubbles and the option cells read from it"""
+        self.add_image('sample', sample.pixels)
+        self.add_image('threshold', thresh * 255)
+        self.cell_rects = -(-layout_geometry(layout, *sample.sheet_size).cell_rects // sample.stride)
+        self.fill_ratios = fill_ratios
+
+class _Tracing:
+    __slots__ = ('trace', 'previous')
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'trace', None)
+        _local.trace = self.trace
+        return self.trace
+
+    def __exit__(self, *exc_info):
+        _local.trace = self.previous
+
+class _NotTracing:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return None
+
+_NOT_TRACING = _NotTracing()
+
+def trace_sheet(image_name, enabled=True):
+    """Make a new SheetTrace current for the calling thread, yielding it (or None when disabled)"""
+    return _Tracing(SheetTrace(image_name)) if enabled else _NOT_TRACING
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+class TraceSampler:
+    """Which sheets to trace: rate of them, chosen by a stable hash of their names, and with confidence > 0 also
+    every sheet that fails or has an answer less confident than confidence"""
+    __slots__ = ('rate', 'confidence')
+
+    def __init__(self, rate=0.0, confidence=DEFAULT_TRACE_CONFIDENCE):
+        if not 0 <= rate <= 1:
+            raise ValueError(f"The trace rate must be between 0 and 1, not {rate}")
+        if not 0 <= confidence <= 1:
+            raise ValueError(f"The trace confidence must be between 0 and 1, not {confidence}")
+        self.rate = rate
+        self.confidence = confidence
+
+    def sampled(self, image_name):
+        """Whether to trace a sheet from the start, the same on every machine and in every worker"""
+        if self.rate <= 0:
+            return False
+        return int.from_bytes(hashlib.sha256(image_name.encode()).digest()[:8], 'big') < self.rate * 2 ** 64
+
+    def wants(self, least_confidence):
+        """Whether to trace a sheet after it was graded; least_confidence is None when it failed"""
+        return self.confidence > 0 and (least_confidence is None or least_confidence < self.confidence)
+
+def trace_path(folder, image_name):
+    return os.path.join(folder, f"{os.path.splitext(image_name)[0]}_trace.png")
+
+def _as_color(image):
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image.copy()
+
+def _labelled(label, image):
+    """An image scaled to TILE_HEIGHT with its label in a bar above it"""
+    height, width = image.shape[:2]
+    tile = cv2.resize(image, (max(1, round(width * TILE_HEIGHT / height)), TILE_HEIGHT),
+                      interpolation=cv2.INTER_NEAREST) if height != TILE_HEIGHT else image
+    bar = np.zeros((24, tile.shape[1], 3), dtype=np.uint8)
+    cv2.putText(bar, label, (6, 17), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+    return np.vstack([bar, tile])
+
+def trace_tiles(trace):
+    """The labelled images of a contact sheet, in pipeline order"""
+    tiles = []
+    if 'gray' in trace.tiles:
+        gray, scale = trace.tiles['gray']
+        tiles.append(('gray', _as_color(gray)))
+        if 'canny' in trace.tiles:
+            tiles.append(('canny', _as_color(trace.tiles['canny'][0])))
+        if trace.contour is not None:
+            contour = _as_color(gray)
+            cv2.drawContours(contour, [np.rint(trace.contour * scale).astype(np.int32)], -1, (0, 200, 0), 2)
+            polygon = np.rint(trace.corners * scale).astype(np.int32)
+            # The polygon is red unless it has the four corners of a sheet
+            color = (255, 0, 0) if len(polygon) == 4 else (0, 0, 255)
+            cv2.polylines(contour, [polygon], True, color, 2)
+            for x, y in polygon:
+                cv2.circle(contour, (int(x), int(y)), 5, color, -1)
+            tiles.append((f'contour ({len(polygon)} corners)', contour))
+    if 'sample' in trace.tiles:
+        sample, scale = trace.tiles['sample']
+        threshold = _as_color(trace.tiles['threshold'][0])
+        cells = _as_color(sample)
+        rects = np.rint(trace.cell_rects * scale).astype(np.int32)
+        tiers = np.full(len(rects), 'sparse', dtype=object)
+        if trace.escalated is not None:
+            tiers[trace.escalated] = 'otsu'
+            tiers[trace.dense] = 'dense'
+            for question, level in zip(trace.escalated, trace.otsu_levels):
+                x0, y0 = rects[question, :, :2].min(axis=0)
+                x1, y1 = rects[question, :, 2:].max(axis=0)
+                cv2.rectangle(threshold, (int(x0), int(y0)), (int(x1), int(y1)), TIER_COLORS['otsu'], 1)
+                cv2.putText(threshold, str(int(level)), (int(x0), int(y0) - 2), cv2.FONT_HERSHEY_SIMPLEX, 0.3,
+                            TIER_COLORS['otsu'], 1, cv2.LINE_AA)
+        selected = np.argmax(trace.fill_ratios, axis=1)
+        for question, question_rects in enumerate(rects):
+            color = TIER_COLORS[tiers[question]]
+            for option, (x0, y0, x1, y1) in enumerate(question_rects):
+                cv2.rectangle(cells, (int(x0), int(y0)), (int(x1) - 1, int(y1) - 1), color,
+                              2 if option == selected[question] else 1)
+        tiles += [('sample', _as_color(sample)), ('threshold, Otsu level of escalated boxes', threshold),
+                  ('cells: sparse / otsu / dense, selected thick', cells)]
+    return tiles
+
+def trace_header(trace):
+    lines = [trace.image_name]
+    if trace.error:
+        lines.append(f"error: {trace.error}")
+    elif trace.grade is not None:
+        lines.append(f"grade: {trace.grade}")
+    if trace.fill_ratios is not None:
+        escalated = 0 if trace.escalated is None else len(trace.escalated)
+        dense = 0 if trace.dense is None else len(trace.dense)
+        top_two = np.sort(trace.fill_ratios, axis=1)[:, -2:]
+        lead = np.min(top_two[:, -1] - top_two[:, 0]) if top_two.shape[1] > 1 else np.min(top_two)
+        lines.append(f"{len(trace.fill_ratios)} questions, {escalated} escalated, {dense} re-read at full density, "
+                     f"closest lead {lead:.4f}")
+    return lines
+
+def contact_sheet(trace):
+    """One image of a trace: a header and its labelled images, TILE_COLUMNS to a row"""
+    tiles = [_labelled(label, image) for label, image in trace_tiles(trace)]
+    rows = [np.hstack(tiles[i:i + TILE_COLUMNS]) for i in range(0, len(tiles), TILE_COLUMNS)]
+    width = max([row.shape[1] for row in rows] + [640])
+    lines = trace_header(trace)
+    header = np.zeros((12 + 22 * len(lines), width, 3), dtype=np.uint8)
+    for i, line in enumerate(lines):
+        cv2.putText(header, line, (8, 26 + 22 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1, cv2.LINE_AA)
+    padded = [np.pad(row, ((0, 0), (0, width - row.shape[1]), (0, 0))) for row in rows]
+    return np.vstack([header] + padded)
+
+def write_trace(trace, folder):
+    path = trace_path(folder, trace.image_name)
+    ok, encoded = cv2.imencode('.png', contact_sheet(trace))
+    if not ok:
+        raise ValueError("Could not encode the contact sheet")
+    with open(path, 'wb') as file:
+        file.write(encoded.tobytes())
+    return path
+
+class TraceWriter:
+    """Renders and writes SheetTraces as contact sheets on a background thread"""
+
+    def __init__(self, folder, queue_depth=DEFAULT_QUEUE_DEPTH):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.written = 0
+        # Bounded, so grading waits for the writer rather than piling up traces in memory
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, trace):
+        self._queue.put(trace)
+
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            if trace is None:
+                return
+            try:
+                write_trace(trace, self.folder)
+                self.written += 1
+            except (OSError, ValueError, cv2.error) as e:
+                print(f"Could not write the trace of {trace.image_name}: {e}")
+
+    def close(self):
+        """Write the traces still queued and stop the thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+def main(argv=None):
+    from grade_mcq import trace_answer_sheet
+    from grade_core import PYRAMID_FACTORS
+    from scanner_profile import load_profile
+    from sheet_layout import load_layout
+    from sheet_sources import file_sheet_sources
+
+    parser = argparse.ArgumentParser(prog="grade_mcq trace",
+                                     description="Write contact sheets of the intermediate images of some sheets")
+    parser.add_argument("images", nargs="+", metavar="IMAGE", help="Sheet images, multi-page TIFFs or ZIP archives")
+    parser.add_argument("--output-folder", default=TRACE_FOLDER_NAME,
+                        help="Folder to write the contact sheets to (default: %(default)s)")
+    parser.add_argument("--pyramid", type=int, choices=PYRAMID_FACTORS, default=1,
+                        help="Locate the sheet on an image downscaled by this factor, as grade_mcq --pyramid")
+    parser.add_argument("--layout", metavar="NAME_OR_PATH", help="Sheet layout, a file or a name in sheet_layouts/")
+    parser.add_argument("--scanner-profile", metavar="NAME_OR_PATH",
+                        help="Scanner profile, a file or a name in scanner_profiles/")
+    args = parser.parse_args(argv)
+    try:
+        layout = load_layout(args.layout)
+        scanner = load_profile(args.scanner_profile)
+    except ValueError as e:
+        parser.error(str(e))
+
+    writer = TraceWriter(args.output_folder)
+    try:
+        for image in args.images:
+            for source in file_sheet_sources(image):
+                writer.submit(trace_answer_sheet(source, args.pyramid, layout, scanner))
+    finally:
+        writer.close()
+    print(f"Wrote {writer.written} contact sheet(s) to {args.output_folder}")
+
+if __name__ == "__main__":
+    main()
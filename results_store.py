@@ -0,0 +1,246 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from grade_core import write_results_csv, write_summary_csv
+
+############################################################################
+
+###### Append-only SQLite store of graded sheets ######
+
+# One row per graded sheet holds its grade or error (and the sheet it
+# duplicates, when duplicate detection flagged it) together with the
+# detected options, fill ratios, marking scheme question IDs, scores and
+# answer confidences, packed as NumPy arrays. Rows are buffered and written in batches, one
+# transaction per batch, instead of one CSV file per sheet. A crash loses at
+# most the unflushed batch (batch_size rows or flush_interval seconds).
+# Every grading run gets a new run number; re-grading a sheet appends a new
+# row, and Summary.csv and the per-sheet CSVs are exported on demand from
+# the latest row of each sheet. Each row also keeps the sheet's position in
+# the run's source order, so exports list the sheets in that order even when
+# they were graded out of order.
+
+############################################################################
+
+RESULTS_FILE_NAME = "results.sqlite"
+DEFAULT_BATCH_SIZE = 256
+# Pending rows are flushed at least this often (seconds), so slow runs lose little on a crash
+FLUSH_INTERVAL = 5.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheets (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    run INTEGER NOT NULL,
+    image_name TEXT NOT NULL,
+    grade NUMERIC,
+    error TEXT,
+    num_questions INTEGER NOT NULL,
+    num_options INTEGER NOT NULL,
+    options BLOB,
+    fill_ratios BLOB,
+    question_ids BLOB,
+    scores BLOB,
+    graded_at REAL NOT NULL,
+    duplicate_of TEXT,
+    confidence BLOB,
+    position INTEGER
+);
+CREATE INDEX IF NOT EXISTS sheets_run_image ON sheets (run, image_name, seq);
+"""
+
+# Latest row of every sheet graded in a run, in source order (rows of older stores have no position and keep
+# the order they were written in)
+_LATEST = ("SELECT {columns} FROM sheets WHERE seq IN "
+           "(SELECT MAX(seq) FROM sheets WHERE run = ? GROUP BY image_name) ORDER BY position, seq")
+
+
+class SheetResult:
+    __slots__ = ('image_name', 'grade', 'error', 'options', 'fill_ratios', 'question_ids', 'scores',
+                 'duplicate_of', 'confidence')
+
+    def __init__(self, image_name, grade, error, options, fill_ratios, question_ids, scores, duplicate_of=None,
+                 confidence=None):
+        self.image_name = image_name
+        self.grade = grade
+        self.error = error
+        self.options = options
+        self.fill_ratios = fill_ratios
+        self.question_ids = question_ids
+        self.scores = scores
+        self.duplicate_of = duplicate_of
+        self.confidence = confidence
+
+def _pack_row(run, row, position):
+    fill_ratios = row.get('fill_ratios')
+    num_questions, num_options = (0, 0) if fill_ratios is None else np.shape(fill_ratios)
+
+    def blob(key, dtype):
+        return None if row.get(key) is None else np.asarray(row[key], dtype=dtype).tobytes()
+
+    grade = None if row['error'] or row['grade'] == '' else row['grade']
+    return (run, row['image_name'], grade, row['error'] or None,
+            num_questions, num_options, blob('options', np.int8), blob('fill_ratios', np.float32),
+            blob('question_ids', np.int32), blob('scores', np.float64), time.time(), row.get('duplicate_of'),
+            blob('confidence', np.float32), position)
+
+def _unpack_row(image_name, grade, error, num_questions, num_options, options, fill_ratios, question_ids, scores,
+                duplicate_of, confidence):
+    def array(data, dtype):
+        return None if data is None else np.frombuffer(data, dtype=dtype)
+
+    fill_ratios = array(fill_ratios, np.float32)
+    return SheetResult(image_name, grade, error, array(options, np.int8),
+                       None if fill_ratios is None else fill_ratios.reshape(num_questions, num_options),
+                       array(question_ids, np.int32), array(scores, np.float64), duplicate_of,
+                       array(confidence, np.float32))
+
+class ResultsStore:
+    """Batched writer and exporter for the results database, safe to share between threads"""
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(sheets)")]
+        # Stores written before duplicate detection, answer confidences and source positions existed
+        for column, column_type in (('duplicate_of', 'TEXT'), ('confidence', 'BLOB'), ('position', 'INTEGER')):
+            if column not in columns:
+                with self._connection:
+                    self._connection.execute(f"ALTER TABLE sheets ADD COLUMN {column} {column_type}")
+        self.run = None
+        self._added = 0
+
+    def latest_run(self):
+        with self._lock:
+            return self._connection.execute("SELECT MAX(run) FROM sheets").fetchone()[0]
+
+    def add(self, row, position=None):
+        """Queue a summary row (image_name, grade, error and optionally the sheet's arrays) for writing.
+        position is the sheet's place in the run's source order, by default the order rows are added in."""
+        with self._lock:
+            if self.run is None:
+                # Writing starts a new run
+                latest = self._connection.execute("SELECT MAX(run) FROM sheets").fetchone()[0]
+                self.run = (latest or 0) + 1
+            self._pending.append(_pack_row(self.run, row, self._added if position is None else position))
+            self._added += 1
+            if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def add_result(self, result, position=None):
+        """Queue a SheetResult read from another store, e.g. when merging the stores of sharded runs"""
+        self.add({'image_name': result.image_name, 'grade': result.grade, 'error': result.error,
+                  'options': result.options, 'fill_ratios': result.fill_ratios,
+                  'question_ids': result.question_ids, 'scores': result.scores,
+                  'duplicate_of': result.duplicate_of, 'confidence': result.confidence}, position)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT INTO sheets (run, image_name, grade, error, num_questions, num_options, options, "
+                    "fill_ratios, question_ids, scores, graded_at, duplicate_of, confidence, position) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    self._pending)
+            self._pending = []
+        self._last_flush = time.monotonic()
+
+    def results(self, run=None):
+        """SheetResult of every sheet of a run (default: the latest), in source order"""
+        if run is None:
+            run = self.run if self.run is not None else self.latest_run()
+        query = _LATEST.format(columns="image_name, grade, error, num_questions, num_options, options, "
+                                       "fill_ratios, question_ids, scores, duplicate_of, confidence")
+        with self._lock:
+            self._flush()
+            rows = self._connection.execute(query, (run,)).fetchall()
+        return [_unpack_row(*row) for row in rows]
+
+    def export_summary(self, output_folder, run=None, summary_name="Summary.csv"):
+        """Write Summary.csv (or summary_name) for a run and return its path"""
+        results = self.results(run)
+        columns = ['image_name', 'grade']
+        if any(result.error for result in results):
+            columns.append('error')
+        if any(result.duplicate_of for result in results):
+            columns.append('duplicate_of')
+        summary_file = os.path.join(output_folder, summary_name)
+        write_summary_csv(summary_file, [{'image_name': result.image_name,
+                                          'grade': '' if result.error or result.grade is None else result.grade,
+                                          'error': result.error, 'duplicate_of': result.duplicate_of}
+                                         for result in results], columns)
+        return summary_file
+
+    def export_sheets(self, output_folder, run=None, image_names=None):
+        """Write <image>_graded.csv for the graded sheets of a run, returning how many were written"""
+        written = 0
+        for result in self.results(run):
+            if result.scores is None or (image_names and result.image_name not in image_names):
+                continue
+            confidence = None if result.confidence is None else result.confidence.round(3)
+            output_file = os.path.join(output_folder, f"{os.path.splitext(result.image_name)[0]}_graded.csv")
+            write_results_csv(output_file, result.question_ids, result.scores, confidence)
+            written += 1
+        return written
+
+    def stats(self):
+        with self._lock:
+            self._flush()
+            runs, rows, sheets = self._connection.execute(
+                "SELECT COUNT(DISTINCT run), COUNT(*), COUNT(DISTINCT image_name) FROM sheets").fetchone()
+        return {'runs': runs, 'rows': rows, 'sheets': sheets, 'latest_run': self.latest_run(),
+                'bytes': os.path.getsize(self.path)}
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._connection.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export CSVs from the MCQ grader results store")
+    parser.add_argument("store_path", help=f"Results file, or an output folder containing {RESULTS_FILE_NAME}")
+    parser.add_argument("command", choices=["stats", "summary", "sheets"],
+                        help="stats: runs and sheets stored; summary: write Summary.csv; "
+                             "sheets: write the per-sheet <image>_graded.csv files")
+    parser.add_argument("images", nargs="*", help="Only export these sheets (with sheets)")
+    parser.add_argument("--run", type=int, help="Run to export (default: the latest)")
+    parser.add_argument("--output-folder", help="Where to write the CSVs (default: the store's folder)")
+    args = parser.parse_args()
+
+    store_path = args.store_path
+    if os.path.isdir(store_path):
+        store_path = os.path.join(store_path, RESULTS_FILE_NAME)
+    if not os.path.exists(store_path):
+        parser.error(f"No results store at {store_path}")
+    output_folder = args.output_folder or os.path.dirname(os.path.abspath(store_path))
+    os.makedirs(output_folder, exist_ok=True)
+
+    store = ResultsStore(store_path)
+    try:
+        if args.command == "stats":
+            print(store.stats())
+        elif args.command == "summary":
+            print(f"Summary saved to {store.export_summary(output_folder, args.run)}")
+        else:
+            written = store.export_sheets(output_folder, args.run, set(args.images) or None)
+            print(f"Wrote {written} graded sheet CSV(s) to {output_folder}")
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+
+############################################################################
+
+###### Per-scanner detection parameters ######
+
+# Scanners differ in sharpness, contrast and how dark they render paper, so
+# the constants that locate a sheet (the Gaussian blur, the Canny thresholds
+# and the approxPolyDP epsilon) and the gray level below which a pixel
+# counts as ink live in a scanner profile. The default profile holds the
+# values the grader has always used; calibrate.py searches for better ones
+# against ground truth and saves them as JSON files in scanner_profiles/.
+# Bubble positions and widths come from the sheet layout, not the scanner.
+
+############################################################################
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scanner_profiles")
+DEFAULT_PROFILE_NAME = "default"
+# Tunable parameters, in the order they are reported
+PARAMETERS = ('blur_kernel', 'canny_low', 'canny_high', 'poly_epsilon', 'dark_threshold')
+
+
+class ScannerProfile:
+    __slots__ = ('name', 'blur_kernel', 'canny_low', 'canny_high', 'poly_epsilon', 'dark_threshold', '_key')
+
+    def __init__(self, name, blur_kernel=5, canny_low=50, canny_high=150, poly_epsilon=0.02, dark_threshold=150):
+        if blur_kernel < 1 or blur_kernel % 2 == 0:
+            raise ValueError(f"Profile {name!r} blur_kernel must be an odd number of pixels")
+        if not 0 <= canny_low < canny_high:
+            raise ValueError(f"Profile {name!r} needs 0 <= canny_low < canny_high")
+        if not 0 < poly_epsilon < 1:
+            raise ValueError(f"Profile {name!r} poly_epsilon must be a fraction of the sheet outline's perimeter")
+        if not 0 < dark_threshold < 255:
+            raise ValueError(f"Profile {name!r} dark_threshold must be a gray level between 0 and 255")
+        self.name = name
+        self.blur_kernel = int(blur_kernel)                 # Gaussian blur before edge detection (odd, pixels)
+        self.canny_low = int(canny_low)                     # Canny hysteresis thresholds
+        self.canny_high = int(canny_high)
+        self.poly_epsilon = float(poly_epsilon)             # approxPolyDP tolerance, as a fraction of the perimeter
+        self.dark_threshold = int(dark_threshold)           # gray levels below this are ink
+        # Only the parameters identify a profile; a renamed copy detects the same
+        self._key = json.dumps(self.params(), sort_keys=True)
+
+    @classmethod
+    def from_dict(cls, spec):
+        try:
+            return cls(spec['name'], **{parameter: spec[parameter] for parameter in PARAMETERS if parameter in spec})
+        except KeyError as e:
+            raise ValueError(f"Scanner profile is missing {e}")
+        except TypeError as e:
+            raise ValueError(f"Scanner profile has a malformed value: {e}")
+
+    def params(self):
+        return {parameter: getattr(self, parameter) for parameter in PARAMETERS}
+
+    def to_dict(self):
+        return dict(name=self.name, **self.params())
+
+    def replace(self, name=None, **params):
+        """A copy with some parameters (and the name) changed"""
+        return ScannerProfile(name or self.name, **dict(self.params(), **params))
+
+    def fingerprint(self):
+        return hashlib.sha256(self._key.encode()).hexdigest()[:16]
+
+    def __eq__(self, other):
+        return isinstance(other, ScannerProfile) and self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        return f"ScannerProfile({self.name!r}, {', '.join(f'{k}={v}' for k, v in self.params().items())})"
+
+DEFAULT_PROFILE = ScannerProfile(DEFAULT_PROFILE_NAME)
+
+def available_profiles():
+    names = {DEFAULT_PROFILE_NAME}
+    if os.path.isdir(PROFILE_DIR):
+        names.update(os.path.splitext(f)[0] for f in os.listdir(PROFILE_DIR) if f.endswith('.json'))
+    return sorted(names)
+
+def profile_path(name):
+    return os.path.join(PROFILE_DIR, f"{name}.json")
+
+def load_profile(name_or_path=None):
+    """Profile from a file path or a name in scanner_profiles/; None gives the default profile"""
+    if name_or_path is None:
+        return DEFAULT_PROFILE
+    if name_or_path == DEFAULT_PROFILE_NAME and not os.path.isfile(profile_path(name_or_path)):
+        return DEFAULT_PROFILE
+    path = name_or_path if os.path.isfile(name_or_path) else profile_path(name_or_path)
+    if not os.path.isfile(path):
+        raise ValueError(f"Unknown scanner profile {name_or_path!r} (available: {', '.join(available_profiles())})")
+    with open(path) as file:
+        try:
+            return ScannerProfile.from_dict(json.load(file))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Could not read scanner profile {path}: {e}")
+
+def save_profile(profile, path=None):
+    """Write a profile as JSON (by default scanner_profiles/<name>.json) and return the path"""
+    path = path or profile_path(profile.name)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(profile.to_dict(), file, indent=2)
+        file.write('\n')
+    return path
@@ -0,0 +1,59 @@
+import threading
+
+import numpy as np
+
+from instrumentation import count
+
+############################################################################
+
+###### Reusable scratch buffers for sheet detection ######
+
+# Locating and sampling a sheet needs several full-size temporaries (the
+# gray, edge, sampled and thresholded images). A SheetBuffers hands them out
+# as views of byte arenas that it keeps between sheets, so OpenCV writes into
+# memory that is already mapped instead of allocating and freeing megabytes
+# per sheet. Scans rarely share an exact size, so an arena only grows (with
+# some headroom) when a sheet needs more than it holds. Each thread detects
+# with its own SheetBuffers (thread_buffers()); arrays handed out are only
+# valid until the same name is asked for again, so they never leave the
+# detection functions.
+
+############################################################################
+
+# Spare capacity given to a growing arena, so slightly larger sheets that follow still fit
+GROWTH_HEADROOM = 0.125
+
+_local = threading.local()
+
+
+class SheetBuffers:
+    """Named scratch arrays, reused from sheet to sheet"""
+    __slots__ = ('_arenas',)
+
+    def __init__(self):
+        self._arenas = {}
+
+    def get(self, name, shape, dtype=np.uint8):
+        """C-contiguous array of this shape, overwriting whatever the name held before"""
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        arena = self._arenas.get(name)
+        if arena is None or arena.size < size:
+            count('buffer_allocations')
+            arena = self._arenas[name] = np.empty(int(size * (1 + GROWTH_HEADROOM)), dtype=np.uint8)
+        return arena[:size].view(dtype).reshape(shape)
+
+    @property
+    def nbytes(self):
+        return sum(arena.nbytes for arena in self._arenas.values())
+
+def scratch(buffers, name, shape, dtype=np.uint8):
+    """A scratch array from buffers, or None (so OpenCV allocates the output) without them"""
+    return None if buffers is None else buffers.get(name, shape, dtype)
+
+def thread_buffers():
+    """The calling thread's SheetBuffers"""
+    buffers = getattr(_local, 'buffers', None)
+    if buffers is None:
+        buffers = _local.buffers = SheetBuffers()
+    return buffers
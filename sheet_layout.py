@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+############################################################################
+
+###### Declarative answer sheet layouts ######
+
+# A layout describes the bubble grid of the upright sheet: how many
+# questions, how many columns they are printed in (numbered down each column
+# first), the options per question and how many of them are answer choices
+# (slots past those are ignored in grading), how many leading strips of each
+# question box hold its number, the margins around the grid as fractions of
+# the sheet, and the bubble shape. Layouts live as JSON (or YAML, when PyYAML is
+# installed) files in sheet_layouts/.
+#
+# For a given sheet size a layout compiles once into rectangles and pixel
+# masks, kept in LRU caches keyed by (layout, size), so every sheet of that
+# size reuses the same arrays.
+
+############################################################################
+
+LAYOUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sheet_layouts")
+DEFAULT_LAYOUT_NAME = "standard-50"
+BUBBLE_SHAPES = ('strip', 'circle')
+
+# Sheet sizes are rounded to a multiple of this, so scans of similar resolution share compiled indexes
+SIZE_STEP = 16
+# Compiled layouts kept per process
+CACHE_SIZE = 32
+
+
+class SheetLayout:
+    def __init__(self, name, questions, columns, options, label_strips=1, margins=(0, 0, 0, 0), bubble=None,
+                 answer_options=None):
+        bubble = dict(bubble or {'shape': 'strip'})
+        if questions < 1 or columns < 1 or options < 1 or label_strips < 0:
+            raise ValueError(f"Layout {name!r} needs at least one question, column and option")
+        if answer_options is not None and not 1 <= answer_options <= options:
+            raise ValueError(f"Layout {name!r} answer options must be between 1 and its {options} options")
+        if len(margins) != 4 or not all(0 <= m < 1 for m in margins) or margins[0] + margins[2] >= 1 \
+                or margins[1] + margins[3] >= 1:
+            raise ValueError(f"Layout {name!r} margins must be four fractions (left, top, right, bottom)")
+        if bubble.get('shape') not in BUBBLE_SHAPES:
+            raise ValueError(f"Layout {name!r} bubble shape must be one of {', '.join(BUBBLE_SHAPES)}")
+        if bubble['shape'] == 'circle':
+            bubble.setdefault('diameter', 0.8)
+            if not 0 < bubble['diameter'] <= 1:
+                raise ValueError(f"Layout {name!r} bubble diameter must be a fraction of the cell")
+        self.name = name
+        self.questions = int(questions)
+        self.columns = int(columns)
+        self.rows = -(-self.questions // self.columns)
+        self.options = int(options)
+        self.answer_options = self.options if answer_options is None else int(answer_options)
+        self.label_strips = int(label_strips)
+        self.margins = tuple(float(m) for m in margins)
+        self.bubble = bubble
+        self._key = json.dumps(self.to_dict(), sort_keys=True)
+
+    @classmethod
+    def from_dict(cls, spec):
+        try:
+            return cls(spec['name'], spec['questions'], spec['columns'], spec['options'],
+                       spec.get('label_strips', 1), spec.get('margins', (0, 0, 0, 0)), spec.get('bubble'),
+                       spec.get('answer_options'))
+        except KeyError as e:
+            raise ValueError(f"Layout is missing {e}")
+
+    def to_dict(self):
+        return {'name': self.name, 'questions': self.questions, 'columns': self.columns, 'options': self.options,
+                'answer_options': self.answer_options, 'label_strips': self.label_strips,
+                'margins': list(self.margins), 'bubble': self.bubble}
+
+    def fingerprint(self):
+        return hashlib.sha256(self._key.encode()).hexdigest()[:16]
+
+    def __eq__(self, other):
+        return isinstance(other, SheetLayout) and self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        return f"SheetLayout({self.name!r}, {self.questions} questions, {self.options} options)"
+
+def available_layouts():
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(LAYOUT_DIR) if f.endswith(('.json', '.yaml', '.yml')))
+
+def load_layout(name_or_path=None):
+    """Layout from a file path or a name in sheet_layouts/; None gives the standard 50-question sheet"""
+    path = name_or_path or DEFAULT_LAYOUT_NAME
+    if not os.path.isfile(path):
+        for extension in ('.json', '.yaml', '.yml'):
+            candidate = os.path.join(LAYOUT_DIR, path + extension)
+            if os.path.isfile(candidate):
+                path = candidate
+                break
+        else:
+            raise ValueError(f"Unknown sheet layout {name_or_path!r} (available: {', '.join(available_layouts())})")
+    with open(path) as file:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError(f"Reading {path} needs PyYAML (pip install pyyaml)")
+            return SheetLayout.from_dict(yaml.safe_load(file))
+        return SheetLayout.from_dict(json.load(file))
+
+def quantized_size(width, height):
+    return max(SIZE_STEP, round(width / SIZE_STEP) * SIZE_STEP), max(SIZE_STEP, round(height / SIZE_STEP) * SIZE_STEP)
+
+class LayoutGeometry:
+    """Question boxes and option cells of a layout on a sheet of a given size, in pixels"""
+    __slots__ = ('box_width', 'box_height', 'box_rects', 'cell_rects', 'cell_mask')
+
+    def __init__(self, box_width, box_height, box_rects, cell_rects, cell_mask):
+        self.box_width = box_width
+        self.box_height = box_height
+        self.box_rects = box_rects      # (questions, 4) x0, y0, x1, y1
+        self.cell_rects = cell_rects    # (questions, options, 4)
+        self.cell_mask = cell_mask      # bubble pixels of one cell, shared by all cells
+
+@lru_cache(maxsize=CACHE_SIZE)
+def layout_geometry(layout, width, height):
+    left, top, right, bottom = layout.margins
+    x0, y0 = round(left * width), round(top * height)
+    grid_width, grid_height = round((1 - left - right) * width), round((1 - top - bottom) * height)
+    box_width, box_height = grid_width // layout.columns, grid_height // layout.rows
+    strip_width = box_width // (layout.options + layout.label_strips)
+    if strip_width < 1 or box_height < 1:
+        raise ValueError(f"Sheet of {width}x{height} pixels is too small for layout {layout.name!r}")
+
+    # Questions are numbered down each column first. Boxes sit at the exact grid pitch, so rounding
+    # the box size down never accumulates into a drift across many rows.
+    column, row = np.divmod(np.arange(layout.questions), layout.rows)
+    box_x = x0 + np.round(column * grid_width / layout.columns).astype(np.intp)
+    box_y = y0 + np.round(row * grid_height / layout.rows).astype(np.intp)
+    box_rects = np.stack([box_x, box_y, box_x + box_width, box_y + box_height], axis=1)
+
+    cell_x = box_x[:, None] + (layout.label_strips + np.arange(layout.options))[None, :] * strip_width
+    cell_y = np.broadcast_to(box_y[:, None], cell_x.shape)
+    cell_rects = np.stack([cell_x, cell_y, cell_x + strip_width, cell_y + box_height], axis=2)
+
+    if layout.bubble['shape'] == 'circle':
+        radius = layout.bubble['diameter'] * min(strip_width, box_height) / 2
+        yy, xx = np.mgrid[:box_height, :strip_width]
+        cell_mask = (xx + 0.5 - strip_width / 2) ** 2 + (yy + 0.5 - box_height / 2) ** 2 <= radius ** 2
+    else:
+        cell_mask = np.ones((box_height, strip_width), dtype=bool)
+    return LayoutGeometry(box_width, box_height, box_rects, cell_rects, cell_mask)
+
+class CellSampler:
+    """Turns a dark-pixel mask sampled every stride pixels into per-cell fill ratios.
+
+    A fill ratio is the share of the question box taken up by dark pixels of that option's bubble.
+    """
+    __slots__ = ('rects', 'weights', 'pixel_index', 'offsets', 'empty_cells', 'shape')
+
+    def __init__(self, cell_rects, cell_mask, box_area, stride, sampled_width):
+        flat_rects = cell_rects.reshape(-1, 4)
+        self.shape = cell_rects.shape[:-1]
+        # Sample index ranges of each cell; ceil maps pixel bounds to the stride grid
+        self.rects = -(-flat_rects // stride)
+        samples = np.empty(len(flat_rects))
+        if cell_mask.all():
+            # Rectangular bubbles are counted from an integral image, no per-pixel index needed
+            self.pixel_index = self.offsets = self.empty_cells = None
+            samples[:] = ((self.rects[:, 2] - self.rects[:, 0]) * (self.rects[:, 3] - self.rects[:, 1]))
+        else:
+            indices = []
+            for i, ((x0, y0, _, _), (sx0, sy0, sx1, sy1)) in enumerate(zip(flat_rects, self.rects)):
+                xs, ys = np.arange(sx0, sx1), np.arange(sy0, sy1)
+                inside = cell_mask[np.ix_(ys * stride - y0, xs * stride - x0)]
+                index = (ys[:, None] * sampled_width + xs[None, :])[inside]
+                indices.append(index)
+                samples[i] = len(index)
+            self.pixel_index = np.concatenate(indices).astype(np.intp)
+            # On small sheets a cell can get no samples at all. reduceat then returns the next cell's count (or
+            # fails past the last sample), so empty cells read from a valid offset and are zeroed afterwards.
+            offsets = np.concatenate([[0], np.cumsum(samples[:-1])]).astype(np.intp)
+            self.offsets = np.minimum(offsets, max(len(self.pixel_index) - 1, 0))
+            self.empty_cells = np.flatnonzero(samples == 0)
+        # Scale each cell's sampled share up to its bubble's pixel count, relative to the box
+        self.weights = cell_mask.sum() / (np.maximum(samples, 1) * box_area)
+
+    def fill_ratios(self, thresh):
+        if self.pixel_index is None:
+            integral = cv2.integral(thresh)
+            x0, y0, x1, y1 = self.rects.T
+            counts = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+        else:
+            if len(self.pixel_index):
+                counts = np.add.reduceat(thresh.ravel()[self.pixel_index], self.offsets, dtype=np.int64)
+            else:
+                counts = np.zeros(len(self.offsets), dtype=np.int64)
+            counts[self.empty_cells] = 0
+        return (counts * self.weights).reshape(self.shape)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def sheet_sampler(layout, width, height, stride=1):
+    """Sampler for every option cell of a width x height sheet read every stride pixels"""
+    geometry = layout_geometry(layout, width, height)
+    return CellSampler(geometry.cell_rects, geometry.cell_mask, geometry.box_width * geometry.box_height,
+                       stride, -(-width // stride))
+
+@lru_cache(maxsize=CACHE_SIZE)
+def box_sampler(layout, width, height):
+    """Full-density sampler for the option cells of one question box, relative to the box's top-left corner"""
+    geometry = layout_geometry(layout, width, height)
+    local_rects = geometry.cell_rects[:1] - np.tile(geometry.box_rects[0, :2], 2)
+    return CellSampler(local_rects, geometry.cell_mask, geometry.box_width * geometry.box_height,
+                       1, geometry.box_width)
+
+DEFAULT_LAYOUT = load_layout()
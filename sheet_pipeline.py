@@ -0,0 +1,175 @@
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from detection_cache import DEFAULT_MAX_BYTES, hash_image_bytes
+from grade_core import detect_sheet, decode_image, select_options, load_marking_scheme, detection_key
+from grade_mcq import (
+    error_row, save_graded_sheet, save_summary, graded_record, open_detection_cache, open_results_store
+)
+from sheet_sources import list_sheet_sources, select_shard, shard_file_name
+
+############################################################################
+
+###### Streaming batch pipeline: decode -> detect -> write ######
+
+# Decoding runs in an I/O thread pool (cv2.imdecode releases the GIL; TIFF
+# pages and ZIP members are read there too),
+# localization / warp / bubble detection run in worker processes and a
+# single writer thread grades and flushes the CSVs (or the results store). Decoded frames reach
+# the workers through shared memory instead of being pickled, and at most
+# queue_depth frames are in flight at any time. With a detection cache,
+# cached sheets skip the workers and go straight to the writer.
+
+############################################################################
+
+# How often a decode waiting for a free slot checks whether the writer has failed
+SLOT_POLL_SECONDS = 0.5
+
+
+def decode_to_shared_memory(file_bytes):
+    """Decode an encoded image (or copy a decoded TIFF page) into a new shared memory block, returning
+    (block, shape)"""
+    image = decode_image(file_bytes)
+    if image is None:
+        raise ValueError("Could not decode the image")
+    block = shared_memory.SharedMemory(create=True, size=image.nbytes)
+    np.ndarray(image.shape, dtype=image.dtype, buffer=block.buf)[:] = image
+    return block, image.shape
+
+def detect_shared_frame(block_name, shape, reduction=1, layout=None, scanner=None):
+    """Worker stage: locate, warp and score the frame held in a shared memory block"""
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        image = np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+        corners, fill_ratios = detect_sheet(image, reduction, layout=layout, scanner=scanner)
+        del image
+        return corners, fill_ratios
+    finally:
+        block.close()
+
+def run_pipeline(marking_scheme_path, answer_sheet_folder, output_folder,
+                 workers=1, io_threads=4, queue_depth=8, reduction=1,
+                 cache_path=None, cache_max_bytes=DEFAULT_MAX_BYTES, regrade_only=False, layout=None,
+                 store_path=None, shard=None, item_analysis=None, scanner=None):
+    """Grade a folder with overlapped decode / compute / write stages and return the summary rows
+
+    With a results store, rows are written to it as they are graded and None is returned. With an
+    (index, count) shard, only that shard's sheets are graded and its own summary file is written.
+    The writer adds every graded sheet to item_analysis (an ItemAnalysis).
+    """
+    marking_scheme = load_marking_scheme(marking_scheme_path, layout)
+    cache = open_detection_cache(cache_path, cache_max_bytes)
+    store = open_results_store(store_path)
+    fingerprint = detection_key(reduction, layout, scanner)
+    sources = select_shard(list_sheet_sources(answer_sheet_folder), shard)
+    summary_name = shard_file_name("Summary.csv", shard)
+    summary_data = [None] * len(sources)
+
+    # Every frame holds a slot from decode until the writer is done with it
+    slots = threading.BoundedSemaphore(queue_depth)
+    finished = queue.Queue(maxsize=queue_depth)
+    # The exception that stopped the writer, re-raised once the stages have wound down
+    writer_errors = []
+
+    def write_results():
+        try:
+            for _ in sources:
+                index, image_file, image_sha256, detection, error = finished.get()
+                try:
+                    if error is not None:
+                        row = error_row(image_file, error)
+                    else:
+                        corners, fill_ratios = detection
+                        options = select_options(fill_ratios)
+                        if cache is not None and corners is not None:
+                            cache.put(image_sha256, fingerprint, corners, options, fill_ratios)
+                        if store is not None:
+                            row = graded_record(image_file, options, fill_ratios, marking_scheme)
+                        else:
+                            row = save_graded_sheet(image_file, options, fill_ratios, marking_scheme, output_folder)
+                        if item_analysis is not None:
+                            item_analysis.add(options)
+                    if store is not None:
+                        # Sheets finish out of order; the store keeps them in folder order
+                        store.add(row, index)
+                    else:
+                        summary_data[index] = row
+                finally:
+                    slots.release()
+            if store is not None:
+                store.export_summary(output_folder, summary_name=summary_name)
+            else:
+                save_summary(summary_data, output_folder, summary_name)
+        except BaseException as e:
+            writer_errors.append(e)
+        finally:
+            # Closing flushes the last batch, so an interrupted run keeps everything graded so far
+            if store is not None:
+                store.close()
+
+    def on_detected(future, index, image_file, image_sha256, block):
+        block.close()
+        block.unlink()
+        try:
+            finished.put((index, image_file, image_sha256, future.result(), None))
+        except Exception as e:
+            # Any failure must still reach the writer, or it would wait forever
+            finished.put((index, image_file, image_sha256, None, e))
+
+    def decode(index, source, pool):
+        image_file = source.name
+        image_sha256 = None
+        try:
+            file_bytes = source.read()
+            if cache is not None:
+                image_sha256 = hash_image_bytes(file_bytes)
+                cached = cache.get(image_sha256, fingerprint)
+                if cached is not None:
+                    # Already stored, so the writer only needs the fill ratios
+                    finished.put((index, image_file, image_sha256, (None, cached.fill_ratios), None))
+                    return
+                if regrade_only:
+                    raise ValueError("No cached detection for this sheet")
+            block, shape = decode_to_shared_memory(file_bytes)
+        except Exception as e:
+            finished.put((index, image_file, image_sha256, None, e))
+            return
+        try:
+            future = pool.submit(detect_shared_frame, block.name, shape, reduction, layout, scanner)
+        except Exception as e:
+            block.close()
+            block.unlink()
+            finished.put((index, image_file, image_sha256, None, e))
+            return
+        future.add_done_callback(lambda f: on_detected(f, index, image_file, image_sha256, block))
+
+    def acquire_slot():
+        """Wait for a free slot; False once the writer has failed, as no slot will be freed again"""
+        while not slots.acquire(timeout=SLOT_POLL_SECONDS):
+            if writer_errors:
+                return False
+        return not writer_errors
+
+    writer = threading.Thread(target=write_results, name="grade-writer")
+    writer.start()
+    try:
+        # Workers are started lazily from the decode threads, so they must not be forked from this threaded
+        # process: a child could inherit a lock held by another thread and deadlock
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool, \
+                ThreadPoolExecutor(max_workers=io_threads) as io_pool:
+            for index, source in enumerate(sources):
+                if not acquire_slot():
+                    break
+                io_pool.submit(decode, index, source, pool)
+            writer.join()
+    finally:
+        if cache is not None:
+            cache.close()
+    if writer_errors:
+        raise writer_errors[0]
+    return None if store is not None else summary_data
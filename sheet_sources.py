@@ -0,0 +1,150 @@
+import hashlib
+import os
+import re
+import zipfile
+from functools import lru_cache
+
+import cv2
+
+############################################################################
+
+###### Answer sheets inside multi-page TIFFs and ZIP archives ######
+
+# A SheetSource names one answer sheet: a loose image file, one page of a
+# multi-page TIFF or one image inside a ZIP archive. Listing a folder only
+# reads TIFF page counts and ZIP directories; a sheet's pixels are read when
+# it is graded, one page (cv2.imreadmulti) or member (straight from the
+# archive, never extracted) at a time, so memory holds just the sheets in
+# flight. Sheets from containers are named after the container and the page
+# or member, e.g. scans_p003.tif or batch_room2_s01.jpg, and graded like
+# loose files of that name.
+#
+# A batch can be split into shards by a stable hash of the sheet names, so
+# several machines can grade one folder with no coordination: shard i of N
+# grades the sheets whose hash is i - 1 modulo N.
+
+############################################################################
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+TIFF_EXTENSIONS = (".tif", ".tiff")
+ARCHIVE_EXTENSIONS = (".zip",)
+SHEET_EXTENSIONS = IMAGE_EXTENSIONS + TIFF_EXTENSIONS + ARCHIVE_EXTENSIONS
+# Open archives kept per process, so reading many members does not parse the ZIP directory each time
+ARCHIVE_CACHE_SIZE = 4
+_SHARD_SPEC = re.compile(r"^(\d+)/(\d+)$")
+
+
+class SheetSource:
+    """One answer sheet: an image file, a page (from 0) of a TIFF or a member of a ZIP archive"""
+    __slots__ = ('path', 'name', 'member', 'page')
+
+    def __init__(self, path, name=None, member=None, page=None):
+        self.path = path
+        self.name = name or os.path.basename(path)
+        self.member = member
+        self.page = page
+
+    def is_file(self):
+        return self.member is None and self.page is None
+
+    @property
+    def virtual_path(self):
+        """Where the sheet would be as a loose file next to its container"""
+        return os.path.join(os.path.dirname(self.path), self.name)
+
+    def read(self):
+        """Encoded image bytes, or for a TIFF page the decoded page"""
+        if self.page is not None:
+            return read_tiff_page(self.path, self.page)
+        if self.member is not None:
+            try:
+                return _open_archive(self.path, *_file_signature(self.path)).read(self.member)
+            except (zipfile.BadZipFile, KeyError) as e:
+                raise ValueError(f"Could not read {self.member} from {self.path}: {e}")
+        with open(self.path, 'rb') as file:
+            return file.read()
+
+    def __repr__(self):
+        return f"SheetSource({self.name!r})"
+
+def as_sheet_source(source):
+    return source if isinstance(source, SheetSource) else SheetSource(source)
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+@lru_cache(maxsize=ARCHIVE_CACHE_SIZE)
+def _open_archive(path, size, mtime_ns):
+    # Keyed by size and mtime too, so a replaced archive is opened again
+    return zipfile.ZipFile(path)
+
+def read_tiff_page(path, page):
+    ok, pages = cv2.imreadmulti(path, page, 1, flags=cv2.IMREAD_COLOR)
+    if not ok or not pages:
+        raise ValueError(f"Could not read page {page + 1} of {path}")
+    return pages[0]
+
+def tiff_pages(path):
+    stem, extension = os.path.splitext(os.path.basename(path))
+    pages = cv2.imcount(path)
+    if pages <= 1:
+        # Single-page (or unreadable, reported when graded) TIFFs keep their own name
+        yield SheetSource(path, page=0)
+        return
+    for page in range(pages):
+        yield SheetSource(path, f"{stem}_p{page + 1:03d}{extension}", page=page)
+
+def archive_members(path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    try:
+        members = _open_archive(path, *_file_signature(path)).namelist()
+    except zipfile.BadZipFile:
+        # Reported as a sheet that cannot be decoded when it is graded
+        yield SheetSource(path)
+        return
+    for member in sorted(members):
+        base_name = os.path.basename(member)
+        # Skips folders, macOS resource forks and hidden files
+        if member.startswith('__MACOSX/') or base_name.startswith('.') or not base_name.endswith(IMAGE_EXTENSIONS):
+            continue
+        yield SheetSource(path, f"{stem}_{member.replace('/', '_')}", member=member)
+
+def file_sheet_sources(path):
+    """The sheets of one file: itself, the pages of a TIFF or the images of a ZIP archive"""
+    if path.endswith(TIFF_EXTENSIONS):
+        return tiff_pages(path)
+    if path.endswith(ARCHIVE_EXTENSIONS):
+        return archive_members(path)
+    return iter([SheetSource(path)])
+
+def list_sheet_sources(folder):
+    """Every sheet of a folder's images, TIFFs and ZIP archives, in file name order"""
+    for file_name in sorted(os.listdir(folder)):
+        if file_name.endswith(SHEET_EXTENSIONS):
+            yield from file_sheet_sources(os.path.join(folder, file_name))
+
+def parse_shard(spec):
+    """(index, count) of a shard given as "i/N", with i counted from 1"""
+    match = _SHARD_SPEC.match(spec.strip())
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise ValueError(f"Shard must be i/N with 1 <= i <= N, not {spec!r}")
+    return int(match.group(1)), int(match.group(2))
+
+def shard_of(name, count):
+    """Shard (from 1) of count that a sheet name belongs to, the same on every machine and Python version"""
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:8], 'big') % count + 1
+
+def select_shard(sources, shard=None):
+    """The sources of one (index, count) shard, in their original order; all of them when shard is None"""
+    if shard is None:
+        return list(sources)
+    index, count = shard
+    return [source for source in sources if shard_of(source.name, count) == index]
+
+def shard_file_name(file_name, shard=None):
+    """Per-shard name of an output file, e.g. Summary.shard-2-of-4.csv"""
+    if shard is None:
+        return file_name
+    stem, extension = os.path.splitext(file_name)
+    return f"{stem}.shard-{shard[0]}-of-{shard[1]}{extension}"
@@ -0,0 +1,313 @@
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+
+import cv2
+import numpy as np
+
+from grade_core import (
+    decode_image, detect_sheet, select_options, grade_matrix, MarkingScheme, format_marks, PYRAMID_FACTORS
+)
+from sheet_layout import DEFAULT_LAYOUT, load_layout
+
+############################################################################
+
+###### Synthetic answer sheets for load and scaling tests ######
+
+# Sheets are drawn from a sheet layout (standard-50 by default: 10 rows x 5
+# columns of question boxes, each a question number followed by five option
+# bubbles) inside a printed frame that the grader locates as the sheet. One
+# of options 1-4 is filled per question, then the printed page is skewed,
+# rotated, lit unevenly, blurred, given sensor noise and JPEG-compressed. Sheet i is fully determined by (seed, i), so a run
+# gives the same sheets however the work is split across processes.
+
+############################################################################
+
+# Full-size sheets match the ~3000x2000 scans of the bundled dataset
+SHEET_WIDTH, SHEET_HEIGHT = 3070, 2160
+# The printed frame; the layout's margins are measured inside it
+GRID_LEFT, GRID_TOP, GRID_WIDTH, GRID_HEIGHT = 140, 680, 1960, 920
+# Options a student may fill; a standard sheet's fifth slot is printed but never used
+NUM_CHOICES = 4
+# Bubble cell size (pixels) of the standard sheet, which the label and bubble drawing sizes are tuned for
+CELL_SIZE = GRID_WIDTH / 5 / 6
+
+# Random stream of the marking scheme, kept apart from the per-sheet streams
+MARKING_SCHEME_STREAM = 2 ** 32
+
+PAPER_COLOR = (236, 226, 214)
+INK_COLOR = (40, 35, 30)
+
+
+class Distortion:
+    """Upper bounds of the random distortions applied to each sheet"""
+
+    def __init__(self, skew=0.03, rotation=2.0, blur=1.5, noise=6.0, jpeg_quality=(60, 95), lighting=0.25):
+        self.skew = skew                    # corner displacement as a fraction of the sheet size
+        self.rotation = rotation            # degrees either way
+        self.blur = blur                    # Gaussian sigma in pixels at full size
+        self.noise = noise                  # sensor noise standard deviation in grey levels
+        self.jpeg_quality = jpeg_quality    # (lowest, highest) encoder quality
+        self.lighting = lighting            # darkest corner of the lighting gradient, as a fraction
+
+NO_DISTORTION = Distortion(skew=0, rotation=0, blur=0, noise=0, jpeg_quality=(95, 95), lighting=0)
+
+def sheet_name(index):
+    return f"sheet_{index:06d}.jpg"
+
+def sheet_rng(seed, index):
+    return np.random.default_rng([seed, index])
+
+def grid_geometry(layout, scale=1.0):
+    """Left, top, box width, box height and option strip width of the layout's grid, in sheet pixels"""
+    left, top, right, bottom = layout.margins
+    grid_left, grid_top = (GRID_LEFT + left * GRID_WIDTH) * scale, (GRID_TOP + top * GRID_HEIGHT) * scale
+    box_width = (1 - left - right) * GRID_WIDTH * scale / layout.columns
+    box_height = (1 - top - bottom) * GRID_HEIGHT * scale / layout.rows
+    return grid_left, grid_top, box_width, box_height, box_width / (layout.options + layout.label_strips)
+
+@lru_cache(maxsize=4)
+def blank_sheet(scale=1.0, layout=DEFAULT_LAYOUT):
+    """The printed sheet with empty bubbles, rendered once per process, scale and layout"""
+    width, height = round(SHEET_WIDTH * scale), round(SHEET_HEIGHT * scale)
+    sheet = np.full((height, width, 3), PAPER_COLOR, dtype=np.uint8)
+    left, top = round(GRID_LEFT * scale), round(GRID_TOP * scale)
+    grid_width, grid_height = round(GRID_WIDTH * scale), round(GRID_HEIGHT * scale)
+    cv2.rectangle(sheet, (left, top), (left + grid_width, top + grid_height), INK_COLOR, max(2, round(4 * scale)))
+
+    grid_left, grid_top, box_width, box_height, strip_width = grid_geometry(layout, scale)
+    cell = min(strip_width, box_height)
+    radius = round(cell * 0.34)
+    # Labels shrink with the cells of denser layouts
+    size = cell / (CELL_SIZE * scale)
+    font_scale, thickness = 1.1 * scale * size, max(1, round(2 * scale * min(size, 1)))
+    for question in range(layout.questions):
+        column, row = divmod(question, layout.rows)
+        x, y = grid_left + column * box_width, grid_top + row * box_height + box_height / 2
+        if layout.label_strips:
+            cv2.putText(sheet, f"{question + 1:02d}", (round(x + strip_width * 0.15), round(y + 14 * scale * size)),
+                        cv2.FONT_HERSHEY_SIMPLEX, font_scale, INK_COLOR, thickness, cv2.LINE_AA)
+        for option in range(1, layout.options + 1):
+            center = (round(x + (layout.label_strips + option - 0.5) * strip_width), round(y))
+            cv2.circle(sheet, center, radius, INK_COLOR, thickness, cv2.LINE_AA)
+            cv2.putText(sheet, str(option), (center[0] - round(9 * scale * size), center[1] + round(11 * scale * size)),
+                        cv2.FONT_HERSHEY_SIMPLEX, font_scale * 0.85, INK_COLOR, thickness, cv2.LINE_AA)
+    return sheet
+
+def fill_bubbles(sheet, answers, rng, scale=1.0, layout=DEFAULT_LAYOUT):
+    """Fill the chosen bubble of every question with a slightly irregular blot"""
+    grid_left, grid_top, box_width, box_height, strip_width = grid_geometry(layout, scale)
+    cell = min(strip_width, box_height)
+    for question, option in enumerate(answers):
+        column, row = divmod(question, layout.rows)
+        jitter = rng.normal(0, cell * 0.04, size=2)
+        center = (round(grid_left + column * box_width + (layout.label_strips + option - 0.5) * strip_width
+                        + jitter[0]),
+                  round(grid_top + (row + 0.5) * box_height + jitter[1]))
+        axes = tuple(round(cell * r) for r in rng.uniform(0.33, 0.42, size=2))
+        shade = tuple(int(c) for c in rng.integers(10, 60) + rng.integers(-8, 9, size=3))
+        cv2.ellipse(sheet, center, axes, rng.uniform(0, 180), 0, 360, shade, -1, cv2.LINE_AA)
+
+def distort(sheet, rng, distortion):
+    """Photograph-like perspective, lighting, blur and noise"""
+    height, width = sheet.shape[:2]
+    source = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    offsets = rng.uniform(-distortion.skew, distortion.skew, size=(4, 2)) * (width, height)
+    angle = np.deg2rad(rng.uniform(-distortion.rotation, distortion.rotation))
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    center = np.array([width / 2, height / 2])
+    destination = ((source - center) @ rotation.T + center + offsets).astype(np.float32)
+    homography = cv2.getPerspectiveTransform(source, destination)
+    image = cv2.warpPerspective(sheet, homography, (width, height), borderMode=cv2.BORDER_REPLICATE)
+
+    if distortion.lighting > 0:
+        # Bilinear gain between random corner brightnesses, kept in uint8 (255 = unchanged)
+        corners = np.uint8(255 * rng.uniform(1 - distortion.lighting, 1, size=(2, 2)))
+        gain = cv2.cvtColor(cv2.resize(corners, (width, height), interpolation=cv2.INTER_LINEAR), cv2.COLOR_GRAY2BGR)
+        image = cv2.multiply(image, gain, scale=1 / 255)
+    if distortion.blur > 0:
+        sigma = rng.uniform(0, distortion.blur) * width / SHEET_WIDTH
+        if sigma > 0.3:
+            image = cv2.GaussianBlur(image, (0, 0), sigma)
+    if distortion.noise > 0:
+        # Luminance grain drawn at half resolution; cv2.randn is seeded per sheet for determinism
+        cv2.setRNGSeed(int(rng.integers(2 ** 31)))
+        noise = np.empty(((height + 1) // 2, (width + 1) // 2), dtype=np.int16)
+        cv2.randn(noise, 0, rng.uniform(0, distortion.noise))
+        noise = cv2.resize(noise, None, fx=2, fy=2, interpolation=cv2.INTER_NEAREST)[:height, :width]
+        image = cv2.add(image, cv2.merge([noise] * 3), dtype=cv2.CV_8U)
+    return image
+
+def render_sheet(index, seed=0, scale=1.0, distortion=None, layout=DEFAULT_LAYOUT):
+    """Render sheet index of a seeded run, returning (JPEG bytes, answers as options 1-4)"""
+    distortion = distortion or Distortion()
+    rng = sheet_rng(seed, index)
+    answers = rng.integers(1, min(NUM_CHOICES, layout.options) + 1, size=layout.questions)
+    sheet = blank_sheet(scale, layout).copy()
+    fill_bubbles(sheet, answers, rng, scale, layout)
+    image = distort(sheet, rng, distortion)
+    quality = int(rng.integers(distortion.jpeg_quality[0], distortion.jpeg_quality[1] + 1))
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError(f"Could not encode sheet {index}")
+    return encoded.tobytes(), answers
+
+def random_marking_scheme(seed=0, num_questions=DEFAULT_LAYOUT.questions, num_choices=NUM_CHOICES):
+    """Marking scheme rows for a seeded run, mostly single answers with a few Any/All questions"""
+    rng = np.random.default_rng([seed, MARKING_SCHEME_STREAM])
+    rows = []
+    for question in range(1, num_questions + 1):
+        condition = rng.choice(['-', 'Any', 'All'], p=[0.8, 0.1, 0.1])
+        count = 1 if condition == '-' else int(rng.integers(2, num_choices))
+        answers = sorted(int(a) for a in rng.choice(np.arange(1, num_choices + 1), size=count, replace=False))
+        rows.append((question, answers, condition))
+    return rows
+
+def marking_scheme_from_rows(rows, layout=DEFAULT_LAYOUT):
+    return MarkingScheme({question: {'correct_answers': answers, 'condition': condition}
+                          for question, answers, condition in rows}, layout)
+
+def write_marking_scheme(rows, path):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(['Question ID', 'Answer ID', 'Condition'])
+        for question, answers, condition in rows:
+            writer.writerow([question, ','.join(map(str, answers)), condition])
+
+def write_answers(answers, path):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(['q_no', 'option'])
+        writer.writerows(enumerate(answers.tolist(), start=1))
+
+def layout_marking_scheme(seed, layout):
+    return random_marking_scheme(seed, layout.questions, min(NUM_CHOICES, layout.options))
+
+def _write_sheet(index, output_folder, seed, scale, distortion, layout):
+    image_bytes, answers = render_sheet(index, seed, scale, distortion, layout)
+    name = sheet_name(index)
+    with open(os.path.join(output_folder, name), 'wb') as file:
+        file.write(image_bytes)
+    write_answers(answers, os.path.join(output_folder, "ground_truth", f"{os.path.splitext(name)[0]}_answers.csv"))
+    return answers
+
+def generate_to_folder(output_folder, count, seed=0, scale=1.0, distortion=None, workers=1, start=0,
+                       layout=DEFAULT_LAYOUT):
+    """Write sheets, their ground-truth answers, a marking scheme and the expected grades"""
+    os.makedirs(os.path.join(output_folder, "ground_truth"), exist_ok=True)
+    rows = layout_marking_scheme(seed, layout)
+    write_marking_scheme(rows, os.path.join(output_folder, "marking_scheme.csv"))
+    indices = range(start, start + count)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        answers = list(executor.map(partial(_write_sheet, output_folder=output_folder, seed=seed, scale=scale,
+                                            distortion=distortion, layout=layout), indices, chunksize=16))
+
+    # Expected Summary.csv, so a grading run can be checked end to end
+    _, totals = grade_matrix(np.array(answers).reshape(count, -1), marking_scheme_from_rows(rows, layout))
+    summary_path = os.path.join(output_folder, "ground_truth", "Summary.csv")
+    grades = {}
+    if start > 0 and os.path.exists(summary_path):
+        # Extending an earlier run keeps the grades of the sheets it wrote
+        with open(summary_path, newline='') as file:
+            grades.update((row['image_name'], row['grade']) for row in csv.DictReader(file))
+    grades.update((sheet_name(index), format_marks(total)) for index, total in zip(indices, totals))
+    with open(summary_path, 'w', newline='') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(['image_name', 'grade'])
+        # Sheet names are zero-padded, so this is index order
+        writer.writerows(sorted(grades.items()))
+
+def _render_and_detect(index, seed, scale, distortion, reduction, layout):
+    image_bytes, answers = render_sheet(index, seed, scale, distortion, layout)
+    try:
+        image = decode_image(image_bytes)
+        _, fill_ratios = detect_sheet(image, reduction, layout=layout)
+        return index, answers, select_options(fill_ratios), None
+    except (ValueError, cv2.error) as e:
+        return index, answers, None, str(e)
+
+def stream_sheets(count, seed=0, scale=1.0, distortion=None, workers=1, start=0, reduction=1,
+                  layout=DEFAULT_LAYOUT):
+    """Render and detect sheets in worker processes without touching disk.
+
+    Yields (index, true answers, detected options or None, error or None) in index order.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(partial(_render_and_detect, seed=seed, scale=scale, distortion=distortion,
+                                        reduction=reduction, layout=layout), range(start, start + count),
+                                chunksize=8)
+
+def grade_stream(count, seed=0, scale=1.0, distortion=None, workers=1, reduction=1, layout=DEFAULT_LAYOUT):
+    """Grade a stream of synthetic sheets and check the detections against the ground truth"""
+    marking_scheme = marking_scheme_from_rows(layout_marking_scheme(seed, layout), layout)
+    started = time.perf_counter()
+    detected, truth, failures, wrong_sheets = [], [], [], []
+    for index, answers, options, error in stream_sheets(count, seed, scale, distortion, workers,
+                                                        reduction=reduction, layout=layout):
+        if error is not None:
+            failures.append((sheet_name(index), error))
+            continue
+        detected.append(options)
+        truth.append(answers)
+        if not np.array_equal(options, answers):
+            wrong_sheets.append(sheet_name(index))
+    elapsed = time.perf_counter() - started
+
+    num_questions = layout.questions
+    detected, truth = np.array(detected).reshape(-1, num_questions), np.array(truth).reshape(-1, num_questions)
+    _, detected_totals = grade_matrix(detected, marking_scheme)
+    _, true_totals = grade_matrix(truth, marking_scheme)
+    return {
+        'sheets': count,
+        'seconds': round(elapsed, 3),
+        'sheets_per_s': round(count / elapsed, 2),
+        'failed': len(failures),
+        'question_accuracy': round(float((detected == truth).mean()), 6) if len(truth) else None,
+        'sheets_with_wrong_answers': len(wrong_sheets),
+        'sheets_with_wrong_grade': int(np.sum(~np.isclose(detected_totals, true_totals))),
+        'examples': (wrong_sheets + [name for name, _ in failures])[:10],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic MCQ answer sheets with ground truth")
+    parser.add_argument("--count", type=int, default=100, help="Number of sheets (default: 100)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed; the same seed gives the same sheets")
+    parser.add_argument("--start", type=int, default=0, help="Index of the first sheet, to extend an earlier run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes (default: number of CPU cores)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Sheet size relative to the ~3000x2000 scans (default: 1.0)")
+    parser.add_argument("--clean", action="store_true", help="Render without skew, lighting, blur or noise")
+    parser.add_argument("--skew", type=float, default=0.03, help="Maximum corner displacement fraction (default: 0.03)")
+    parser.add_argument("--rotation", type=float, default=2.0, help="Maximum rotation in degrees (default: 2)")
+    parser.add_argument("--output-folder", help="Write the sheets and ground truth here")
+    parser.add_argument("--grade", action="store_true",
+                        help="Stream the sheets through detection and grading in memory and report accuracy")
+    parser.add_argument("--pyramid", type=int, choices=PYRAMID_FACTORS, default=1,
+                        help="Locate sheets on an image downscaled by this factor (with --grade)")
+    parser.add_argument("--layout", metavar="NAME_OR_PATH",
+                        help=f"Sheet layout to draw, a file or a name in sheet_layouts/ (default: {DEFAULT_LAYOUT.name})")
+    args = parser.parse_args()
+    if not args.output_folder and not args.grade:
+        parser.error("give --output-folder and/or --grade")
+    try:
+        layout = load_layout(args.layout)
+    except ValueError as e:
+        parser.error(str(e))
+
+    distortion = NO_DISTORTION if args.clean else Distortion(skew=args.skew, rotation=args.rotation)
+    if args.output_folder:
+        started = time.perf_counter()
+        generate_to_folder(args.output_folder, args.count, args.seed, args.scale, distortion, args.workers, args.start,
+                           layout)
+        elapsed = time.perf_counter() - started
+        print(f"Wrote {args.count} sheets to {args.output_folder} in {elapsed:.1f}s "
+              f"({args.count / elapsed:.1f} sheets/s)")
+    if args.grade:
+        print(grade_stream(args.count, args.seed, args.scale, distortion, args.workers, args.pyramid, layout))
+
+if __name__ == "__main__":
+    main()
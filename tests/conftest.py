@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_sheets import layout_marking_scheme, render_sheet, sheet_name, write_marking_scheme
+from sheet_layout import DEFAULT_LAYOUT
+
+
+@pytest.fixture
+def sheet_folder(tmp_path):
+    """A folder of three small synthetic sheets and the path of their marking scheme"""
+    folder = tmp_path / "sheets"
+    folder.mkdir()
+    for index in range(3):
+        image_bytes, _ = render_sheet(index, seed=1, scale=0.5)
+        (folder / sheet_name(index)).write_bytes(image_bytes)
+    marking_scheme_path = tmp_path / "marking_scheme.csv"
+    write_marking_scheme(layout_marking_scheme(1, DEFAULT_LAYOUT), marking_scheme_path)
+    return folder, str(marking_scheme_path)
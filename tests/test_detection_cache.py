@@ -0,0 +1,40 @@
+import sqlite3
+import sys
+
+import numpy as np
+
+import detection_cache
+from detection_cache import DetectionCache, DEFAULT_MAX_BYTES
+
+
+def count_entries(cache_path):
+    with sqlite3.connect(cache_path) as connection:
+        return connection.execute("SELECT COUNT(*) FROM detections").fetchone()[0]
+
+def test_stats_does_not_evict(tmp_path, monkeypatch, capsys):
+    cache_path = str(tmp_path / detection_cache.CACHE_FILE_NAME)
+    cache = DetectionCache(cache_path, max_bytes=None)
+    for index in range(3):
+        cache.put(f"{index:064x}", "fingerprint", np.zeros((4, 2)), np.zeros(5), np.zeros((5, 4)))
+    cache.close()
+    # Pretend the entries are large, so that together they exceed the default limit
+    with sqlite3.connect(cache_path) as connection:
+        connection.execute("UPDATE detections SET size = ?", (DEFAULT_MAX_BYTES // 2,))
+
+    monkeypatch.setattr(sys, 'argv', ["detection_cache.py", str(tmp_path), "stats"])
+    detection_cache.main()
+
+    assert "'entries': 3" in capsys.readouterr().out
+    assert count_entries(cache_path) == 3
+
+def test_close_evicts_beyond_max_bytes(tmp_path):
+    cache_path = str(tmp_path / detection_cache.CACHE_FILE_NAME)
+    cache = DetectionCache(cache_path, max_bytes=1000)
+    for index in range(3):
+        cache.put(f"{index:064x}", "fingerprint", np.zeros((4, 2)), np.zeros(5), np.zeros((5, 4)))
+    cache.close()
+    # Each entry takes 32 + 5 + 160 bytes
+    assert count_entries(cache_path) == 3
+    cache = DetectionCache(cache_path, max_bytes=400)
+    cache.close()
+    assert count_entries(cache_path) == 2
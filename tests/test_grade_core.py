@@ -0,0 +1,97 @@
+import glob
+import itertools
+import os
+
+import numpy as np
+import pytest
+
+from grade_core import (
+    MarkingScheme, compute_fill_ratios, detect_colored_bubble, extract_question_boxes, find_sheet_corners,
+    grade_matrix, load_image, order_corners, reference_fill_ratios, sample_fill_ratios, score_selection_masks,
+    select_options, warp_perspective
+)
+from sheet_layout import SheetLayout
+
+
+@pytest.mark.parametrize("corners", [
+    [[0, 0], [0, 100], [200, 100], [200, 0]],
+    [[30, 0], [0, 120], [190, 150], [220, 20]],
+    [[100, 0], [0, 100], [100, 201], [201, 100]],
+])
+def test_order_corners_returns_each_corner_once(corners):
+    corners = np.array(corners)
+    for permutation in itertools.permutations(range(4)):
+        ordered = order_corners(corners[list(permutation)])
+        # Top-left, bottom-left, bottom-right, top-right, whatever corner the contour started at
+        assert np.array_equal(ordered, corners)
+
+
+DATASET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Data Set", "Answer Scripts",
+                       "Answer Scripts")
+BUNDLED_SCANS = sorted(glob.glob(os.path.join(DATASET, "*", "*.jpg")))
+# The sampled sheet is resized to a 16-pixel grid, and escalated questions are re-thresholded with Otsu, so the
+# sparse fill ratios only match the reference to within this
+SAMPLED_TOLERANCE = 0.05
+
+
+def reference_detection(image_path, reduction):
+    image = load_image(image_path)
+    corners = find_sheet_corners(image, reduction)
+    boxes = extract_question_boxes(warp_perspective(image, corners))
+    reference = np.array([reference_fill_ratios(box) for box in boxes])
+    return image, corners, reference, np.array([detect_colored_bubble(box) for box in boxes])
+
+@pytest.mark.skipif(not BUNDLED_SCANS, reason="the bundled dataset is not present")
+@pytest.mark.parametrize("reduction", [1, 4])
+@pytest.mark.parametrize("image_path", BUNDLED_SCANS, ids=lambda path: os.path.relpath(path, DATASET))
+def test_fill_ratios_match_the_reference_detector(image_path, reduction):
+    image, corners, reference, reference_options = reference_detection(image_path, reduction)
+
+    dense = compute_fill_ratios(warp_perspective(image, corners))
+    np.testing.assert_allclose(dense, reference, rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(select_options(dense), reference_options)
+
+    sampled = sample_fill_ratios(image, corners)
+    np.testing.assert_allclose(sampled, reference, rtol=0, atol=SAMPLED_TOLERANCE)
+    np.testing.assert_array_equal(select_options(sampled), reference_options)
+
+
+def scheme(*rows, layout=None):
+    return MarkingScheme({question: {'correct_answers': answers, 'condition': condition}
+                          for question, (answers, condition) in enumerate(rows, start=1)}, layout)
+
+
+def test_grade_matrix_scores_single_and_any_questions():
+    marking_scheme = scheme(([2], '-'), ([1, 3], 'Any'))
+    scores, totals = grade_matrix([[2, 3], [1, 1], [2, 2], [0, 0]], marking_scheme)
+    np.testing.assert_array_equal(scores, [[1, 1], [0, 1], [1, 0], [0, 0]])
+    np.testing.assert_array_equal(totals, [2, 1, 1, 0])
+
+
+def test_all_questions_score_valid_share_minus_invalid_share():
+    # Valid {1, 3} of the four answer choices, so invalid {2, 4}
+    marking_scheme = scheme(([1, 3], 'All'))
+    selected = np.array([[0b0101], [0b0001], [0b0011], [0b1010], [0b0111], [0]])
+    scores = score_selection_masks(selected, marking_scheme)
+    np.testing.assert_allclose(scores[:, 0], [1, 0.5, 0, -1, 0.5, 0])
+
+
+def test_fifth_slot_of_the_standard_sheet_is_ignored():
+    marking_scheme = scheme(([1, 2, 3], 'All'), ([4], '-'), ([2, 5], 'Any'))
+    scores, _ = grade_matrix([[5, 5, 5], [1, 4, 2]], marking_scheme)
+    np.testing.assert_allclose(scores, [[0, 0, 0], [1 / 3, 1, 1]])
+
+
+def test_over_marked_rows_lose_single_and_any_marks():
+    marking_scheme = scheme(([2], '-'), ([1, 3], 'Any'), ([1, 2, 3], 'All'))
+    selected = np.array([[0b0011, 0b1101, 0b1111]])
+    scores = score_selection_masks(selected, marking_scheme)
+    np.testing.assert_allclose(scores, [[0, 0, 0]])
+
+
+def test_answers_beyond_the_fifth_option_are_graded():
+    layout = SheetLayout('wide', questions=2, columns=1, options=8)
+    marking_scheme = scheme(([7], '-'), ([6, 8], 'All'), ([9], 'Any'), layout=layout)
+    scores, totals = grade_matrix([[7, 6, 9], [5, 8, 0], [8, 1, 0]], marking_scheme)
+    np.testing.assert_allclose(scores, [[1, 0.5, 0], [0, 0.5, 0], [0, -1 / 6, 0]])
+    np.testing.assert_allclose(totals, [1.5, 0.5, -1 / 6])
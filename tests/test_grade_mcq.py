@@ -0,0 +1,29 @@
+import shutil
+
+import grade_core
+from grade_mcq import grade_folder
+from synthetic_sheets import sheet_name
+
+
+def test_skipped_duplicate_is_never_sampled(sheet_folder, tmp_path, monkeypatch):
+    folder, marking_scheme_path = sheet_folder
+    shutil.copyfile(folder / sheet_name(0), folder / "zz_rescan.jpg")
+    sampled = []
+    sample_fill_ratios = grade_core.sample_fill_ratios
+
+    def counting_sample_fill_ratios(image, corners, *args, **kwargs):
+        sampled.append(image.shape)
+        return sample_fill_ratios(image, corners, *args, **kwargs)
+
+    monkeypatch.setattr(grade_core, 'sample_fill_ratios', counting_sample_fill_ratios)
+    output_folder = tmp_path / "graded"
+    output_folder.mkdir()
+    rows = grade_folder(marking_scheme_path, str(folder), str(output_folder), duplicates='skip')
+
+    assert len(sampled) == 3
+    skipped = rows[-1]
+    assert skipped['image_name'] == "zz_rescan.jpg"
+    assert skipped['duplicate_of'] == sheet_name(0)
+    assert skipped['grade'] == ''
+    assert not (output_folder / "zz_rescan_graded.csv").exists()
+    assert all(row['grade'] != '' for row in rows[:-1])
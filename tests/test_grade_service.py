@@ -0,0 +1,53 @@
+import asyncio
+from http import HTTPStatus
+
+import numpy as np
+import pytest
+
+import grade_service
+from grade_service import GradingService, HttpError, detect_batch, read_request
+from scanner_profile import load_profile
+
+
+def read(raw):
+    async def parse():
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        return await read_request(reader)
+    return asyncio.run(parse())
+
+@pytest.mark.parametrize("length", [b"abc", b"-5", b""])
+def test_malformed_content_length_is_bad_request(length):
+    with pytest.raises(HttpError) as error:
+        read(b"POST /grade/A HTTP/1.1\r\nContent-Length: " + length + b"\r\n\r\nbody")
+    assert error.value.status == HTTPStatus.BAD_REQUEST
+
+def test_missing_content_length_on_post_is_length_required():
+    with pytest.raises(HttpError) as error:
+        read(b"POST /grade/A HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    assert error.value.status == HTTPStatus.LENGTH_REQUIRED
+
+def test_get_without_content_length():
+    assert read(b"GET /health HTTP/1.1\r\n\r\n") == ('GET', '/health', {}, b'')
+
+def test_rejected_uploads_are_not_counted_as_requests():
+    service = GradingService(max_in_flight=0)
+    service.schemes['A'] = None
+    with pytest.raises(HttpError) as error:
+        asyncio.run(service.submit('A', b''))
+    assert error.value.status == HTTPStatus.TOO_MANY_REQUESTS
+    assert service.counters['rejected'] == 1 and service.counters['requests'] == 0
+
+def test_detect_batch_uses_the_scanner_profile(sheet_folder, monkeypatch):
+    folder, _ = sheet_folder
+    seen = []
+
+    def detect_sheet(image, reduction=1, layout=None, scanner=None):
+        seen.append(scanner)
+        return None, np.zeros((1, 1))
+
+    monkeypatch.setattr(grade_service, 'detect_sheet', detect_sheet)
+    scanner = load_profile(None)
+    detections = detect_batch([(folder / "sheet_000000.jpg").read_bytes()], scanner=scanner)
+    assert seen == [scanner] and detections[0][1] is None
@@ -0,0 +1,52 @@
+import csv
+import sqlite3
+import zipfile
+
+from results_store import ResultsStore
+from sheet_pipeline import run_pipeline
+
+
+def row(image_name):
+    return {'image_name': image_name, 'grade': 1, 'error': None}
+
+def test_results_keep_source_order(tmp_path):
+    store = ResultsStore(str(tmp_path / "results.sqlite"))
+    # Graded out of order, as in a pipeline run
+    for position, image_name in [(2, "a.jpg"), (0, "c.jpg"), (1, "b.jpg")]:
+        store.add(row(image_name), position)
+    assert [result.image_name for result in store.results()] == ["c.jpg", "b.jpg", "a.jpg"]
+    store.close()
+
+def test_rows_default_to_the_order_they_are_added_in(tmp_path):
+    store = ResultsStore(str(tmp_path / "results.sqlite"))
+    for image_name in ["z.jpg", "m.jpg", "a.jpg"]:
+        store.add(row(image_name))
+    assert [result.image_name for result in store.results()] == ["z.jpg", "m.jpg", "a.jpg"]
+    store.close()
+
+def test_store_without_positions_keeps_write_order(tmp_path):
+    store_path = str(tmp_path / "results.sqlite")
+    store = ResultsStore(store_path)
+    for image_name in ["z.jpg", "a.jpg"]:
+        store.add(row(image_name))
+    store.close()
+    with sqlite3.connect(store_path) as connection:
+        connection.execute("UPDATE sheets SET position = NULL")
+    store = ResultsStore(store_path)
+    assert [result.image_name for result in store.results()] == ["z.jpg", "a.jpg"]
+    store.close()
+
+def test_pipeline_summary_from_store_is_in_folder_order(sheet_folder, tmp_path):
+    folder, marking_scheme_path = sheet_folder
+    # b.zip is listed before b_a.jpg, but its member b_z.jpg sorts after it by name
+    with zipfile.ZipFile(folder / "b.zip", 'w') as archive:
+        archive.write(folder / "sheet_000000.jpg", "z.jpg")
+    (folder / "sheet_000000.jpg").unlink()
+    (folder / "sheet_000001.jpg").rename(folder / "b_a.jpg")
+    output_folder = tmp_path / "output"
+    output_folder.mkdir()
+    run_pipeline(marking_scheme_path, str(folder), str(output_folder), workers=2, io_threads=2, queue_depth=3,
+                 store_path=str(output_folder / "results.sqlite"))
+    with open(output_folder / "Summary.csv", newline='') as file:
+        names = [summary_row['image_name'] for summary_row in csv.DictReader(file)]
+    assert names == ["b_z.jpg", "b_a.jpg", "sheet_000002.jpg"]
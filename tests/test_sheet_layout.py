@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+from sheet_layout import load_layout, sheet_sampler
+
+
+@pytest.mark.parametrize("width, height, stride", [(64, 85, 2), (64, 85, 4), (96, 128, 4)])
+def test_cells_without_samples_read_as_empty(width, height, stride):
+    layout = load_layout('circles-100x4')
+    sampler = sheet_sampler(layout, width, height, stride)
+    assert len(sampler.empty_cells), "the sheet should be small enough to leave cells without samples"
+    # Every sampled pixel is dark, so only the cells without samples read below the full bubble
+    thresh = np.ones((-(-height // stride), -(-width // stride)), dtype=np.uint8)
+    ratios = sampler.fill_ratios(thresh).ravel()
+    full = np.delete(ratios, sampler.empty_cells)
+    assert np.all(ratios[sampler.empty_cells] == 0)
+    assert np.allclose(full, full[0]) and full[0] > 0
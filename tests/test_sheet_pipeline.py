@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+import sheet_pipeline
+from sheet_pipeline import run_pipeline
+
+
+def test_writer_failure_raises_instead_of_hanging(sheet_folder, tmp_path, monkeypatch):
+    folder, marking_scheme_path = sheet_folder
+
+    def failing_save_graded_sheet(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(sheet_pipeline, 'save_graded_sheet', failing_save_graded_sheet)
+    outcome = []
+
+    def run():
+        try:
+            run_pipeline(marking_scheme_path, str(folder), str(tmp_path), workers=1, io_threads=1, queue_depth=1)
+        except BaseException as e:
+            outcome.append(e)
+
+    # With one slot, the second sheet waits for a slot the failed writer would never free
+    runner = threading.Thread(target=run, daemon=True)
+    runner.start()
+    runner.join(timeout=60)
+    assert not runner.is_alive(), "run_pipeline hung after the writer failed"
+    assert len(outcome) == 1 and isinstance(outcome[0], OSError)
+    assert str(outcome[0]) == "disk full"
+
+
+def test_pipeline_grades_every_sheet(sheet_folder, tmp_path):
+    folder, marking_scheme_path = sheet_folder
+    rows = run_pipeline(marking_scheme_path, str(folder), str(tmp_path), workers=1, io_threads=2, queue_depth=2)
+    assert [row['error'] for row in rows] == [None] * 3
+    assert (tmp_path / "Summary.csv").exists()
+
+
+def test_repeated_runs_do_not_deadlock(sheet_folder, tmp_path):
+    folder, marking_scheme_path = sheet_folder
+    finished = []
+
+    def run():
+        for _ in range(5):
+            # Workers start while the decode and writer threads are running
+            rows = run_pipeline(marking_scheme_path, str(folder), str(tmp_path), workers=2, io_threads=3,
+                                queue_depth=2)
+            finished.append([row['error'] for row in rows])
+
+    runner = threading.Thread(target=run, daemon=True)
+    runner.start()
+    runner.join(timeout=120)
+    assert not runner.is_alive(), "run_pipeline hung"
+    assert finished == [[None] * 3] * 5
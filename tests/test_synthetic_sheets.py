@@ -0,0 +1,11 @@
+import csv
+
+from synthetic_sheets import generate_to_folder, sheet_name
+
+
+def test_start_extends_the_ground_truth_summary(tmp_path):
+    generate_to_folder(str(tmp_path), 2, scale=0.25)
+    generate_to_folder(str(tmp_path), 2, scale=0.25, start=2)
+    with open(tmp_path / "ground_truth" / "Summary.csv", newline='') as file:
+        names = [row['image_name'] for row in csv.DictReader(file)]
+    assert names == [sheet_name(index) for index in range(4)]
@@ -0,0 +1,53 @@
+import csv
+import os
+
+import pytest
+
+import watch_folder
+from watch_folder import SettledFiles
+
+
+def stop_after_polls(monkeypatch, polls):
+    """Make the watch's idle sleep interrupt it, as Ctrl+C would, after a number of polls"""
+    remaining = [polls]
+
+    def sleep(seconds):
+        remaining[0] -= 1
+        if remaining[0] <= 0:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(watch_folder, '_open_inotify', lambda folder: None)
+    monkeypatch.setattr(watch_folder.time, 'sleep', sleep)
+
+def test_failing_sheet_does_not_stop_the_watch(sheet_folder, tmp_path, monkeypatch):
+    folder, marking_scheme_path = sheet_folder
+    grade_answer_sheet = watch_folder.grade_answer_sheet
+
+    def failing_grade_answer_sheet(image_path, *args, **kwargs):
+        if os.path.basename(image_path) == "sheet_000001.jpg":
+            raise OSError("unreadable")
+        return grade_answer_sheet(image_path, *args, **kwargs)
+
+    monkeypatch.setattr(watch_folder, 'grade_answer_sheet', failing_grade_answer_sheet)
+    stop_after_polls(monkeypatch, 3)
+    output_folder = tmp_path / "output"
+    output_folder.mkdir()
+    watch_folder.watch_folder(marking_scheme_path, str(folder), str(output_folder), poll_interval=0, settle_time=0)
+
+    with open(output_folder / "Summary.csv", newline='') as file:
+        rows = {row['image_name']: row for row in csv.DictReader(file)}
+    assert sorted(rows) == ["sheet_000000.jpg", "sheet_000001.jpg", "sheet_000002.jpg"]
+    assert rows["sheet_000001.jpg"]['error'] == "unreadable"
+    assert rows["sheet_000000.jpg"]['error'] == rows["sheet_000002.jpg"]['error'] == ""
+
+
+def test_settled_files_forget_graded_and_removed_sheets(sheet_folder):
+    folder, _ = sheet_folder
+    settled = SettledFiles(str(folder), settle_time=60)
+    for image_file in ["sheet_000000.jpg", "sheet_000001.jpg", "gone.jpg", "notes.txt"]:
+        settled.mark_closed(image_file)
+    (folder / "sheet_000002.jpg").write_bytes(b"")
+    assert sorted(settled.ready({"sheet_000000.jpg"})) == ["sheet_000001.jpg"]
+    os.remove(folder / "sheet_000002.jpg")
+    assert settled.ready({"sheet_000000.jpg", "sheet_000001.jpg"}) == []
+    assert not settled._closed and not settled._observed
@@ -0,0 +1,206 @@
+import csv
+import io
+import os
+import signal
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from detection_cache import DEFAULT_MAX_BYTES
+from grade_mcq import (
+    load_marking_scheme, list_answer_sheets, grade_answer_sheet, open_detection_cache, open_profile_log, error_row,
+    _init_worker, _grade_in_worker
+)
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+############################################################################
+
+###### Watch-folder ingestion for continuous scanner output ######
+
+# New sheets are graded once they are completely written: either inotify
+# reported that the writer closed them, or their size and mtime have not
+# changed for settle_time seconds and the JPEG/PNG trailer is present (the
+# stdlib polling fallback, which also covers network shares inotify cannot
+# see). Each result is appended to
+# Summary.csv as soon as it is graded, and sheets already listed there are
+# never graded again, including across restarts. A sheet that fails is
+# recorded with its error, as in batch runs, and the watch goes on.
+
+############################################################################
+
+SUMMARY_COLUMNS = ['image_name', 'grade', 'error']
+
+# Trailers written last by JPEG and PNG encoders
+_END_MARKERS = {'.jpg': b'\xff\xd9', '.jpeg': b'\xff\xd9', '.png': b'IEND\xaeB`\x82'}
+# A stable file without its trailer is graded anyway after this many settle periods
+_MISSING_TRAILER_PATIENCE = 10
+
+
+def read_summary(summary_file):
+    """Return the header and graded image names of an existing summary"""
+    if not os.path.exists(summary_file):
+        return None, set()
+    with open(summary_file, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        return header, {row[0] for row in reader if row}
+
+def append_summary_row(summary_file, row, columns):
+    """Append one row with a single O_APPEND write, so readers never see a partial line"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    if not os.path.exists(summary_file):
+        writer.writerow(columns)
+    writer.writerow(['' if row.get(column) is None else row.get(column) for column in columns])
+    fd = os.open(summary_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, buffer.getvalue().encode())
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def has_end_marker(image_path):
+    marker = _END_MARKERS.get(os.path.splitext(image_path)[1].lower())
+    if marker is None:
+        return True
+    with open(image_path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        file.seek(max(file.tell() - 16, 0))
+        return marker in file.read()
+
+class SettledFiles:
+    """Tracks candidate sheets until they are completely written"""
+
+    def __init__(self, folder, settle_time):
+        self.folder = folder
+        self.settle_time = settle_time
+        self._observed = {}
+        self._closed = set()
+
+    def mark_closed(self, image_file):
+        self._closed.add(image_file)
+
+    def ready(self, skip):
+        now = time.monotonic()
+        ready = []
+        image_files = list_answer_sheets(self.folder)
+        # Forget sheets that were graded or removed, so a long watch does not accumulate them
+        present = set(image_files) - skip
+        self._closed &= present
+        for image_file in set(self._observed) - present:
+            del self._observed[image_file]
+        for image_file in image_files:
+            if image_file in skip:
+                continue
+            image_path = os.path.join(self.folder, image_file)
+            try:
+                stat = os.stat(image_path)
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            previous = self._observed.get(image_file)
+            if previous is None or previous[0] != signature:
+                self._observed[image_file] = (signature, now)
+                previous = self._observed[image_file]
+            if stat.st_size == 0:
+                continue
+            stable_for = now - previous[1]
+            if image_file in self._closed or stable_for >= self.settle_time * _MISSING_TRAILER_PATIENCE:
+                ready.append(image_file)
+            elif stable_for >= self.settle_time and has_end_marker(image_path):
+                ready.append(image_file)
+        for image_file in ready:
+            self._observed.pop(image_file, None)
+            self._closed.discard(image_file)
+        return ready
+
+def _open_inotify(folder):
+    if inotify_simple is None:
+        return None
+    try:
+        inotify = inotify_simple.INotify()
+        flags = inotify_simple.flags
+        inotify.add_watch(folder, flags.CLOSE_WRITE | flags.MOVED_TO)
+        return inotify
+    except OSError:
+        return None
+
+def _stop_on_sigterm(signum, frame):
+    raise KeyboardInterrupt
+
+def watch_folder(marking_scheme_path, answer_sheet_folder, output_folder, workers=1, reduction=1,
+                 cache_path=None, cache_max_bytes=DEFAULT_MAX_BYTES, regrade_only=False, poll_interval=1.0,
+                 settle_time=2.0, profile_path=None, layout=None, scanner=None):
+    """Grade sheets as they arrive in answer_sheet_folder until interrupted"""
+    summary_file = os.path.join(output_folder, "Summary.csv")
+    header, processed = read_summary(summary_file)
+    columns = header or SUMMARY_COLUMNS
+    settled = SettledFiles(answer_sheet_folder, settle_time)
+    inotify = _open_inotify(answer_sheet_folder)
+    print(f"Watching {answer_sheet_folder} ({'inotify' if inotify else 'polling'}), "
+          f"{len(processed)} sheet(s) already graded")
+
+    pool, marking_scheme, cache, profile_log = None, None, None, None
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(marking_scheme_path, cache_path, cache_max_bytes, profile_path,
+                                             layout, scanner))
+    else:
+        marking_scheme = load_marking_scheme(marking_scheme_path, layout)
+        cache = open_detection_cache(cache_path, cache_max_bytes)
+        profile_log = open_profile_log(profile_path)
+
+    # Service managers stop the watcher with SIGTERM; treat it like Ctrl+C
+    signal.signal(signal.SIGTERM, _stop_on_sigterm)
+    in_flight = {}
+    try:
+        while True:
+            for image_file in settled.ready(processed | set(in_flight.values())):
+                image_path = os.path.join(answer_sheet_folder, image_file)
+                if pool is None:
+                    try:
+                        row = grade_answer_sheet(image_path, marking_scheme, output_folder, reduction, cache,
+                                                 regrade_only, profile_log, layout, scanner=scanner)
+                    except Exception as e:
+                        row = error_row(image_file, e)
+                    append_summary_row(summary_file, row, columns)
+                    processed.add(image_file)
+                else:
+                    future = pool.submit(_grade_in_worker, image_path, None, output_folder, reduction, regrade_only)
+                    in_flight[future] = image_file
+
+            # Wait for the next file event, a finished sheet or the poll interval
+            if in_flight:
+                done, _ = wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    image_file = in_flight.pop(future)
+                    try:
+                        row = future.result()
+                    except Exception as e:
+                        row = error_row(image_file, e)
+                    append_summary_row(summary_file, row, columns)
+                    processed.add(image_file)
+            elif inotify is not None:
+                for event in inotify.read(timeout=int(poll_interval * 1000)):
+                    settled.mark_closed(event.name)
+            else:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print("Stopping watch, finishing sheets in progress")
+        for future in list(in_flight):
+            try:
+                row = future.result()
+            except Exception:
+                # Not recorded, so it is graded again on the next start
+                continue
+            append_summary_row(summary_file, row, columns)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if cache is not None:
+            cache.close()
+        if inotify is not None:
+            inotify.close()